@@ -0,0 +1,355 @@
+"""
+Benchmarks of WarcDB's import and query hot paths, over synthetic WARC and WACZ files (see warcdb.synthetic).
+
+    python benchmarks/bench.py --records 5000 --output results.json
+    python benchmarks/bench.py --records 5000 --compare baseline.json
+
+Every import case runs `warcdb import` in a process of its own, so that its peak RSS can be measured.
+Queries (those of the README, and WarcDB lookups) are then timed against the database it built.
+Results are written as JSON. With --compare, metrics that got worse by more than --tolerance
+against a previous run are reported. Only import throughput (records/s, MB/s), the best of --import-repeat runs,
+counts as a regression, which makes the exit code 1: query latencies and migration timings
+are too noisy on shared machines (e.g. CI runners) to fail on.
+"""
+
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from importlib import metadata
+
+import click
+from warcio import ArchiveIterator
+
+from warcdb import WarcDB
+from warcdb.migrations import migration
+from warcdb.synthetic import write_synthetic_wacz, write_synthetic_warc
+
+# name: (source, extra `warcdb import` arguments)
+CASES = {
+    "default": ("warc", []),
+    "bulk": ("warc", ["--profile", "bulk"]),
+    "pipeline": ("warc", ["--pipeline"]),
+    "dedup-zlib": ("warc", ["--dedup", "--compression", "zlib"]),
+    "header-tables": ("warc", ["--header-tables"]),
+    "fts": ("warc", ["--fts"]),
+    "no-payload": ("warc", ["--no-payload"]),
+    "wacz": ("wacz", []),
+}
+
+QUERIES = {
+    "record_lookup": lambda db, sample: [db[id].rec_type for id in sample["ids"]],
+    "payload_lookup": lambda db, sample: [db.payload(id) for id in sample["ids"]],
+    "closest_capture": lambda db, sample: [
+        db.closest(url, "20240101000100") for url in sample["urls"]
+    ],
+    "cookie_headers": lambda db, sample: db.db.execute("""
+        select name, value from v_response_http_header where name = 'set-cookie'
+        union
+        select name, value from v_request_http_header where name = 'cookie'
+        """).fetchall(),
+    "response_headers": lambda db, sample: db.db.execute("""
+        select json_extract(h.value, '$.header') as header,
+               json_extract(h.value, '$.value') as value
+        from response, json_each(http_headers) h
+        """).fetchall(),
+    "cdxj": lambda db, sample: list(db.cdxj()),
+    "search": lambda db, sample: list(db.search("stocks market", limit=10)),
+}
+
+# Metrics where higher is better; for all others (timings) lower is better.
+# Only these are checked for regressions.
+HIGHER_IS_BETTER = {"records_per_sec", "mb_per_sec"}
+
+
+def _peak_rss_mb(rusage) -> float:
+    # KiB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return round(rusage.ru_maxrss / scale, 1)
+
+
+def _file_size_mb(*paths) -> float:
+    size = sum(os.path.getsize(p) for p in paths if os.path.exists(p))
+    return round(size / 1024 / 1024, 2)
+
+
+def best_import(db_path, source, args, repeat) -> dict:
+    """The fastest of several runs of an import, into a new database every time"""
+    runs = []
+    for _ in range(repeat):
+        for path in (db_path, f"{db_path}-wal", f"{db_path}-shm"):
+            if os.path.exists(path):
+                os.remove(path)
+        runs.append(run_import(db_path, source, args))
+    return min(runs, key=lambda run: run["seconds"])
+
+
+def run_import(db_path, source, args) -> dict:
+    """Run `warcdb import` in a separate process, and measure its throughput and peak RSS"""
+    command = [sys.executable, "-c", "from warcdb import warcdb_cli; warcdb_cli()"]
+    start = time.perf_counter()
+    process = subprocess.Popen(
+        [*command, "import", db_path, source, *args],
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+    )
+    stderr = process.stderr.read()
+    _, status, rusage = os.wait4(process.pid, 0)
+    seconds = time.perf_counter() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise click.ClickException(f"warcdb import {' '.join(args)} failed:\n{stderr}")
+
+    records = (
+        sqlite3.connect(db_path)
+        .execute("SELECT COUNT(*) FROM _warcdb_records")
+        .fetchone()[0]
+    )
+    input_mb = _file_size_mb(source)
+    return {
+        "records": records,
+        "seconds": round(seconds, 3),
+        "records_per_sec": round(records / seconds, 1),
+        "mb_per_sec": round(input_mb / seconds, 2),
+        "input_mb": input_mb,
+        "peak_rss_mb": _peak_rss_mb(rusage),
+        "db_size_mb": _file_size_mb(db_path, f"{db_path}-wal"),
+    }
+
+
+def time_queries(db_path, repeat) -> dict:
+    """The median and 95th percentile latency of every applicable query, in milliseconds"""
+    db = WarcDB(db_path)
+    # Lookups are done for a sample of the records, and of the URLs
+    sample = {
+        "ids": [
+            row[0]
+            for row in db.db.execute(
+                "SELECT warc_record_id FROM _warcdb_records ORDER BY warc_record_id LIMIT 100"
+            )
+        ],
+        "urls": [
+            row[0]
+            for row in db.db.execute(
+                "SELECT warc_target_uri FROM response ORDER BY warc_record_id LIMIT 100"
+            )
+        ],
+    }
+    timings = {}
+    for name, query in QUERIES.items():
+        if name == "search" and not db.db["response_text_fts"].exists():
+            continue
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            query(db, sample)
+            samples.append((time.perf_counter() - start) * 1000)
+        samples.sort()
+        timings[name] = {
+            "median_ms": round(statistics.median(samples), 3),
+            "p95_ms": round(samples[int(0.95 * (len(samples) - 1))], 3),
+        }
+    db.close()
+    return timings
+
+
+def time_migrations(workdir) -> dict:
+    """Time applying all migrations to a new database"""
+    db = WarcDB(os.path.join(workdir, "migrations.db"))
+    start = time.perf_counter()
+    migration.apply(db.db)
+    return {"seconds": round(time.perf_counter() - start, 4)}
+
+
+def time_iadd(warc_path, workdir) -> dict:
+    """Time `db += record` for records parsed beforehand, i.e. normalizing and writing them"""
+    records = []
+    with open(warc_path, "rb") as f:
+        for r in ArchiveIterator(f):
+            r.payload()
+            records.append(r)
+    db = WarcDB(os.path.join(workdir, "iadd.db"))
+    migration.apply(db.db)
+    start = time.perf_counter()
+    with db:
+        for r in records:
+            db += r
+    seconds = time.perf_counter() - start
+    return {
+        "records": len(records),
+        "seconds": round(seconds, 3),
+        "records_per_sec": round(len(records) / seconds, 1),
+    }
+
+
+def flatten(results, prefix=""):
+    """(metric path, value) pairs of the numeric leaves of the results"""
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from flatten(value, f"{prefix}{key}.")
+        elif isinstance(value, (int, float)):
+            yield f"{prefix}{key}", value
+
+
+def slowdowns(baseline, results, tolerance) -> list:
+    """Throughput and latency metrics that got worse by more than a relative tolerance"""
+    before = dict(flatten(baseline["results"]))
+    found = []
+    for metric, value in flatten(results["results"]):
+        name = metric.rsplit(".", 1)[-1]
+        if metric not in before or not before[metric]:
+            continue
+        if name in HIGHER_IS_BETTER:
+            change = (before[metric] - value) / before[metric]
+        elif name.endswith("_ms") or metric == "migrations.seconds":
+            change = (value - before[metric]) / before[metric]
+        else:
+            continue
+        if change > tolerance:
+            found.append(
+                {
+                    "metric": metric,
+                    "baseline": before[metric],
+                    "value": value,
+                    "change": round(change, 3),
+                    "regression": name in HIGHER_IS_BETTER,
+                }
+            )
+    return found
+
+
+@click.command()
+@click.option("--records", type=click.IntRange(min=1), default=2000, show_default=True)
+@click.option(
+    "--payload-size",
+    type=click.IntRange(min=1),
+    default=16 * 1024,
+    show_default=True,
+    help="Average response payload size, in bytes",
+)
+@click.option(
+    "--revisit-ratio",
+    type=click.FloatRange(0, 1),
+    default=0.1,
+    show_default=True,
+    help="Fraction of captures that are revisits",
+)
+@click.option(
+    "--no-gzip",
+    is_flag=True,
+    help="Write an uncompressed WARC (WACZ files are always gzipped)",
+)
+@click.option("--seed", type=click.INT, default=0, show_default=True)
+@click.option(
+    "case_names",
+    "--case",
+    type=click.Choice(list(CASES)),
+    multiple=True,
+    help="Import cases to run (can be repeated; all by default)",
+)
+@click.option(
+    "--repeat",
+    type=click.IntRange(min=1),
+    default=20,
+    show_default=True,
+    help="Runs of every query",
+)
+@click.option(
+    "--import-repeat",
+    type=click.IntRange(min=1),
+    default=1,
+    show_default=True,
+    help="Runs of every import case, of which the fastest is kept",
+)
+@click.option(
+    "--output",
+    type=click.File("w"),
+    default="-",
+    help="Where to write the JSON results",
+)
+@click.option(
+    "--compare",
+    type=click.File("r"),
+    help="Results of a previous run to check for regressions against",
+)
+@click.option(
+    "--tolerance",
+    type=click.FloatRange(min=0),
+    default=0.25,
+    show_default=True,
+    help="Relative change above which a metric is reported (and import throughput counts as a regression)",
+)
+def bench(
+    records,
+    payload_size,
+    revisit_ratio,
+    no_gzip,
+    seed,
+    case_names,
+    repeat,
+    import_repeat,
+    output,
+    compare,
+    tolerance,
+):
+    """Benchmark warcdb import and queries over synthetic WARC files"""
+    params = {
+        "records": records,
+        "payload_size": payload_size,
+        "revisit_ratio": revisit_ratio,
+        "gzip": not no_gzip,
+        "seed": seed,
+    }
+    try:
+        version = metadata.version("warcdb")
+    except metadata.PackageNotFoundError:
+        version = None
+    results = {
+        "warcdb": version,
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "platform": platform.platform(),
+        "params": params,
+        "results": {},
+    }
+
+    with tempfile.TemporaryDirectory() as workdir:
+        warc = os.path.join(workdir, "synthetic.warc" + (".gz" if not no_gzip else ""))
+        with open(warc, "wb") as f:
+            write_synthetic_warc(f, **params)
+        sources = {"warc": warc, "wacz": os.path.join(workdir, "synthetic.wacz")}
+        write_synthetic_wacz(sources["wacz"], **{**params, "gzip": True})
+
+        results["results"]["migrations"] = time_migrations(workdir)
+        results["results"]["iadd"] = time_iadd(warc, workdir)
+        imports = results["results"]["import"] = {}
+        for name in case_names or CASES:
+            source, args = CASES[name]
+            db_path = os.path.join(workdir, f"{name}.warcdb")
+            click.echo(f"import: {name}", err=True)
+            imports[name] = best_import(db_path, sources[source], args, import_repeat)
+            imports[name]["queries"] = time_queries(db_path, repeat)
+
+    json.dump(results, output, indent=2)
+    output.write("\n")
+
+    if compare:
+        found = slowdowns(json.load(compare), results, tolerance)
+        for slowdown in found:
+            click.echo(
+                "{kind}: {metric} {baseline} -> {value} ({change:+.0%})".format(
+                    kind="Regression" if slowdown["regression"] else "Slower",
+                    **slowdown,
+                ),
+                err=True,
+            )
+        if any(slowdown["regression"] for slowdown in found):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    bench()
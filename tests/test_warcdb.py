@@ -1,15 +1,88 @@
+import gzip
+import http.server
+import io
+import json
 import os
 import pathlib
+import pstats
 import re
+import socket
+import sqlite3
+import tempfile
+import threading
+import zipfile
+import tracemalloc
+from collections import defaultdict
 
 import pytest
 import sqlite_utils
 from click.testing import CliRunner
-from warcdb import warcdb_cli
+from sqlite_utils.plugins import pm
+from warcio import ArchiveIterator
+from warcdb import WarcDB, WarcDBDataset, codecs, warcdb_cli
+from warcdb.derived import registered_domain, surt, url_host
+from warcdb.migrations import migration
+from warcdb.parquet import _table_query
+from warcdb.pipeline import Pipeline
+from warcdb.profiles import deferred_indexes
+from warcdb.settings import get_setting
+from warcdb.sources import RecordFilter, iter_source
+from warcdb.synthetic import write_synthetic_wacz, write_synthetic_warc
+from warcdb.text import response_text
 
 db_file = "test_warc.db"
 tests_dir = pathlib.Path(__file__).parent
 
+
+class FlakyRangeRequestHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the tests dir with Range support, dropping the first response for each file half-way"""
+
+    dropped = set()
+    ranges = []
+    served = []
+
+    def do_GET(self):
+        data = (tests_dir / self.path.lstrip("/")).read_bytes()
+        start, end = 0, len(data)
+        if "Range" in self.headers:
+            first, last = self.headers["Range"].split("=")[1].split("-")
+            start, end = int(first), int(last or len(data) - 1) + 1
+            self.ranges.append((self.path, start))
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{len(data)}")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("ETag", f'"{len(data)}"')
+        self.end_headers()
+
+        body = data[start:end]
+        self.served.append(len(body))
+        if self.path not in self.dropped:
+            self.dropped.add(self.path)
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.connection.shutdown(socket.SHUT_RDWR)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def flaky_http_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), FlakyRangeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}"
+    server.shutdown()
+    FlakyRangeRequestHandler.dropped.clear()
+    FlakyRangeRequestHandler.ranges.clear()
+    FlakyRangeRequestHandler.served.clear()
+
+
 # all these WARC files were created with wget except for apod.warc.gz which was
 # created with browsertrix-crawler
 
@@ -37,7 +110,17 @@ def test_import(warc_path):
         "resource",
         "response",
         "warcinfo",
+        "revisit",
+        "conversion",
+        "continuation",
         "_sqlite_migrations",
+        "_warcdb_ingest_log",
+        "_warcdb_imports",
+        "_warcdb_records",
+        "warc_file",
+        "request_http_header",
+        "response_http_header",
+        "response_text",
     }
 
     if warc_path == str(tests_dir / "google.warc"):
@@ -101,3 +184,1339 @@ def test_http_header():
     assert next(responses)["http_status"] == 301
     assert next(responses)["http_status"] == 302
     assert next(responses)["http_status"] == 200
+
+
+def test_mapping_interface(tmp_path):
+    path = str(tmp_path / "mapping.db")
+    warc = str(tests_dir / "google.warc")
+    CliRunner().invoke(warcdb_cli, ["import", path, warc])
+    db = WarcDB(path)
+
+    records = list(ArchiveIterator(open(warc, "rb")))
+    assert len(db) == len(records)
+    assert set(db) == {r.rec_headers["WARC-Record-ID"] for r in records}
+
+    record_id = "<urn:uuid:524F62DD-D788-4085-B14D-22B0CDC0AC53>"
+    assert record_id in db and "<urn:uuid:missing>" not in db
+    r = db[record_id]
+    assert r.rec_type == "request"
+    assert r.rec_headers["WARC-Record-ID"] == record_id
+    assert r.rec_headers["WARC-Target-URI"] == "https://www.google.com/"
+    assert r.http_headers.get_header("host") == "www.google.com"
+    assert "_warcdb_payload" not in vars(r)
+
+    for row in db.db["response"].rows:
+        r = db[row["warc_record_id"]]
+        assert r.payload() == row["payload"]
+        assert r.http_headers.get_statuscode() == str(row["http_status"])
+
+    record_id = row["warc_record_id"]
+    del db[record_id]
+    assert record_id not in db and len(db) == len(records) - 1
+    with pytest.raises(KeyError):
+        db[record_id]
+
+    # records can be added back by id
+    r = next(r for r in records if r.rec_headers["WARC-Record-ID"] == record_id)
+    with db:
+        db[record_id] = r
+        assert db[record_id].rec_type == "response"
+    assert len(WarcDB(path)) == len(records)
+
+
+def test_delitem_deletes_dependent_rows(tmp_path):
+    path = str(tmp_path / "delitem.db")
+    wacz = str(tests_dir / "scoop.wacz")
+    result = CliRunner().invoke(
+        warcdb_cli, ["import", path, wacz, "--header-tables", "--fts", "--dedup"]
+    )
+    assert result.exit_code == 0, result.output
+    db = WarcDB(path)
+
+    def count(sql, record_id):
+        return db.db.execute(sql, [record_id]).fetchone()[0]
+
+    record_id = "<urn:uuid:2c260c52-85e7-4e49-9fa2-e999926606c7>"
+    digest = db.db["response_record"].get(record_id)["payload_digest"]
+    assert (
+        count("SELECT COUNT(*) FROM response_record WHERE payload_digest = ?", digest)
+        == 1
+    )
+    assert count(
+        "SELECT COUNT(*) FROM response_http_header WHERE warc_record_id = ?", record_id
+    )
+    assert record_id in [row["warc_record_id"] for row in db.search("Florents")]
+
+    del db[record_id]
+    assert record_id not in db
+    assert not count(
+        "SELECT COUNT(*) FROM response_http_header WHERE warc_record_id = ?", record_id
+    )
+    assert not count(
+        "SELECT COUNT(*) FROM response_text WHERE warc_record_id = ?", record_id
+    )
+    assert record_id not in [row["warc_record_id"] for row in db.search("Florents")]
+    # The index still matches the text table
+    db.db.execute(
+        "INSERT INTO response_text_fts (response_text_fts) VALUES ('integrity-check')"
+    )
+    assert not count("SELECT COUNT(*) FROM payloads WHERE digest = ?", digest)
+
+    # Payloads other records reference are kept
+    record_id, digest = db.db.execute("""
+        SELECT warc_record_id, payload_digest FROM response_record
+        WHERE payload_digest IN (
+            SELECT payload_digest FROM response_record GROUP BY 1 HAVING COUNT(*) > 1
+        )
+        """).fetchone()
+    del db[record_id]
+    assert count("SELECT COUNT(*) FROM payloads WHERE digest = ?", digest) == 1
+    assert (
+        count(
+            "SELECT COUNT(*) FROM response WHERE payload_digest = ? AND payload IS NULL",
+            digest,
+        )
+        == 0
+    )
+
+
+@pytest.mark.parametrize("batch_size", [1, 3, 1000])
+def test_import_batch_size(batch_size):
+    runner = CliRunner()
+    result = runner.invoke(
+        warcdb_cli,
+        ["import", db_file, str(tests_dir / "google.warc"), "--batch-size", batch_size],
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_file)
+    assert db["request"].count == 3
+    assert db["response"].count == 3
+
+    os.remove(db_file)
+
+
+def test_context_manager_flushes_on_exit():
+    db = WarcDB(db_file, batch_size=1000)
+    migration.apply(db.db)
+    with db:
+        for r in ArchiveIterator(open(tests_dir / "google.warc", "rb")):
+            db += r
+        # nothing has been written yet, everything is still buffered
+        assert sqlite_utils.Database(db_file)["response"].count == 0
+
+    assert sqlite_utils.Database(db_file)["response"].count == 3
+
+    os.remove(db_file)
+
+
+def test_import_memory_stays_flat(tmp_path):
+    """Payloads must not outlive their record once it has been written"""
+    from io import BytesIO
+
+    from warcio.warcwriter import WARCWriter
+
+    n_records, payload_size = 400, 64 * 1024
+    warc_file = tmp_path / "synthetic.warc"
+    with open(warc_file, "wb") as fh:
+        writer = WARCWriter(fh, gzip=False)
+        for i in range(n_records):
+            record = writer.create_warc_record(
+                f"https://example.com/{i}",
+                "resource",
+                payload=BytesIO(bytes([i % 256]) * payload_size),
+                warc_content_type="application/octet-stream",
+            )
+            writer.write_record(record)
+
+    db = WarcDB(str(tmp_path / "synthetic.warcdb"), batch_size=20)
+    migration.apply(db.db)
+
+    tracemalloc.start()
+    with db:
+        for r in ArchiveIterator(open(warc_file, "rb")):
+            db += r
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert sqlite_utils.Database(tmp_path / "synthetic.warcdb")["resource"].count == (
+        n_records
+    )
+    assert peak < n_records * payload_size / 4
+
+
+def test_import_jobs():
+    warcs = [
+        str(tests_dir / "google.warc"),
+        str(tests_dir / "frontpages.warc.gz"),
+        str(tests_dir / "scoop.wacz"),
+    ]
+    runner = CliRunner()
+    result = runner.invoke(warcdb_cli, ["import", db_file, *warcs])
+    assert result.exit_code == 0
+    sequential = sqlite_utils.Database(db_file)
+    expected = {t.name: t.count for t in sequential.tables}
+    record_ids = {
+        row[0]
+        for row in sequential.execute("SELECT warc_record_id FROM _warcdb_records")
+    }
+    os.remove(db_file)
+
+    result = runner.invoke(warcdb_cli, ["import", db_file, *warcs, "--jobs", 2])
+    assert result.exit_code == 0
+    parallel = sqlite_utils.Database(db_file)
+    assert {t.name: t.count for t in parallel.tables} == expected
+    assert {
+        row[0] for row in parallel.execute("SELECT warc_record_id FROM _warcdb_records")
+    } == record_ids
+
+    # The records of each file are inserted in the order they were read in
+    for table in parallel.tables:
+        if "warc_file_id" not in table.columns_dict:
+            continue
+        offsets = defaultdict(list)
+        for file_id, offset in parallel.execute(
+            f"SELECT warc_file_id, warc_offset FROM [{table.name}] ORDER BY rowid"
+        ):
+            offsets[file_id].append(offset)
+        for file_offsets in offsets.values():
+            assert file_offsets == sorted(set(file_offsets)), table.name
+
+    os.remove(db_file)
+
+
+def test_import_pipeline():
+    warcs = [
+        str(tests_dir / "google.warc"),
+        str(tests_dir / "frontpages.warc.gz"),
+        str(tests_dir / "scoop.wacz"),
+    ]
+    runner = CliRunner()
+    result = runner.invoke(warcdb_cli, ["import", db_file, *warcs])
+    assert result.exit_code == 0
+    query = "SELECT warc_record_id, warc_offset, payload FROM response ORDER BY 1"
+    expected = list(sqlite_utils.Database(db_file).query(query))
+    os.remove(db_file)
+
+    result = runner.invoke(warcdb_cli, ["import", db_file, *warcs, "--pipeline"])
+    assert result.exit_code == 0
+    assert list(sqlite_utils.Database(db_file).query(query)) == expected
+    for stage in ["read", "parse", "normalize", "write"]:
+        assert re.search(rf"^\s*{stage}\s+\d+", result.output, re.MULTILINE)
+
+    # Everything was checkpointed
+    result = runner.invoke(warcdb_cli, ["import", db_file, *warcs, "--pipeline"])
+    assert "already imported" in result.output
+
+    result = runner.invoke(
+        warcdb_cli, ["import", db_file, *warcs, "--pipeline", "--jobs", 2]
+    )
+    assert result.exit_code != 0
+
+    os.remove(db_file)
+
+
+def test_pipeline_propagates_errors():
+    def items():
+        yield from range(10)
+        raise ValueError("parse failed")
+
+    def normalize(item):
+        if item == 20:
+            raise ValueError("normalize failed")
+        return item
+
+    with pytest.raises(ValueError, match="parse failed"):
+        list(Pipeline(items(), [("normalize", normalize)]))
+
+    pipeline = Pipeline(range(100), [("normalize", normalize)], queue_size=4)
+    with pytest.raises(ValueError, match="normalize failed"):
+        list(pipeline)
+    assert [s["stage"] for s in pipeline.report()] == ["parse", "normalize", "write"]
+
+
+def test_import_profiles(tmp_path):
+    runner = CliRunner()
+    warc = str(tests_dir / "frontpages.warc.gz")
+    indexes = "SELECT name, sql FROM sqlite_master WHERE type IN ('index', 'trigger') AND sql IS NOT NULL ORDER BY name"
+    result = runner.invoke(warcdb_cli, ["import", str(tmp_path / "default.db"), warc])
+    assert result.exit_code == 0
+    expected = list(sqlite_utils.Database(tmp_path / "default.db").query(indexes))
+
+    db_path = str(tmp_path / "bulk.db")
+    result = runner.invoke(warcdb_cli, ["import", db_path, warc, "--profile", "bulk"])
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    assert db.journal_mode == "wal"
+    assert list(db.query(indexes)) == expected
+    settings = dict(db.execute("SELECT key, value FROM _warcdb_settings").fetchall())
+    assert settings["import_profile"] == "bulk"
+    assert json.loads(settings["import_pragmas"])["synchronous"] == 0
+    assert settings["deferred_indexes"] is None
+
+    # Full-text search triggers are dropped during the import, and the index rebuilt after it
+    db["response"].enable_fts(["payload"], create_triggers=True)
+    db.close()
+    result = runner.invoke(
+        warcdb_cli,
+        ["import", db_path, str(tests_dir / "google.warc"), "--profile", "bulk"],
+    )
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    assert db["response"].search("google")
+    assert len(list(db.query(indexes))) == len(expected) + 3
+
+    readonly = WarcDB(db_path, profile="readonly")
+    assert readonly.pragmas["query_only"] == 1
+    assert readonly.db.execute("PRAGMA temp_store").fetchone()[0] == 0
+    assert len(readonly)
+    with pytest.raises(sqlite3.OperationalError):
+        readonly.db["warc_file"].delete_where()
+
+
+def test_import_dedup():
+    runner = CliRunner()
+    warc = str(tests_dir / "frontpages.warc.gz")
+
+    runner.invoke(warcdb_cli, ["import", db_file, warc])
+    db = sqlite_utils.Database(db_file)
+    payloads = sorted(r[0] for r in db.execute("SELECT payload FROM response"))
+    os.remove(db_file)
+
+    # enabling dedup converts an existing database in place
+    runner.invoke(warcdb_cli, ["import", db_file, str(tests_dir / "google.warc")])
+    result = runner.invoke(warcdb_cli, ["import", db_file, warc, "--dedup"])
+    assert result.exit_code == 0
+    # ...and is remembered afterwards
+    result = runner.invoke(warcdb_cli, ["import", db_file, warc])
+    assert result.exit_code == 0
+
+    db = sqlite_utils.Database(db_file)
+    assert "payload" not in db["response_record"].columns_dict
+    assert db["response"].count == 3 + len(payloads)
+    assert db["payloads"].count <= db["response"].count + db["resource"].count
+    assert set(payloads) <= {r[0] for r in db.execute("SELECT payload FROM response")}
+    assert db.execute("SELECT COUNT(*) FROM v_response_http_header").fetchone()[0]
+
+    os.remove(db_file)
+
+
+def test_warc_payload_function():
+    warc = str(tests_dir / "google.warc")
+    CliRunner().invoke(warcdb_cli, ["import", db_file, warc, "--compression", "zlib"])
+    query = "SELECT warc_record_id, warc_payload(payload) FROM response"
+    db = WarcDB(db_file)
+    rows = list(db.db.execute(query))
+    assert rows == [(record_id, db.payload(record_id)) for record_id, _ in rows]
+
+    # Other connections only have it through the sqlite-utils plugin
+    with pytest.raises(sqlite3.OperationalError):
+        sqlite_utils.Database(db_file).execute(query)
+    pm.register(codecs)
+    try:
+        assert list(sqlite_utils.Database(db_file).execute(query)) == rows
+    finally:
+        pm.unregister(codecs)
+    os.remove(db_file)
+
+
+@pytest.mark.parametrize("codec", ["zlib", "zstd"])
+def test_import_compression(codec):
+    if codec == "zstd":
+        pytest.importorskip("zstandard")
+    runner = CliRunner()
+    warc = str(tests_dir / "frontpages.warc.gz")
+
+    runner.invoke(warcdb_cli, ["import", db_file, warc])
+    db = sqlite_utils.Database(db_file)
+    assert db["response"].columns_dict["payload"] is bytes
+    expected = list(db.execute("SELECT warc_record_id, payload FROM response"))
+    os.remove(db_file)
+
+    # switching codec on an existing database recompresses what's already there
+    runner.invoke(warcdb_cli, ["import", db_file, str(tests_dir / "google.warc")])
+    result = runner.invoke(
+        warcdb_cli, ["import", db_file, warc, "--compression", codec]
+    )
+    assert result.exit_code == 0
+
+    db = WarcDB(db_file).db
+    rows = dict(
+        db.execute("SELECT warc_record_id, warc_payload(payload) FROM response")
+    )
+    for warc_record_id, payload in expected:
+        assert rows[warc_record_id] == payload
+    compressed = db.execute("SELECT SUM(LENGTH(payload)) FROM response").fetchone()[0]
+    assert compressed < sum(len(payload) for payload in rows.values())
+
+    os.remove(db_file)
+
+
+@pytest.mark.parametrize(
+    "warc_path", [tests_dir / "frontpages.warc.gz", tests_dir / "scoop.wacz"]
+)
+def test_import_no_payload(warc_path, tmp_path):
+    full_db, ref_db = str(tmp_path / "full.db"), str(tmp_path / "ref.db")
+    runner = CliRunner()
+    assert runner.invoke(warcdb_cli, ["import", full_db, str(warc_path)]).exit_code == 0
+    result = runner.invoke(
+        warcdb_cli, ["import", ref_db, "--no-payload", str(warc_path)]
+    )
+    assert result.exit_code == 0
+
+    ref = WarcDB(ref_db)
+    assert ref.db["response"].count == sqlite_utils.Database(full_db)["response"].count
+    assert ref.db.execute("SELECT COUNT(payload) FROM response").fetchone()[0] == 0
+    assert [f["path"] for f in ref.db["warc_file"].rows] == [os.path.abspath(warc_path)]
+
+    # payloads are read back from the WARC file, at the offset they were found at
+    for row in sqlite_utils.Database(full_db).query(
+        "SELECT warc_record_id, payload FROM response UNION ALL SELECT warc_record_id, payload FROM resource"
+    ):
+        assert ref.payload(row["warc_record_id"]) == row["payload"]
+
+
+@pytest.mark.parametrize(
+    "args",
+    [
+        ["--large-payloads", "stream"],
+        ["--large-payloads", "stream", "--compression", "zlib"],
+        ["--large-payloads", "stream", "--dedup"],
+        ["--large-payloads", "reference"],
+    ],
+)
+def test_import_large_payloads(args, tmp_path, monkeypatch):
+    warc_path = str(tests_dir / "frontpages.warc.gz")
+    full_db, large_db = str(tmp_path / "full.db"), str(tmp_path / "large.db")
+    # Spooled payloads are deleted once written
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    runner = CliRunner()
+    assert runner.invoke(warcdb_cli, ["import", full_db, warc_path]).exit_code == 0
+    result = runner.invoke(
+        warcdb_cli,
+        ["import", large_db, warc_path, "--large-payload-size", 10000, *args],
+    )
+    assert result.exit_code == 0
+
+    large = WarcDB(large_db)
+    expected = {
+        row["warc_record_id"]: row["payload"]
+        for row in sqlite_utils.Database(full_db).query(
+            "SELECT warc_record_id, payload FROM response"
+        )
+    }
+    assert any(len(payload) > 10000 for payload in expected.values())
+    for warc_record_id, payload in expected.items():
+        assert large.payload(warc_record_id) == payload
+    # Large payloads are stored by digest, or left in the WARC in reference mode
+    if "reference" in args:
+        assert not large.db["payloads"].exists()
+    else:
+        assert large.db.execute(
+            "SELECT COUNT(*) FROM payloads WHERE LENGTH(warc_payload(payload)) > 10000"
+        ).fetchone()[0] == sum(len(p) > 10000 for p in set(expected.values()))
+    assert sorted(os.listdir(tmp_path)) == ["full.db", "large.db"]
+
+
+def test_header_tables():
+    runner = CliRunner()
+    runner.invoke(warcdb_cli, ["import", db_file, str(tests_dir / "google.warc")])
+    db = sqlite_utils.Database(db_file)
+    query = "SELECT * FROM v_response_http_header ORDER BY warc_record_id, name, value"
+    from_json = list(db.query(query))
+    assert from_json and db["response_http_header"].count == 0
+
+    # backfill existing records
+    result = runner.invoke(warcdb_cli, ["index-headers", db_file])
+    assert result.exit_code == 0
+    assert db["response_http_header"].count == len(from_json)
+    assert list(db.query(query)) == from_json
+    plan = db.execute(
+        "EXPLAIN QUERY PLAN SELECT * FROM v_response_http_header WHERE name = 'location'"
+    ).fetchall()
+    assert "INDEX" in plan[0][-1]
+
+    # subsequent imports write them as well
+    runner.invoke(
+        warcdb_cli, ["import", db_file, str(tests_dir / "frontpages.warc.gz")]
+    )
+    assert (
+        db["request_http_header"].count
+        == db.execute(
+            "SELECT COUNT(*) FROM request, JSON_EACH(request.http_headers)"
+        ).fetchone()[0]
+    )
+
+    os.remove(db_file)
+
+
+def test_full_text_search():
+    runner = CliRunner()
+    warc = str(tests_dir / "frontpages.warc.gz")
+    result = runner.invoke(warcdb_cli, ["import", db_file, warc, "--fts", "--dedup"])
+    assert result.exit_code == 0
+
+    db = WarcDB(db_file)
+    texts = {row["warc_record_id"]: row for row in db.db["response_text"].rows}
+    assert texts
+    # Markup, scripts and styles are stripped
+    assert not any(
+        "<div" in row["text"] or "function(" in row["text"] for row in texts.values()
+    )
+    hits = list(db.search("York"))
+    assert "The New York Times" in hits[0]["title"]
+    # Text extraction is remembered for subsequent imports
+    runner.invoke(warcdb_cli, ["import", db_file, str(tests_dir / "google.warc")])
+    assert list(db.search("google"))
+
+    # index-text backfills an existing database
+    os.remove(db_file)
+    runner.invoke(warcdb_cli, ["import", db_file, warc, "--compression", "zlib"])
+    result = runner.invoke(warcdb_cli, ["index-text", db_file])
+    assert result.exit_code == 0
+    db = WarcDB(db_file)
+    assert {
+        row["warc_record_id"]: row for row in db.db["response_text"].rows
+    }.keys() == texts.keys()
+    assert [hit["warc_record_id"] for hit in db.search("York")] == [
+        hit["warc_record_id"] for hit in hits
+    ]
+
+    os.remove(db_file)
+
+
+@pytest.mark.parametrize(
+    "content_type,body,expected",
+    [
+        (
+            "text/html",
+            "<title>Caf\xe9</title><p>na\xefve</p>".encode("utf-8"),
+            ("Café", "naïve"),
+        ),
+        (
+            "text/html",
+            '<meta charset="iso-8859-1"><p>na\xefve</p>'.encode("latin-1"),
+            ("", "naïve"),
+        ),
+        (
+            # Without </head>, which is optional
+            "text/html",
+            b"<html><head><title>Home</title><meta charset=utf-8><style>p {}</style>"
+            b"<body><p>Hello <b>world</b></p><script>var x;</script>",
+            ("Home", "Hello world"),
+        ),
+        ("text/plain; charset=latin-1", "na\xefve".encode("latin-1"), (None, "naïve")),
+        ("text/css", b"p { color: red }", None),
+    ],
+)
+def test_response_text(content_type, body, expected):
+    headers = [{"header": "Content-Type", "value": content_type}]
+    row = {"payload": body, "http_headers": json.dumps(headers)}
+    assert response_text(row) == expected
+    # Still Content-Encoded
+    headers.append({"header": "Content-Encoding", "value": "gzip"})
+    row = {"payload": gzip.compress(body), "http_headers": json.dumps(headers)}
+    assert response_text(row) == expected
+
+
+@pytest.mark.parametrize(
+    "url,expected_surt,expected_domain",
+    [
+        (
+            "https://www.Example.com/A?b=1&a=2#top",
+            "com,example)/a?a=2&b=1",
+            "example.com",
+        ),
+        ("http://news.bbc.co.uk:80", "uk,co,bbc,news)/", "bbc.co.uk"),
+        ("http://example.org:8080/x", "org,example:8080)/x", "example.org"),
+        ("http://127.0.0.1/", "127.0.0.1)/", "127.0.0.1"),
+        ("dns:example.com", "dns:example.com", None),
+    ],
+)
+def test_derived_url_columns(url, expected_surt, expected_domain):
+    assert surt(url) == expected_surt
+    assert registered_domain(url_host(url)) == expected_domain
+
+
+def test_derived_columns_are_indexed():
+    runner = CliRunner()
+    runner.invoke(warcdb_cli, ["import", db_file, str(tests_dir / "scoop.wacz")])
+    db = sqlite_utils.Database(db_file)
+    row = db.execute("""
+        SELECT surt, host, registered_domain, date_epoch FROM response
+        WHERE warc_target_uri = 'https://github.com/Florents-Tselai/WarcDB'
+        """).fetchone()
+    assert row == (
+        "com,github)/florents-tselai/warcdb",
+        "github.com",
+        "github.com",
+        1697804567,
+    )
+
+    for query in [
+        "SELECT * FROM response WHERE surt = 'com,github)/' ORDER BY date_epoch",
+        "SELECT * FROM response WHERE host = 'github.com' AND date_epoch BETWEEN 1697804567 AND 1697804600",
+        "SELECT * FROM response WHERE http_status >= 500",
+    ]:
+        plan = db.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+        assert "USING INDEX" in plan[0][-1], query
+
+    os.remove(db_file)
+
+
+def test_cdx():
+    wacz = str(tests_dir / "scoop.wacz")
+    runner = CliRunner()
+    runner.invoke(warcdb_cli, ["import", db_file, wacz])
+    result = runner.invoke(warcdb_cli, ["cdx", db_file])
+    assert result.exit_code == 0
+
+    def fields(line):
+        key, timestamp, entry = line.split(" ", 2)
+        entry = json.loads(entry)
+        return (
+            key,
+            timestamp,
+            *(str(entry[k]) for k in ("url", "digest", "length", "offset", "filename")),
+        )
+
+    lines = [fields(line) for line in result.output.splitlines()]
+    assert [line[:2] for line in lines] == sorted(line[:2] for line in lines)
+
+    # the same captures as the index the WACZ ships with
+    # (whose keys of POST requests also include the request body)
+    index = zipfile.ZipFile(wacz).read("indexes/index.cdx").decode().splitlines()
+    assert sorted(
+        line[1:] for line in lines if not line[2].startswith("urn:")
+    ) == sorted(fields(line)[1:] for line in index if '"urn:' not in line)
+
+    db = WarcDB(db_file)
+    url = "https://github.com/Florents-Tselai/WarcDB"
+    for timestamp in [None, "2023-10-20", "20231020122247"]:
+        [r] = db.closest(url, timestamp)
+        assert r.rec_headers["WARC-Target-URI"] == url
+    assert db.closest("https://example.com/") == []
+
+    os.remove(db_file)
+
+
+def test_export(tmp_path):
+    runner = CliRunner()
+    runner.invoke(warcdb_cli, ["import", db_file, str(tests_dir / "scoop.wacz")])
+    out = str(tmp_path / "out.warc.gz")
+    where = ["--where", "host = :host", "-p", "host", "github.com"]
+    result = runner.invoke(warcdb_cli, ["export", db_file, out, *where])
+    assert result.exit_code == 0, result.output
+
+    # every record is its own gzip member, so it can be read on its own
+    with open(out, "rb") as f:
+        for offset, length, _ in iter_source((out, None)):
+            f.seek(offset)
+            assert len(list(ArchiveIterator(io.BytesIO(f.read(length))))) == 1
+
+    exported = str(tmp_path / "exported.db")
+    runner.invoke(warcdb_cli, ["import", exported, out])
+    db, subset = WarcDB(db_file), WarcDB(exported)
+    query = "SELECT warc_record_id, http_status_line, warc_target_uri FROM response WHERE host = 'github.com'"
+    assert list(db.db.execute(query)) == list(subset.db.execute(query))
+    query = (
+        "SELECT warc_record_id, http_status_line FROM request WHERE host = 'github.com'"
+    )
+    assert list(db.db.execute(query)) == list(subset.db.execute(query))
+    # warcinfo records don't have a host, so they're skipped
+    expected = {
+        row[0]
+        for rec_type in ["request", "response", "metadata", "resource"]
+        for row in db.db.execute(
+            f"SELECT warc_record_id FROM {rec_type} WHERE host = 'github.com'"
+        )
+    }
+    assert set(subset) == expected
+    for record_id in subset:
+        assert subset.payload(record_id) == db.payload(record_id)
+
+    # Records are read in WARC order from an index, rather than sorted
+    for rec_type in ["warcinfo", "request", "response", "metadata", "resource"]:
+        plan = db.db.execute(
+            f"EXPLAIN QUERY PLAN SELECT * FROM [{rec_type}] ORDER BY warc_file_id, warc_offset"
+        ).fetchall()
+        assert not any("TEMP B-TREE" in row[-1] for row in plan)
+
+    # A condition on a column no table has fails, rather than exporting nothing
+    where = ["--where", "hots = :host", "-p", "host", "github.com"]
+    result = runner.invoke(warcdb_cli, ["export", db_file, out, *where])
+    assert result.exit_code == 1
+    assert "Error: no such column: hots" in result.output
+
+    os.remove(db_file)
+
+
+def test_revisit_conversion_continuation(tmp_path):
+    from warcio import StatusAndHeaders
+    from warcio.warcwriter import WARCWriter
+
+    warc = str(tmp_path / "revisits.warc.gz")
+    url = "https://example.com/"
+    with open(warc, "wb") as f:
+        writer = WARCWriter(f, gzip=True)
+        http_headers = StatusAndHeaders(
+            "200 OK", [("Content-Type", "text/plain")], protocol="HTTP/1.1"
+        )
+        response = writer.create_warc_record(
+            url, "response", payload=io.BytesIO(b"hello"), http_headers=http_headers
+        )
+        writer.write_record(response)
+        digest = response.rec_headers["WARC-Payload-Digest"]
+        response_id = response.rec_headers["WARC-Record-ID"]
+        date = response.rec_headers["WARC-Date"]
+        for headers in [{"WARC-Refers-To": response_id}, {}]:
+            writer.write_record(
+                writer.create_revisit_record(
+                    url, digest, url, date, http_headers, warc_headers_dict=headers
+                )
+            )
+        for rec_type in ["conversion", "continuation"]:
+            writer.write_record(
+                writer.create_warc_record(
+                    url,
+                    rec_type,
+                    payload=io.BytesIO(b"converted"),
+                    warc_content_type="text/plain",
+                )
+            )
+
+    result = CliRunner().invoke(warcdb_cli, ["import", db_file, warc])
+    assert result.exit_code == 0, result.output
+    db = WarcDB(db_file)
+    assert {t: db.db[t].count for t in ["revisit", "conversion", "continuation"]} == {
+        "revisit": 2,
+        "conversion": 1,
+        "continuation": 1,
+    }
+
+    # revisits resolve to the original payload, by WARC-Refers-To or by digest
+    for revisit in db.db["revisit"].rows:
+        assert db[revisit["warc_record_id"]].payload() == b"hello"
+        assert revisit["http_status"] == 200
+    conversion = next(db.db["conversion"].rows)
+    assert db.payload(conversion["warc_record_id"]) == b"converted"
+
+    captures = sorted(r.rec_type for r in db.closest(url, limit=3))
+    assert captures == ["response", "revisit", "revisit"]
+    assert sum("warc/revisit" in line for line in db.cdxj()) == 2
+
+    os.remove(db_file)
+
+
+def test_synthetic_wacz(tmp_path):
+    params = dict(records=50, payload_size=1024, revisit_ratio=0.2)
+    wacz = tmp_path / "synthetic.wacz"
+    count = write_synthetic_wacz(wacz, **params)
+    write_synthetic_wacz(tmp_path / "again.wacz", **params)
+    assert wacz.read_bytes() == (tmp_path / "again.wacz").read_bytes()
+
+    runner = CliRunner()
+    result = runner.invoke(warcdb_cli, ["import", db_file, str(wacz)])
+    assert result.exit_code == 0
+    db = WarcDB(db_file)
+    assert len(db) == count
+    revisits = [row["warc_record_id"] for row in db.db["revisit"].rows]
+    assert revisits
+    assert all(db.payload(record_id) for record_id in revisits)
+    os.remove(db_file)
+
+    # Its index is used to seek to the captures matching filters
+    result = runner.invoke(warcdb_cli, ["import", db_file, str(wacz), "--status", 404])
+    assert result.exit_code == 0
+    statuses = WarcDB(db_file).db.execute(
+        "SELECT http_status FROM response UNION ALL SELECT http_status FROM revisit"
+    )
+    assert [status for status, in statuses] == [404, 404]
+    os.remove(db_file)
+
+
+@pytest.mark.parametrize("shard_by", ["crawl", "month", "host"])
+def test_dataset(shard_by, tmp_path):
+    warcs = [
+        str(tests_dir / "google.warc"),
+        str(tests_dir / "frontpages.warc.gz"),
+        str(tests_dir / "scoop.wacz"),
+    ]
+    single_db, dataset_path = str(tmp_path / "single.db"), str(tmp_path / "dataset")
+    runner = CliRunner()
+    assert runner.invoke(warcdb_cli, ["import", single_db, *warcs]).exit_code == 0
+    result = runner.invoke(
+        warcdb_cli,
+        [
+            "import",
+            dataset_path,
+            *warcs,
+            "--shard-by",
+            shard_by,
+            "--compression",
+            "zlib",
+        ],
+    )
+    assert result.exit_code == 0
+    single = WarcDB(single_db)
+
+    dataset = WarcDBDataset(dataset_path)
+    shards = dataset.shards()
+    assert len(shards) > 1
+    assert set(os.listdir(dataset_path)) == {
+        "catalog.warcdb",
+        *(os.path.basename(path) for path in shards.values()),
+    }
+    query = "SELECT warc_record_id, rec_type FROM _warcdb_records ORDER BY 1"
+    assert [tuple(row.values()) for row in dataset.query(query)] == [
+        tuple(row) for row in single.db.execute(query)
+    ]
+    assert len(dataset) == len(single)
+    for row in single.db.query("SELECT warc_record_id, payload FROM response"):
+        assert dataset.payload(row["warc_record_id"]) == row["payload"]
+    assert list(dataset.cdxj()) == list(single.cdxj())
+
+    # Shards a predicate rules out aren't attached
+    if shard_by == "month":
+        predicate = {"from_": "2022-06", "to": "2022-06-30"}
+    elif shard_by == "host":
+        predicate = {"host": "www.google.com"}
+    else:
+        predicate = {"crawl": "google.warc"}
+    pruned = dataset.shards(**predicate)
+    assert 0 < len(pruned) < len(shards)
+    count = "SELECT COUNT(*) AS n FROM response WHERE host = 'www.google.com'"
+    assert list(dataset.query(count, **predicate)) == list(single.db.query(count))
+
+    # The ingest log is the dataset's
+    result = runner.invoke(warcdb_cli, ["import", dataset_path, *warcs])
+    assert result.output.count("already imported") == len(warcs)
+    other = "host" if shard_by != "host" else "month"
+    result = runner.invoke(
+        warcdb_cli, ["import", dataset_path, *warcs, "--shard-by", other]
+    )
+    assert result.exit_code != 0
+    assert f"sharded by {shard_by}" in result.output
+
+    result = runner.invoke(
+        warcdb_cli,
+        ["dataset-query", dataset_path, count, "--nl", *predicate_args(predicate)],
+    )
+    assert result.exit_code == 0
+    assert json.loads(result.output) == next(single.db.query(count))
+
+
+def test_dataset_query_all_shards(tmp_path):
+    warc = str(tmp_path / "synthetic.warc.gz")
+    with open(warc, "wb") as f:
+        write_synthetic_warc(f, records=200, payload_size=256, hosts=50)
+    single_db = str(tmp_path / "single.db")
+    runner = CliRunner()
+    runner.invoke(warcdb_cli, ["import", single_db, warc])
+    single = sqlite_utils.Database(single_db)
+    count = "SELECT COUNT(*) AS n FROM response"
+
+    # Default host shards are queried over a single connection
+    dataset_path = str(tmp_path / "hosts")
+    runner.invoke(warcdb_cli, ["import", dataset_path, warc, "--shard-by", "host"])
+    assert len(WarcDBDataset(dataset_path).shards()) == 8
+    result = runner.invoke(warcdb_cli, ["dataset-query", dataset_path, count, "--nl"])
+    assert result.exit_code == 0, result.output
+    assert json.loads(result.output) == next(single.query(count))
+
+    # More shards than SQLite can attach are queried in batches
+    dataset_path = str(tmp_path / "many")
+    runner.invoke(
+        warcdb_cli,
+        ["import", dataset_path, warc, "--shard-by", "host", "--shards", 16],
+    )
+    dataset = WarcDBDataset(dataset_path)
+    assert len(dataset.shards()) == 16
+    query = "SELECT warc_record_id FROM response"
+    assert sorted(row["warc_record_id"] for row in dataset.query(query)) == sorted(
+        row[0] for row in single.execute(query)
+    )
+    assert sum(row["n"] for row in dataset.query(count)) == single["response"].count
+    with pytest.raises(ValueError, match="can only attach"):
+        dataset.connect()
+    result = runner.invoke(warcdb_cli, ["dataset-query", dataset_path, count])
+    assert result.exit_code == 0
+    assert "2 batches" in result.output
+
+
+def predicate_args(predicate):
+    return [
+        arg
+        for name, value in predicate.items()
+        for arg in (f"--{name.rstrip('_')}", value)
+    ]
+
+
+def test_merge(tmp_path):
+    runner = CliRunner()
+    imports = {
+        "google.db": [str(tests_dir / "google.warc"), "--compression", "zlib"],
+        "frontpages.db": [str(tests_dir / "frontpages.warc.gz"), "--fts"],
+        "scoop.db": [str(tests_dir / "scoop.wacz"), "--large-payload-size", 10000],
+        # Overlaps with google.db
+        "both.db": [str(tests_dir / "google.warc"), str(tests_dir / "scoop.wacz")],
+    }
+    for name, args in imports.items():
+        result = runner.invoke(warcdb_cli, ["import", str(tmp_path / name), *args])
+        assert result.exit_code == 0
+    single_db = str(tmp_path / "single.db")
+    warcs = ["google.warc", "frontpages.warc.gz", "scoop.wacz"]
+    runner.invoke(
+        warcdb_cli, ["import", single_db, *(str(tests_dir / w) for w in warcs)]
+    )
+
+    merged_db = str(tmp_path / "merged.db")
+    inputs = [str(tmp_path / name) for name in imports]
+    result = runner.invoke(warcdb_cli, ["merge", merged_db, *inputs])
+    assert result.exit_code == 0
+    assert f"{inputs[-1]}: 0 records added" in result.output
+
+    merged, single = WarcDB(merged_db), WarcDB(single_db)
+    # The settings of the inputs are combined, and indexes built
+    assert get_setting(merged.db, "payload_codec") == "zlib"
+    assert list(merged.search("news"))
+    assert deferred_indexes(merged.db)["sql"] == []
+    indexes = "SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL ORDER BY 1"
+    assert list(merged.db.query(indexes)) == list(single.db.query(indexes))
+
+    assert len(merged) == len(single)
+    for warc_record_id in single:
+        assert merged.payload(warc_record_id) == single.payload(warc_record_id)
+    assert list(merged.cdxj()) == list(single.cdxj())
+    assert merged.db["warc_file"].count == 3
+    result = runner.invoke(
+        warcdb_cli, ["import", merged_db, *(str(tests_dir / w) for w in warcs)]
+    )
+    assert result.output.count("already imported") == 3
+
+    result = runner.invoke(warcdb_cli, ["merge", inputs[0], inputs[1], inputs[0]])
+    assert result.exit_code != 0
+
+    # Into a deduplicated database
+    dedup_db = str(tmp_path / "dedup.db")
+    runner.invoke(warcdb_cli, ["import", dedup_db, "--dedup"])
+    assert runner.invoke(warcdb_cli, ["merge", dedup_db, *inputs]).exit_code == 0
+    dedup = WarcDB(dedup_db)
+    for warc_record_id in single:
+        assert dedup.payload(warc_record_id) == single.payload(warc_record_id)
+    # Stored once per digest (a large request body included)
+    referenced = " UNION ".join(
+        f"SELECT payload_digest FROM [{table.name}]"
+        for table in dedup.db.tables
+        if "payload_digest" in table.columns_dict
+    )
+    assert dedup.db["payloads"].count == len(
+        dedup.db.execute(f"{referenced} EXCEPT SELECT NULL").fetchall()
+    )
+
+
+def test_merge_old_schema(tmp_path):
+    # A database of WarcDB v0.2.2, before record locations, the records index and derived columns
+    old_db = str(tmp_path / "old.db")
+    old = sqlite_utils.Database(old_db)
+    migration.apply(old, stop_before="m004_payload_blob")
+    warc = str(tests_dir / "google.warc")
+    records = list(ArchiveIterator(open(warc, "rb")))
+    for r in records:
+        row = {k.lower().replace("-", "_"): v for k, v in r.rec_headers.headers}
+        row["payload"] = r.content_stream().read()
+        if r.http_headers:
+            row["http_headers"] = json.dumps(
+                [{"header": h, "value": v} for h, v in r.http_headers.headers]
+            )
+        if r.rec_type == "response":
+            row["http_status"] = r.http_headers.get_statuscode()
+        old[r.rec_type].insert(row, pk="warc_record_id", alter=True)
+    schema = old.schema
+    old.close()
+
+    merged_db = str(tmp_path / "merged.db")
+    result = CliRunner().invoke(warcdb_cli, ["merge", merged_db, old_db])
+    assert result.exit_code == 0, result.output
+    assert f"{old_db}: {len(records)} records added" in result.output
+    # The input is left as it is
+    assert sqlite_utils.Database(old_db).schema == schema
+
+    merged = WarcDB(merged_db)
+    assert len(merged) == len(records)
+    for r in records:
+        assert merged[r.rec_headers["WARC-Record-ID"]].rec_type == r.rec_type
+    assert list(merged.db.query("""
+        SELECT surt, host, date_epoch FROM response WHERE surt IS NULL OR host IS NULL OR date_epoch IS NULL
+        """)) == []
+    imported_db = str(tmp_path / "imported.db")
+    CliRunner().invoke(warcdb_cli, ["import", imported_db, warc])
+    imported = WarcDB(imported_db)
+    # (Without their location, which the old schema didn't keep)
+    assert [line.split(" {")[0] for line in merged.cdxj()] == [
+        line.split(" {")[0] for line in imported.cdxj()
+    ]
+    assert merged.closest("https://www.google.com/")
+    assert [
+        r.rec_headers["WARC-Record-ID"]
+        for r in merged.closest("https://www.google.com/")
+    ] == [
+        r.rec_headers["WARC-Record-ID"]
+        for r in imported.closest("https://www.google.com/")
+    ]
+
+
+def test_compact(tmp_path):
+    db_path = str(tmp_path / "archive.db")
+    runner = CliRunner()
+    runner.invoke(
+        warcdb_cli,
+        ["import", db_path, str(tests_dir / "frontpages.warc.gz"), "--fts"],
+    )
+    rows = "SELECT * FROM response ORDER BY warc_record_id"
+    expected = list(sqlite_utils.Database(db_path).query(rows))
+
+    output = str(tmp_path / "compact.db")
+    result = runner.invoke(
+        warcdb_cli, ["compact", db_path, output, "--page-size", "16384"]
+    )
+    assert result.exit_code == 0
+    db = WarcDB(output)
+    assert list(db.db.query(rows)) == expected
+    assert db.db.execute("PRAGMA page_size").fetchone()[0] == 16384
+    assert db.db["sqlite_stat1"].exists()
+    assert list(db.search("news"))
+    # Captures are in SURT order
+    surts = [
+        row[0] for row in db.db.execute("SELECT surt FROM response ORDER BY rowid")
+    ]
+    assert surts == sorted(surts)
+    # The database itself is left as it was
+    assert not sqlite_utils.Database(db_path)["sqlite_stat1"].exists()
+
+    assert runner.invoke(warcdb_cli, ["compact", db_path]).exit_code == 0
+    assert list(sqlite_utils.Database(db_path).query(rows)) == expected
+
+
+def test_compact_rebuilds_fts(tmp_path):
+    db_path = str(tmp_path / "archive.db")
+    runner = CliRunner()
+    runner.invoke(
+        warcdb_cli,
+        [
+            "import",
+            db_path,
+            str(tests_dir / "frontpages.warc.gz"),
+            str(tests_dir / "google.warc"),
+        ],
+    )
+    result = runner.invoke(
+        warcdb_cli, ["enable-fts", db_path, "response", "warc_target_uri"]
+    )
+    assert result.exit_code == 0, result.output
+    search = "SELECT warc_target_uri FROM response WHERE rowid IN (SELECT rowid FROM response_fts WHERE response_fts MATCH 'google')"
+    expected = sorted(sqlite_utils.Database(db_path).execute(search).fetchall())
+    assert expected
+
+    assert runner.invoke(warcdb_cli, ["compact", db_path]).exit_code == 0
+    db = sqlite_utils.Database(db_path)
+    # google.com captures were moved before the nytimes.com ones
+    surts = [row[0] for row in db.execute("SELECT surt FROM response ORDER BY rowid")]
+    assert surts == sorted(surts)
+    assert sorted(db.execute(search).fetchall()) == expected
+
+
+@pytest.mark.parametrize(
+    "import_args",
+    [
+        [],
+        ["--dedup", "--compression", "zlib", "--large-payload-size", 10000],
+    ],
+)
+def test_export_parquet(import_args, tmp_path):
+    ds = pytest.importorskip("pyarrow.dataset")
+    db_path, out = str(tmp_path / "archive.db"), str(tmp_path / "parquet")
+    warc = str(tests_dir / "frontpages.warc.gz")
+    runner = CliRunner()
+    runner.invoke(warcdb_cli, ["import", db_path, warc, *import_args])
+    result = runner.invoke(
+        warcdb_cli,
+        ["export-parquet", db_path, out, "--partition", "day", "--batch-size", 3],
+    )
+    assert result.exit_code == 0, result.output
+
+    db = WarcDB(db_path)
+    responses = ds.dataset(
+        os.path.join(out, "response"), format="parquet", partitioning="hive"
+    ).to_table()
+    assert responses.schema.field("warc_date").type.tz == "UTC"
+    assert str(responses.schema.field("http_status").type) == "int32"
+    assert responses.num_rows == db.db["response"].count
+    for row in responses.to_pylist():
+        assert row["date"] == row["warc_date"].strftime("%Y-%m-%d")
+        assert row["payload"] == db.payload(row["warc_record_id"])
+    # Tables without records have no files
+    assert sorted(os.listdir(out)) == [
+        "metadata",
+        "request",
+        "resource",
+        "response",
+        "warcinfo",
+    ]
+
+    # Only metadata, in a single file per table
+    out = str(tmp_path / "metadata")
+    result = runner.invoke(
+        warcdb_cli,
+        ["export-parquet", db_path, out, "--no-payload", "--partition", "none"],
+    )
+    assert result.exit_code == 0, result.output
+    responses = ds.dataset(os.path.join(out, "response", "part-0.parquet")).to_table()
+    assert "payload" not in responses.column_names
+    assert responses.num_rows == db.db["response"].count
+
+    result = runner.invoke(warcdb_cli, ["export-parquet", db_path, out])
+    assert result.exit_code == 1
+    assert "isn't empty" in result.output
+
+    # Tables are read in date order from an index, rather than sorted
+    for table in ["warcinfo", "request", "response", "metadata", "resource"]:
+        sql, _ = _table_query(db.db, table, True, "%Y-%m")
+        assert sql.endswith("ORDER BY r.date_epoch")
+        plan = db.db.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall()
+        assert not any("TEMP B-TREE" in row[-1] for row in plan)
+
+    # Without the index (e.g. in databases not migrated yet), rows are read unsorted
+    db.db.execute("DROP INDEX idx_request_date_epoch")
+    # On a new connection, as query plans are cached with their statement
+    sql, _ = _table_query(sqlite_utils.Database(db_path), "request", True, "%Y-%m")
+    assert "ORDER BY" not in sql
+
+
+def test_import_stats(tmp_path):
+    db_path = str(tmp_path / "archive.db")
+    report_path, profile_path = str(tmp_path / "stats.json"), str(tmp_path / "prof")
+    warc = str(tests_dir / "frontpages.warc.gz")
+    runner = CliRunner()
+    args = ["import", db_path, warc, "--stats", report_path, "--fts"]
+    result = runner.invoke(warcdb_cli, [*args, "--cprofile", profile_path])
+    assert result.exit_code == 0, result.output
+
+    db = sqlite_utils.Database(db_path)
+    with open(report_path) as f:
+        report = json.load(f)
+    assert report["sources"] == 1
+    assert report["records"] == db["_warcdb_records"].count
+    assert report["rec_types"]["response"]["records"] == db["response"].count
+    assert report["rec_types"]["response"]["payload_bytes"] == sum(
+        len(row["payload"]) for row in db.query("SELECT payload FROM response")
+    )
+    assert report["input_bytes"] == os.path.getsize(warc)
+    assert report["duplicates_ignored"] == 0
+    assert report["peak_rss_mb"] > 0
+    assert {"read", "parse", "normalize", "text", "insert"} <= set(report["stages"])
+    assert sum(s["seconds"] for s in report["stages"].values()) <= report["seconds"]
+    assert pstats.Stats(profile_path).total_calls > 0
+
+    # Records imported again are ignored, and counted as duplicates
+    result = runner.invoke(
+        warcdb_cli, [*args, "--force", "--stats-interval", "0.001", "--batch-size", 1]
+    )
+    assert result.exit_code == 0, result.output
+    with open(report_path) as f:
+        snapshots = [json.loads(line) for line in f]
+    report = snapshots[-1]
+    assert len(snapshots) > 1
+    assert report["duplicates_ignored"] == report["records"]
+
+    result = runner.invoke(warcdb_cli, args)
+    with open(report_path) as f:
+        assert json.load(f)["sources_skipped"] == 1
+
+    imports = list(db.query("SELECT * FROM _warcdb_imports ORDER BY id"))
+    assert [i["records"] for i in imports] == [report["records"], report["records"], 0]
+    assert [i["duplicates_ignored"] for i in imports] == [0, report["records"], 0]
+    assert json.loads(imports[1]["stats"])["records"] == report["records"]
+
+    result = runner.invoke(warcdb_cli, ["import", db_path, warc, "--stats-interval", 1])
+    assert result.exit_code == 2
+
+
+def test_import_skips_imported_sources():
+    runner = CliRunner()
+    warc = str(tests_dir / "google.warc")
+    runner.invoke(warcdb_cli, ["import", db_file, warc])
+
+    result = runner.invoke(warcdb_cli, ["import", db_file, warc])
+    assert result.exit_code == 0
+    assert "already imported" in result.output
+
+    db = sqlite_utils.Database(db_file)
+    assert db["_warcdb_ingest_log"].get(warc)["completed"] == 1
+
+    os.remove(db_file)
+
+
+def test_import_resumes_from_checkpoint():
+    runner = CliRunner()
+    warc = str(tests_dir / "frontpages.warc.gz")
+    runner.invoke(warcdb_cli, ["import", db_file, warc])
+    db = sqlite_utils.Database(db_file)
+    expected = {t: db[t].count for t in ["request", "response", "metadata"]}
+    log = db["_warcdb_ingest_log"].get(warc)
+
+    # Pretend the import died after the first response had been committed
+    first_response = next(db["response"].rows)
+    offsets = []
+    for offset, _, r in iter_source((warc, None)):
+        offsets.append(offset)
+        if r.rec_headers["WARC-Record-ID"] == first_response["warc_record_id"]:
+            break
+    db["response"].delete_where(
+        "warc_record_id != ?", [first_response["warc_record_id"]]
+    )
+    db["metadata"].delete_where()
+    db["_warcdb_ingest_log"].update(
+        warc, {"offset": offsets[-1], "records": len(offsets), "completed": 0}
+    )
+
+    result = runner.invoke(warcdb_cli, ["import", db_file, warc])
+    assert result.exit_code == 0
+    assert {t: db[t].count for t in expected} == expected
+    resumed = db["_warcdb_ingest_log"].get(warc)
+    assert (resumed["records"], resumed["completed"]) == (log["records"], 1)
+
+    os.remove(db_file)
+
+
+def test_import_http_resumes_dropped_connections(flaky_http_server):
+    warcs = ["google.warc", "frontpages.warc.gz"]
+    runner = CliRunner()
+
+    runner.invoke(warcdb_cli, ["import", db_file, *[str(tests_dir / w) for w in warcs]])
+    db = sqlite_utils.Database(db_file)
+    expected = {t: db[t].count for t in ["request", "response", "metadata"]}
+    os.remove(db_file)
+
+    urls = [f"{flaky_http_server}/{w}" for w in warcs]
+    result = runner.invoke(warcdb_cli, ["import", db_file, *urls, "--prefetch", 1])
+    assert result.exit_code == 0, result.output
+    db = sqlite_utils.Database(db_file)
+    assert {t: db[t].count for t in expected} == expected
+    # every file was resumed from where its connection dropped
+    assert {path for path, start in FlakyRangeRequestHandler.ranges} == {
+        f"/{w}" for w in warcs
+    }
+
+    os.remove(db_file)
+
+
+def test_import_remote_wacz(flaky_http_server):
+    wacz = tests_dir / "scoop.wacz"
+    runner = CliRunner()
+
+    runner.invoke(warcdb_cli, ["import", db_file, str(wacz)])
+    db = sqlite_utils.Database(db_file)
+    expected = {t: db[t].count for t in ["request", "response", "resource"]}
+    os.remove(db_file)
+
+    url = f"{flaky_http_server}/scoop.wacz"
+    result = runner.invoke(warcdb_cli, ["import", db_file, url])
+    assert result.exit_code == 0, result.output
+    db = sqlite_utils.Database(db_file)
+    assert {t: db[t].count for t in expected} == expected
+    os.remove(db_file)
+
+    # Only the selected members are downloaded
+    FlakyRangeRequestHandler.served.clear()
+    result = runner.invoke(
+        warcdb_cli, ["import", db_file, url, "--wacz-member", "nothing/*"]
+    )
+    assert result.exit_code == 0, result.output
+    assert sum(FlakyRangeRequestHandler.served) < wacz.stat().st_size / 10
+
+    os.remove(db_file)
+
+
+@pytest.mark.parametrize(
+    "filters",
+    [
+        ["--url-prefix", "https://github.com/Florents-Tselai/WarcDB/"],
+        ["--mime", "text/html", "--status", "200"],
+        ["--mime", "image/", "--from", "2023-10-20T12:22:48", "--to", "2023-10-20"],
+    ],
+)
+def test_import_filters_wacz_with_index(filters):
+    wacz = str(tests_dir / "scoop.wacz")
+    result = CliRunner().invoke(warcdb_cli, ["import", db_file, wacz, *filters])
+    assert result.exit_code == 0, result.output
+
+    # the index must select the same records as filtering while streaming
+    args = iter(filters)
+    options = dict(zip(args, args))
+    record_filter = RecordFilter.create(
+        [options["--url-prefix"]] if "--url-prefix" in options else (),
+        [options["--mime"]] if "--mime" in options else (),
+        [options["--status"]] if "--status" in options else (),
+        options.get("--from"),
+        options.get("--to"),
+    )
+    # (file:// captures have no HTTP headers for warcio to parse, unlike indexers)
+    expected = {
+        r.rec_headers["WARC-Record-ID"]
+        for r in ArchiveIterator(zipfile.ZipFile(wacz).open("archive/data.warc.gz"))
+        if record_filter.matches_record(r)
+        and r.rec_headers["WARC-Target-URI"].startswith("http")
+    }
+    assert expected
+
+    db = sqlite_utils.Database(db_file)
+    imported = {row[0] for row in db.execute("""
+            SELECT warc_record_id, warc_target_uri FROM response
+            UNION SELECT warc_record_id, warc_target_uri FROM resource
+            """) if row[1].startswith("http")}
+    assert imported == expected
+    assert db["request"].count == 0
+
+    os.remove(db_file)
+
+
+@pytest.mark.parametrize("source", ["scoop.wacz", "google.warc"])
+def test_import_filters_keep_warcinfo(source):
+    result = CliRunner().invoke(
+        warcdb_cli, ["import", db_file, str(tests_dir / source), "--status", 200]
+    )
+    assert result.exit_code == 0, result.output
+    db = sqlite_utils.Database(db_file)
+    assert db["warcinfo"].count == 1
+    assert db["response"].count
+    orphans = db.execute("""
+        SELECT COUNT(*) FROM response
+        WHERE warc_warcinfo_id NOT IN (SELECT warc_record_id FROM warcinfo)
+        """).fetchone()[0]
+    assert orphans == 0
+    os.remove(db_file)
+
+
+@pytest.mark.parametrize("option", ["--from", "--to"])
+@pytest.mark.parametrize("date", ["yesterday", "2023-13-01", "20231020T"])
+def test_import_filters_invalid_dates(option, date):
+    warc = str(tests_dir / "google.warc")
+    result = CliRunner().invoke(warcdb_cli, ["import", db_file, warc, option, date])
+    assert result.exit_code == 2
+    assert f"Invalid value for '{option}': Invalid date <{date}>" in result.output
+    assert not os.path.exists(db_file)
+
+
+def test_import_filters_warc():
+    warc = str(tests_dir / "google.warc")
+    result = CliRunner().invoke(warcdb_cli, ["import", db_file, warc, "--status", 200])
+    assert result.exit_code == 0
+    db = sqlite_utils.Database(db_file)
+    assert [r["http_status"] for r in db["response"].rows] == [200]
+
+    # a different filter imports the file again
+    result = CliRunner().invoke(warcdb_cli, ["import", db_file, warc])
+    assert "already imported" not in result.output
+    assert db["response"].count == 3
+
+    os.remove(db_file)
@@ -1,19 +1,90 @@
+import cProfile
 import datetime
-import zipfile
+import multiprocessing
+import os
+import sqlite3
+from collections import defaultdict
 from collections.abc import MutableMapping
-from functools import cache
+from concurrent.futures import ProcessPoolExecutor
 from itertools import chain
 from json import dumps
+from queue import Empty
 
 import click
-import requests as req
 import sqlite_utils
-from more_itertools import always_iterable
 from tqdm import tqdm
-from warcio import ArchiveIterator, StatusAndHeaders
+from warcio import StatusAndHeaders
 from warcio.recordloader import ArcWarcRecord
 
+from warcdb.blobs import (
+    LARGE_PAYLOAD_MODES,
+    LARGE_PAYLOAD_SIZE,
+    LargePayload,
+    LargePayloads,
+    read_payload,
+    write_large_payload,
+)
+from warcdb.cdx import cdxj_lines, closest_captures
+from warcdb.codecs import (
+    CODECS,
+    encode_payload,
+    get_codec,
+    register_payload_function,
+    set_payload_codec,
+)
+from warcdb.dedup import (
+    DEDUP_TABLES,
+    PAYLOADS_TABLE,
+    create_payloads_table,
+    dedup_enabled,
+    enable_dedup,
+    payload_digest,
+    storage_table,
+)
+from warcdb.derived import derived_columns
+from warcdb.export import EXPORT_TABLES, export_warc
+from warcdb.parquet import (
+    PARQUET_BATCH_SIZE,
+    PARQUET_COMPRESSIONS,
+    PARTITIONS,
+    export_parquet,
+)
+from warcdb.headers import (
+    HEADER_TABLES,
+    backfill_header_tables,
+    header_rows,
+    header_tables_enabled,
+)
 from warcdb.migrations import migration
+from warcdb.records import LazyRecord
+from warcdb.pipeline import QUEUE_SIZE, READ_AHEAD, Pipeline, StageStats
+from warcdb.profiles import (
+    PROFILES,
+    apply_profile,
+    defer_indexes,
+    rebuild_indexes,
+    record_profile,
+)
+from warcdb.remote import HTTPClient, PrefetchingStream
+from warcdb.settings import get_setting
+from warcdb.stats import ImportStats, StatsReporter, record_import
+from warcdb.text import (
+    TEXT_TABLE,
+    enable_text_search,
+    text_rows,
+    text_search_enabled,
+)
+from warcdb.sources import (
+    RecordFilter,
+    check_date,
+    expand_sources,
+    iter_source,
+    load_record,
+    remote_sources,
+    source_fingerprint,
+    source_key,
+    source_name,
+)
 
 
 def dict_union(*args):
@@ -34,9 +105,14 @@ setattr(StatusAndHeaders, "to_json", headers_to_json)
 """ Monkeypatch warcio.ArcWarcRecord.payload """
 
 
-@cache  # It's important that we cache this, as the content_stream() can only be consumed once.
 def record_payload(self: ArcWarcRecord):
-    return self.content_stream().read()
+    # The content_stream() can only be consumed once, so the payload is memoized.
+    # It lives on the record itself, so it's freed together with the record.
+    try:
+        return self._warcdb_payload
+    except AttributeError:
+        self._warcdb_payload = self.content_stream().read()
+        return self._warcdb_payload
 
 
 setattr(ArcWarcRecord, "payload", record_payload)
@@ -44,10 +120,15 @@ setattr(ArcWarcRecord, "payload", record_payload)
 """ Monkeypatch warcio.ArcWarcRecord.as_dict() """
 
 
-@cache
 def record_as_dict(self: ArcWarcRecord):
     """Method to easily represent a record as a dict, to be fed into db_utils.Database.insert()"""
-    return {k.lower().replace("-", "_"): v for k, v in self.rec_headers.headers}
+    try:
+        return self._warcdb_dict
+    except AttributeError:
+        self._warcdb_dict = {
+            k.lower().replace("-", "_"): v for k, v in self.rec_headers.headers
+        }
+        return self._warcdb_dict
 
 
 setattr(ArcWarcRecord, "as_dict", record_as_dict)
@@ -62,6 +143,39 @@ setattr(ArcWarcRecord, "as_dict", record_as_dict)
 # setattr(ArcWarcRecord, 'to_json', record_to_json)
 
 
+col_type_conversions = {
+    "content_length": int,
+    "payload": bytes,
+    "warc_date": datetime.datetime,
+}
+
+INGEST_LOG_TABLE = "_warcdb_ingest_log"
+FILES_TABLE = "warc_file"
+# Maps every warc_record_id to its rec_type table
+RECORDS_TABLE = "_warcdb_records"
+
+"""Supported rec_types, mapped to the foreign keys of their table"""
+RECORD_TABLES = {
+    "warcinfo": [],
+    "request": [("warc_warcinfo_id", "warcinfo", "warc_record_id")],
+    "response": [
+        ("warc_warcinfo_id", "warcinfo", "warc_record_id"),
+        ("warc_concurrent_to", "request", "warc_record_id"),
+    ],
+    "metadata": [
+        ("warc_warcinfo_id", "warcinfo", "warc_record_id"),
+        ("warc_concurrent_to", "response", "warc_record_id"),
+    ],
+    "resource": [
+        ("warc_warcinfo_id", "warcinfo", "warc_record_id"),
+        ("warc_concurrent_to", "metadata", "warc_record_id"),
+    ],
+    "revisit": [("warc_warcinfo_id", "warcinfo", "warc_record_id")],
+    "conversion": [("warc_warcinfo_id", "warcinfo", "warc_record_id")],
+    "continuation": [("warc_warcinfo_id", "warcinfo", "warc_record_id")],
+}
+
+
 class WarcDB(MutableMapping):
     """
     Wrapper around sqlite_utils.Database
@@ -79,10 +193,35 @@ class WarcDB(MutableMapping):
     def __init__(self, *args, **kwargs):
         # First pop warcdb - specific params
         self._batch_size = kwargs.pop("batch_size", 1000)
-        self._records_table = kwargs.get("records_table", "records")
+        self._records_table = kwargs.pop("records_table", RECORDS_TABLE)
+        profile = kwargs.pop("profile", None)
+
+        # Records waiting to be flushed, grouped by table
+        self._pending = defaultdict(list)
+        self._pending_count = 0
+        # Ingest log entries, written with the records they cover
+        self._checkpoints = {}
+        self._buffering = False
+        # What imports spend their time on (see warcdb.stats)
+        self.stats = ImportStats()
 
         # Pass the rest to sqlite_utils
         self._db = sqlite_utils.Database(*args, **kwargs)
+        register_payload_function(self.db.conn)
+        # The pragmas the profile resulted in (see warcdb.profiles)
+        self.pragmas = apply_profile(self.db, profile) if profile else {}
+        self._load_storage_settings()
+
+    def _load_storage_settings(self):
+        self._codec = get_codec(get_setting(self.db, "payload_codec"))
+        self._dedup = dedup_enabled(self.db)
+        self._header_tables = header_tables_enabled(self.db)
+        self._text_search = text_search_enabled(self.db)
+        self._storage_tables = {
+            rec_type: storage_table(self.db, rec_type) for rec_type in RECORD_TABLES
+        }
+        # Columns of the tables written to, so flush() only alters them for new columns
+        self._known_columns = {}
 
     @property
     def db(self) -> sqlite_utils.Database:
@@ -94,7 +233,7 @@ class WarcDB(MutableMapping):
 
     @property
     def records(self):
-        """Returns the db table the records are stored"""
+        """Returns the db table mapping each warc_record_id to its rec_type"""
         return self.table(self._records_table)
 
     @property
@@ -111,174 +250,1352 @@ class WarcDB(MutableMapping):
         """This is the only client-facing way to mutate the file.
         Any normalization should happen here.
         """
-        # Any normalizations happens here
-        raise NotImplemented
+        record_id = value.rec_headers.get_header("WARC-Record-ID")
+        if key != record_id:
+            raise ValueError(
+                f"{key} doesn't match the record's WARC-Record-ID {record_id}"
+            )
+        self.add_row(*record_to_row(value))
 
     def __getitem__(self, item) -> ArcWarcRecord:
-        # Any denormalization happens here
-        raise NotImplemented
+        rec_type = self.rec_type(item)
+        # Everything but the payload, which is only loaded if it's accessed
+        columns = [c for c in self.table(rec_type).columns_dict if c != "payload"]
+        row = next(
+            self.db.query(
+                f"SELECT {', '.join(f'[{c}]' for c in columns)} FROM [{rec_type}] WHERE warc_record_id = ?",
+                [item],
+            )
+        )
+        return LazyRecord(rec_type, row, lambda: self.payload(item))
 
     def __delitem__(self, key):
-        raise NotImplemented
+        """
+        Delete a record, together with its header table rows, its text (and its full-text search entry),
+        and its payload if it's stored by digest and no other record references it.
+        """
+        rec_type = self.rec_type(key)
+        table = self.table(self._storage_tables[rec_type])
+        header_table = HEADER_TABLES.get(rec_type)
+        # Tables whose records reference the payloads table (see warcdb.dedup and warcdb.blobs)
+        references = [
+            name
+            for name in dict.fromkeys(self._storage_tables.values())
+            if self.table(name).exists()
+            and "payload_digest" in self.table(name).columns_dict
+        ]
+        with self.db.conn:
+            digest = None
+            if table.name in references:
+                (digest,) = self.db.execute(
+                    f"SELECT payload_digest FROM [{table.name}] WHERE warc_record_id = ?",
+                    [key],
+                ).fetchone()
+            self.db.execute(
+                f"DELETE FROM [{table.name}] WHERE warc_record_id = ?", [key]
+            )
+            self.db.execute(
+                f"DELETE FROM [{self._records_table}] WHERE warc_record_id = ?", [key]
+            )
+            if header_table and self.table(header_table).exists():
+                self.db.execute(
+                    f"DELETE FROM [{header_table}] WHERE warc_record_id = ?", [key]
+                )
+            # Its full-text search entry is deleted by a trigger
+            if rec_type == "response" and self.table(TEXT_TABLE).exists():
+                self.db.execute(
+                    f"DELETE FROM [{TEXT_TABLE}] WHERE warc_record_id = ?", [key]
+                )
+            if digest is not None:
+                unreferenced = " AND ".join(
+                    f"NOT EXISTS (SELECT 1 FROM [{name}] WHERE payload_digest = :digest)"
+                    for name in references
+                )
+                self.db.execute(
+                    f"DELETE FROM [{PAYLOADS_TABLE}] WHERE digest = :digest AND {unreferenced}",
+                    {"digest": digest},
+                )
 
     def __iter__(self):
-        raise NotImplemented
+        self.flush()
+        if not self.records.exists():
+            return
+        # The cursor is iterated as rows are fetched, the ids are never all loaded
+        for (record_id,) in self.db.execute(
+            f"SELECT warc_record_id FROM [{self._records_table}]"
+        ):
+            yield record_id
 
     def __len__(self):
-        return self.records.count
+        self.flush()
+        return self.records.count if self.records.exists() else 0
+
+    def __contains__(self, item):
+        try:
+            self.rec_type(item)
+            return True
+        except KeyError:
+            return False
+
+    def rec_type(self, warc_record_id: str) -> str:
+        """The rec_type (and table) of a record, looked up by its id"""
+        # Records still buffered are looked up too
+        self.flush()
+        row = None
+        if self.records.exists():
+            row = self.db.execute(
+                f"SELECT rec_type FROM [{self._records_table}] WHERE warc_record_id = ?",
+                [warc_record_id],
+            ).fetchone()
+        if row is None:
+            raise KeyError(warc_record_id)
+        return row[0]
 
     """ API Methods """
 
-    def __iadd__(self, r: ArcWarcRecord):
+    def __enter__(self):
+        self._buffering = True
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Whatever has been parsed so far is valid, so flush it even on error
+        self.close()
+
+    def close(self):
+        """Flush any pending records and close the underlying connection"""
+        self.flush()
+        self._buffering = False
+        self.db.close()
+
+    def flush(self):
         """
-        TODO
-        ====
+        Write all pending records in a single transaction.
 
-        * For all rec_types: also store WARC/1.0 field (warc and version?)
-        * Todo pass conversions: {'Content-Length': int, warc-date: datet
-        * All 'response', 'resource', 'request', 'revisit', 'conversion' and 'continuation' records may have a payload.
-        All 'warcinfo' and 'metadata' records shall not have a payload.
+        Rows are grouped per rec_type table, so each table receives one
+        executemany() call per flush, instead of one INSERT + commit per record.
         """
-        col_type_conversions = {
-            "content_length": int,
-            "payload": str,
-            "warc_date": datetime.datetime,
-        }
-        record_dict = r.as_dict()
-
-        # Certain rec_types have payload
-        has_payload = r.rec_type in [
-            "warcinfo",
-            "request",
-            "response",
-            "metadata",
-            "resource",
-        ]
-        if has_payload:
-            record_dict["payload"] = r.payload()
-
-        # Certain rec_types have http_headers
-        has_http_headers = r.http_headers is not None
-        if has_http_headers:
-            record_dict["http_headers"] = r.http_headers.to_json()
-
-        """Depending on the record type we insert to appropriate record"""
-        if r.rec_type == "warcinfo":
-            self.db.table("warcinfo").insert(
-                record_dict,
-                pk="warc_record_id",
-                alter=True,
-                ignore=True,
-                columns=col_type_conversions,
-            )
-        elif r.rec_type == "request":
-            self.db.table("request").insert(
-                record_dict,
-                pk="warc_record_id",
-                foreign_keys=[("warc_warcinfo_id", "warcinfo", "warc-record-id")],
-                alter=True,
-                ignore=True,
-                columns=col_type_conversions,
+        if not self._pending_count and not self._checkpoints:
+            return
+
+        pending, self._pending = self._pending, defaultdict(list)
+        self._pending_count = 0
+        checkpoints, self._checkpoints = self._checkpoints, {}
+
+        # Text is extracted before payloads are moved out (dedup) or compressed
+        texts = []
+        if self._text_search:
+            with self.stats.timer("text"):
+                texts = list(text_rows(pending.get("response", [])))
+
+        if self._dedup:
+            pending[PAYLOADS_TABLE] = self._split_payloads(pending)
+
+        # Large payloads are stored by digest in the payloads table, and written once
+        # their row is inserted (see warcdb.blobs)
+        large = {}
+        for rec_type, rows in pending.items():
+            for row in rows:
+                payload = row.get("payload")
+                if not isinstance(payload, LargePayload):
+                    continue
+                del row["payload"]
+                if rec_type == PAYLOADS_TABLE:
+                    digest = row["digest"]
+                else:
+                    digest = row.get("warc_payload_digest") or payload.digest
+                    row["payload_digest"] = digest
+                if digest in large:
+                    payload.discard()
+                else:
+                    large[digest] = payload
+        if large:
+            create_payloads_table(self.db)
+
+        if self._codec.name != "none":
+            with self.stats.timer("compress"):
+                for row in chain.from_iterable(pending.values()):
+                    if "payload" in row:
+                        row["payload"] = encode_payload(self._codec, row["payload"])
+
+        # Schema changes (new tables or columns) happen outside the transaction
+        statements = []
+        for rec_type, rows in pending.items():
+            if not rows:
+                continue
+            table_name = self._storage_tables.get(rec_type, rec_type)
+            table = self.table(table_name)
+            if not table.exists():
+                with self.stats.timer("schema"):
+                    table.insert_all(
+                        rows,
+                        pk="warc_record_id",
+                        foreign_keys=RECORD_TABLES[rec_type],
+                        alter=True,
+                        ignore=True,
+                        columns=col_type_conversions,
+                    )
+                continue
+            columns = list(dict.fromkeys(chain.from_iterable(rows)))
+            known = self._known_columns.get(table_name, set())
+            if not known.issuperset(columns):
+                with self.stats.timer("schema"):
+                    table.add_missing_columns(rows)
+                self._known_columns[table_name] = set(table.columns_dict)
+
+            column_names = ", ".join(f"[{c}]" for c in columns)
+            placeholders = ", ".join("?" for _ in columns)
+            sql = f"INSERT OR IGNORE INTO [{table_name}] ({column_names}) VALUES ({placeholders})"
+            statements.append((sql, [[row.get(c) for c in columns] for row in rows]))
+
+        if self._header_tables:
+            for rec_type, header_table in HEADER_TABLES.items():
+                headers = list(
+                    chain.from_iterable(map(header_rows, pending.get(rec_type, [])))
+                )
+                if headers:
+                    statements.append(
+                        (
+                            f"INSERT OR IGNORE INTO [{header_table}] (warc_record_id, position, name, value) VALUES (?, ?, ?, ?)",
+                            headers,
+                        )
+                    )
+
+        if texts:
+            statements.append(
+                (
+                    f"INSERT OR IGNORE INTO [{TEXT_TABLE}] (warc_record_id, title, text) VALUES (?, ?, ?)",
+                    texts,
+                )
             )
 
-        elif r.rec_type == "response":
-            if r.http_headers:
-                record_dict["http_status"] = r.http_headers.get_statuscode()
-            self.db.table("response").insert(
-                record_dict,
-                pk="warc_record_id",
-                foreign_keys=[
-                    ("warc_warcinfo_id", "warcinfo", "warc_record_id"),
-                    ("warc_concurrent_to", "request", "warc_record_id"),
-                ],
-                alter=True,
-                ignore=True,
-                columns=col_type_conversions,
+        # The id -> rec_type lookup of WarcDB[id]
+        ids = [
+            (row["warc_record_id"], rec_type)
+            for rec_type in RECORD_TABLES
+            for row in pending.get(rec_type, [])
+        ]
+        if ids:
+            if not self.records.exists():
+                self.records.create(
+                    {"warc_record_id": str, "rec_type": str}, pk="warc_record_id"
+                )
+            statements.append(
+                (
+                    f"INSERT OR IGNORE INTO [{self._records_table}] (warc_record_id, rec_type) VALUES (?, ?)",
+                    ids,
+                )
             )
 
-        elif r.rec_type == "metadata":
-            self.db.table("metadata").insert(
-                record_dict,
-                pk="warc_record_id",
-                foreign_keys=[
-                    ("warc-warcinfo-id", "warcinfo", "warc_record_id"),
-                    ("warc_concurrent_to", "response", "warc_record_id"),
-                ],
-                alter=True,
-                ignore=True,
-                columns=col_type_conversions,
+        # Checkpoints are committed together with the records they cover
+        if checkpoints:
+            columns = list(next(iter(checkpoints.values())))
+            column_names = ", ".join(f"[{c}]" for c in columns)
+            placeholders = ", ".join("?" for _ in columns)
+            sql = f"INSERT OR REPLACE INTO [{INGEST_LOG_TABLE}] ({column_names}) VALUES ({placeholders})"
+            statements.append(
+                (sql, [[row[c] for c in columns] for row in checkpoints.values()])
             )
 
-        elif r.rec_type == "resource":
-            self.db.table("resource").insert(
-                record_dict,
-                pk="warc_record_id",
-                foreign_keys=[
-                    ("warc-warcinfo-id", "warcinfo", "warc_record_id"),
-                    ("warc_concurrent_to", "metadata", "warc_record_id"),
-                ],
-                alter=True,
-                ignore=True,
-                columns=col_type_conversions,
+        if large:
+            statements.append(
+                (
+                    f"INSERT OR IGNORE INTO [{PAYLOADS_TABLE}] (digest) VALUES (?)",
+                    [(digest,) for digest in large],
+                )
             )
 
-        else:
-            raise ValueError(
-                f"Record type <{r.rec_type}> is not supported"
-                f"Only [warcinfo, request, response, metadata, resource] are."
+        try:
+            with self.stats.timer("insert"), self.db.conn:
+                for sql, params in statements:
+                    cursor = self.db.conn.executemany(sql, params)
+                    # Records already in the database are ignored
+                    if params is ids:
+                        self.stats.add_duplicates(len(ids) - cursor.rowcount)
+                for digest, payload in large.items():
+                    write_large_payload(
+                        self.db.conn,
+                        PAYLOADS_TABLE,
+                        "digest",
+                        digest,
+                        payload,
+                        self._codec,
+                    )
+        finally:
+            for payload in large.values():
+                payload.discard()
+
+    def checkpoint(self, source: str, **state):
+        """Record the import progress of a source in the ingest log, with the next flush"""
+        self._checkpoints[source] = {
+            "source": source,
+            **state,
+            "updated_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+        }
+
+    def ingest_state(self, source: str):
+        """The ingest log entry of a source, or None if it has never been imported"""
+        table = self.table(INGEST_LOG_TABLE)
+        if not table.exists():
+            return None
+        try:
+            return table.get(source)
+        except sqlite_utils.db.NotFoundError:
+            return None
+
+    def file_id(self, source) -> int:
+        """Id of a source in the warc_file table, which records where records were read from"""
+        path, wacz_member = source
+        if not path.startswith("http"):
+            # Payloads are loaded back from it later, possibly from another directory
+            path = os.path.abspath(path)
+        return self.table(FILES_TABLE).lookup(
+            {"source": source_key((path, wacz_member))},
+            {"path": path, "wacz_member": wacz_member},
+        )
+
+    def payload(self, warc_record_id: str, http: HTTPClient = None):
+        """
+        The (decompressed) payload of a record.
+        Records imported with --no-payload have theirs read back from their WARC file.
+        """
+        rec_type = self.rec_type(warc_record_id)
+        if rec_type == "revisit":
+            return self.revisited_payload(warc_record_id, http)
+        row = next(
+            self.db.query(
+                f"SELECT * FROM [{rec_type}] WHERE warc_record_id = ?",
+                [warc_record_id],
             )
+        )
+        if row["payload"] is None and row.get("payload_digest"):
+            # A large payload, stored by digest (see warcdb.blobs)
+            row["payload"] = self.db.execute(
+                f"SELECT payload FROM [{PAYLOADS_TABLE}] WHERE digest = ?",
+                [row["payload_digest"]],
+            ).fetchone()[0]
+        if row["payload"] is not None:
+            return self.decode_payload(row["payload"])
+        if row["warc_file_id"] is None:
+            return None
+        f = self.table(FILES_TABLE).get(row["warc_file_id"])
+        return load_record(
+            f["path"], f["wacz_member"], row["warc_offset"], row["warc_length"], http
+        ).payload()
+
+    def revisited_payload(self, warc_record_id: str, http: HTTPClient = None):
+        """
+        The payload of the record a revisit record refers to:
+        its WARC-Refers-To record if it's in the database,
+        or else a capture with the same payload digest (preferably of the same URL).
+        Returns None if the original isn't in the database.
+        """
+        revisit = self.table("revisit").get(warc_record_id)
+        refers_to = revisit.get("warc_refers_to")
+        if refers_to in self and self.rec_type(refers_to) != "revisit":
+            return self.payload(refers_to, http)
+
+        digest = revisit.get("warc_payload_digest")
+        if not digest:
+            return None
+        url = revisit.get("warc_refers_to_target_uri") or revisit["warc_target_uri"]
+        for rec_type in DEDUP_TABLES:
+            table = self._storage_tables[rec_type]
+            if not self.table(table).exists():
+                continue
+            original = self.db.execute(
+                f"""
+                SELECT warc_record_id FROM [{table}] WHERE warc_payload_digest = ?
+                ORDER BY warc_target_uri = ? DESC LIMIT 1
+                """,
+                [digest, url],
+            ).fetchone()
+            if original:
+                return self.payload(original[0], http)
+        return None
+
+    def decode_payload(self, payload: bytes) -> bytes:
+        """Decompress a payload as stored in the database"""
+        return self._codec.decompress(payload)
+
+    def cdxj(self):
+        """Stream a CDXJ index of all captures, sorted by SURT and timestamp"""
+        self.flush()
+        return cdxj_lines(self.db, self._storage_tables)
+
+    def closest(self, url: str, timestamp=None, limit=1):
+        """
+        The captures (response, resource and revisit records) of a URL closest to a timestamp,
+        e.g. 20231020122247 or 2023-10-20; the latest ones if it's None.
+        """
+        self.flush()
+        record_ids = closest_captures(
+            self.db, self._storage_tables, url, timestamp, limit
+        )
+        return [self[record_id] for record_id in record_ids]
+
+    @staticmethod
+    def _split_payloads(pending):
+        """Replace the payloads of dedup'd rows with their digest, returning the payload rows"""
+        payloads = {}
+        for rec_type in DEDUP_TABLES:
+            for row in pending.get(rec_type, []):
+                payload = row.pop("payload", None)
+                if payload is None:
+                    continue
+                if isinstance(payload, LargePayload):
+                    digest = row.get("warc_payload_digest") or payload.digest
+                else:
+                    digest = row.get("warc_payload_digest") or payload_digest(payload)
+                row["payload_digest"] = digest
+                if digest not in payloads:
+                    payloads[digest] = {"digest": digest, "payload": payload}
+                elif isinstance(payload, LargePayload):
+                    payload.discard()
+        return list(payloads.values())
+
+    def enable_dedup(self):
+        """Switch to content-addressed payload storage (see warcdb.dedup)"""
+        self.flush()
+        enable_dedup(self.db)
+        self._load_storage_settings()
+
+    def enable_header_tables(self):
+        """Materialize HTTP headers into indexed tables (see warcdb.headers)"""
+        self.flush()
+        backfill_header_tables(self.db)
+        self._load_storage_settings()
+
+    def enable_text_search(self):
+        """Extract the text of responses into a full-text search index (see warcdb.text)"""
+        self.flush()
+        enable_text_search(self.db)
+        self._load_storage_settings()
+
+    def search(self, q: str, limit=None):
+        """
+        The warc_record_id and title of the responses matching a full-text search query, best matches first.
+        Requires enable_text_search().
+        """
+        self.flush()
+        return self.db[TEXT_TABLE].search(
+            q, columns=["warc_record_id", "title"], limit=limit
+        )
+
+    def defer_indexes(self):
+        """Drop secondary indexes until rebuild_indexes() (see warcdb.profiles)"""
+        self.flush()
+        defer_indexes(self.db)
+
+    def rebuild_indexes(self):
+        """Rebuild the indexes dropped by defer_indexes()"""
+        self.flush()
+        rebuild_indexes(self.db)
+
+    def set_payload_codec(self, name):
+        """Compress payloads with the given codec (see warcdb.codecs)"""
+        self.flush()
+        set_payload_codec(self.db, name)
+        self._load_storage_settings()
+
+    def add_row(self, rec_type: str, row: dict):
+        """Queue an already normalized row (see record_to_row()) for insertion"""
+        self.stats.count(rec_type, row)
+        self._pending[rec_type].append(row)
+        self._pending_count += 1
+
+        # Outside a `with` block every record is written straight away
+        if not self._buffering or self._pending_count >= self._batch_size:
+            self.flush()
+
+    def __iadd__(self, r: ArcWarcRecord):
+        self.add_row(*record_to_row(r))
         return self
 
 
+def record_to_row(r: ArcWarcRecord, payload=True):
+    """
+    Normalize a record into the row to be inserted in its rec_type table.
+    Returns a (rec_type, row) tuple.
+    Without payload, the payload is left out, to be loaded back lazily (see WarcDB.payload()).
+    payload can also be a LargePayloads policy (see warcdb.blobs); large payloads are then LargePayload objects.
+
+    TODO
+    ====
+
+    * For all rec_types: also store WARC/1.0 field (warc and version?)
+    * Todo pass conversions: {'Content-Length': int, warc-date: datet
+    * All 'response', 'resource', 'request', 'revisit', 'conversion' and 'continuation' records may have a payload.
+    All 'warcinfo' and 'metadata' records shall not have a payload.
+    """
+    if r.rec_type not in RECORD_TABLES:
+        raise ValueError(
+            f"Record type <{r.rec_type}> is not supported. "
+            f"Only [{', '.join(RECORD_TABLES)}] are."
+        )
+
+    record_dict = dict(r.as_dict())
+
+    # Certain rec_types have payload
+    # (a revisit's is usually empty: its body is the one of the record it revisits)
+    has_payload = r.rec_type in [
+        "warcinfo",
+        "request",
+        "response",
+        "metadata",
+        "resource",
+        "revisit",
+        "conversion",
+        "continuation",
+    ]
+    if has_payload and payload:
+        record_dict["payload"] = read_payload(r, payload)
+
+    # Certain rec_types have http_headers
+    has_http_headers = r.http_headers is not None
+    if has_http_headers:
+        record_dict["http_headers"] = r.http_headers.to_json()
+        record_dict["http_status_line"] = (
+            f"{r.http_headers.protocol} {r.http_headers.statusline}"
+        )
+
+    if r.rec_type in ("response", "revisit") and r.http_headers:
+        record_dict["http_status"] = r.http_headers.get_statuscode()
+
+    record_dict.update(derived_columns(record_dict))
+
+    return r.rec_type, record_dict
+
+
+""" Resumable imports """
+
+
+def resume_state(db: WarcDB, source, force=False, record_filter: RecordFilter = None):
+    """
+    The ingest log state to resume importing a source from,
+    or None if it has been fully imported already.
+    Sources that changed since they were imported,
+    or that were imported with a different filter, are imported from scratch.
+    """
+    size, digest = source_fingerprint(source)
+    described = (record_filter or RecordFilter()).describe()
+    state = None if force else db.ingest_state(source_key(source))
+    if state is None or (state["size"], state["digest"], state["record_filter"]) != (
+        size,
+        digest,
+        described,
+    ):
+        return {
+            "size": size,
+            "digest": digest,
+            "record_filter": described,
+            "offset": 0,
+            "records": 0,
+            "completed": 0,
+        }
+    if state["completed"]:
+        return None
+    return {
+        k: state[k]
+        for k in ("size", "digest", "record_filter", "offset", "records", "completed")
+    }
+
+
+def records_after(
+    source,
+    offset,
+    http: HTTPClient = None,
+    record_filter: RecordFilter = None,
+    payloads=True,
+    wrap_stream=None,
+):
+    """Iterate over the (offset, length, record) of each record of a source, after its last checkpoint"""
+    records = iter_source(source, offset, http, record_filter, payloads, wrap_stream)
+    for record_offset, length, r in records:
+        # The record at the checkpoint was committed together with it
+        if offset and record_offset == offset:
+            continue
+        yield record_offset, length, r
+
+
+def located_row(r: ArcWarcRecord, offset, length, payloads=True):
+    """record_to_row(), along with where the record was read from"""
+    rec_type, row = record_to_row(r, payloads)
+    row["warc_offset"] = offset
+    row["warc_length"] = length
+    return rec_type, row
+
+
+def resume_records(
+    source,
+    offset,
+    http: HTTPClient = None,
+    record_filter: RecordFilter = None,
+    payloads=True,
+):
+    """
+    Iterate over the (rec_type, row) of each record of a source, after its last checkpoint,
+    along with the record's offset.
+    """
+    records = records_after(source, offset, http, record_filter, payloads)
+    for record_offset, length, r in records:
+        yield record_offset, *located_row(r, record_offset, length, payloads)
+
+
+def import_source(
+    db: WarcDB,
+    source,
+    state,
+    http: HTTPClient = None,
+    record_filter: RecordFilter = None,
+    payloads=True,
+):
+    """
+    Import a single source, checkpointing its progress in the ingest log.
+    The time spent reading, parsing and normalizing its records is accounted to db.stats.
+    """
+    key = source_key(source)
+    file_id = db.file_id(source)
+    stats = db.stats
+    records = records_after(
+        source, state["offset"], http, record_filter, payloads, stats.timed_stream
+    )
+    records = stats.timed(records, "parse")
+    for offset, length, r in tqdm(records, desc=source_name(source)):
+        with stats.timer("normalize"):
+            rec_type, row = located_row(r, offset, length, payloads)
+        row["warc_file_id"] = file_id
+        db.add_row(rec_type, row)
+        state["offset"] = offset
+        state["records"] += 1
+        db.checkpoint(key, **state)
+    state["completed"] = 1
+    db.checkpoint(key, **state)
+
+
+def pipelined_import(
+    db: WarcDB,
+    sources,
+    http: HTTPClient = None,
+    record_filter: RecordFilter = None,
+    payloads=True,
+    queue_size=QUEUE_SIZE,
+):
+    """
+    Import sources one after the other, with reading, parsing, normalizing and writing
+    running concurrently (see warcdb.pipeline).
+    `sources` maps each source to its resume_state().
+    Returns the stats of every stage.
+    """
+    read = StageStats("read")
+
+    def read_ahead(stream):
+        return PrefetchingStream(lambda: stream, stream.tell(), READ_AHEAD, read)
+
+    def parse():
+        for source, state in sources.items():
+            records = records_after(
+                source, state["offset"], http, record_filter, payloads, read_ahead
+            )
+            for offset, length, r in records:
+                yield source, offset, length, r
+            # End of the source
+            yield source, None, None, None
+
+    def normalize(item):
+        source, offset, length, r = item
+        if r is None:
+            return source, None, None, None
+        return source, offset, *located_row(r, offset, length, payloads)
+
+    file_ids = {source: db.file_id(source) for source in sources}
+    pipeline = Pipeline(parse(), [("normalize", normalize)], queue_size=queue_size)
+    with tqdm(desc=f"{len(sources)} sources", unit=" records") as progress:
+        for source, offset, rec_type, row in pipeline:
+            state = sources[source]
+            if row is None:
+                state["completed"] = 1
+                db.checkpoint(source_key(source), **state)
+                progress.set_postfix(done=source_name(source))
+                continue
+            row["warc_file_id"] = file_ids[source]
+            db.add_row(rec_type, row)
+            state["offset"] = offset
+            state["records"] += 1
+            db.checkpoint(source_key(source), **state)
+            progress.update()
+    db.stats.pipeline = pipeline.report([read])
+    return db.stats.pipeline
+
+
+def format_stage_stats(stats) -> str:
+    """A table of pipeline stage stats"""
+    columns = list(stats[0])
+    rows = [columns] + [[str(s[c]) for c in columns] for s in stats]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    return "\n".join(
+        "  ".join(value.rjust(width) for value, width in zip(row, widths))
+        for row in rows
+    )
+
+
+""" Parallel import: worker processes parse, a single writer inserts """
+
+_worker_queue = None
+_worker_http = None
+_worker_filter = None
+_worker_payloads = True
+
+
+def _init_worker(queue, http_options, record_filter, payloads):
+    global _worker_queue, _worker_http, _worker_filter, _worker_payloads
+    _worker_queue = queue
+    # Workers parse one source at a time, so there's nothing to prefetch
+    _worker_http = HTTPClient(**{**http_options, "prefetch": 0})
+    _worker_filter = record_filter
+    _worker_payloads = payloads
+
+
+def _parse_source(source, offset, batch_size):
+    """
+    Parse a source in a worker, sending batches of normalized rows to the writer,
+    along with the offset of their last record.
+    """
+    completed = False
+    try:
+        rows = []
+        records = resume_records(
+            source, offset, _worker_http, _worker_filter, _worker_payloads
+        )
+        for offset, rec_type, row in records:
+            rows.append((rec_type, row))
+            if len(rows) >= batch_size:
+                _worker_queue.put((source, rows, offset))
+                rows = []
+        if rows:
+            _worker_queue.put((source, rows, offset))
+        completed = True
+    finally:
+        # Always tell the writer we're done, even on error,
+        # so it doesn't wait forever; the error itself surfaces through the future
+        _worker_queue.put((source, None, completed))
+
+
+def parallel_import(
+    db: WarcDB,
+    sources,
+    jobs: int,
+    batch_size: int,
+    http: HTTPClient = None,
+    record_filter: RecordFilter = None,
+    payloads=True,
+):
+    """
+    Parse sources in `jobs` worker processes and write them to `db` from this process.
+    `sources` maps each source to its resume_state().
+    The order of records within each source is preserved.
+    """
+    queue = multiprocessing.Queue(maxsize=2 * jobs)
+    file_ids = {source: db.file_id(source) for source in sources}
+
+    with ProcessPoolExecutor(
+        max_workers=jobs,
+        initializer=_init_worker,
+        initargs=(queue, (http or HTTPClient()).options, record_filter, payloads),
+    ) as executor:
+        futures = [
+            executor.submit(_parse_source, source, state["offset"], batch_size)
+            for source, state in sources.items()
+        ]
+
+        remaining = len(sources)
+        with tqdm(desc=f"{remaining} sources", unit=" records") as progress:
+            while remaining:
+                try:
+                    source, rows, offset = queue.get(timeout=1)
+                except Empty:
+                    # A worker that died can't send its sentinel
+                    for future in futures:
+                        if future.done() and future.exception():
+                            raise future.exception()
+                    continue
+                state = sources[source]
+                if rows is None:
+                    remaining -= 1
+                    # offset is the sentinel's completed flag
+                    if offset:
+                        state["completed"] = 1
+                        db.checkpoint(source_key(source), **state)
+                    progress.set_postfix(done=source_name(source))
+                    continue
+                for rec_type, row in rows:
+                    row["warc_file_id"] = file_ids[source]
+                    db.add_row(rec_type, row)
+                state["offset"] = offset
+                state["records"] += len(rows)
+                db.checkpoint(source_key(source), **state)
+                progress.update(len(rows))
+
+        for future in futures:
+            future.result()
+
+
 from sqlite_utils import cli as sqlite_utils_cli
 
+# Imported once WarcDB is defined, which it builds on
+from warcdb.dataset import SHARD_KEYS, ShardedWriter, WarcDBDataset
+from warcdb.merge import compact, merge_databases
+
 warcdb_cli = sqlite_utils_cli.cli
 warcdb_cli.help = "Commands for interacting with .warcdb files\n\nBased on SQLite-Utils"
 
 
+def _date_option(ctx, param, value):
+    """Callback of the --from / --to options"""
+    try:
+        return value and check_date(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 @warcdb_cli.command("import")
 @click.argument(
     "db_path",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+    type=click.Path(file_okay=True, dir_okay=True, allow_dash=False),
 )
 @click.argument("warc_path", type=click.STRING, nargs=-1)
 @click.option(
     "--batch-size",
     type=click.INT,
     default=1000,
-    help="Batch size for chunked INSERTs [Note: ignored for now]",
+    help="Number of records to buffer before writing them in a single transaction",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=1,
+    help="Number of worker processes parsing WARC files in parallel",
 )
-def import_(db_path, warc_path, batch_size):
+@click.option(
+    "--pipeline",
+    is_flag=True,
+    help="Read, parse, normalize and write records concurrently, and report the throughput of each stage",
+)
+@click.option(
+    "--profile",
+    type=click.Choice(["bulk", "safe"]),
+    help="SQLite tuning profile: bulk trades durability for speed and builds indexes at the end, safe is durable (both use WAL)",
+)
+@click.option(
+    "--shard-by",
+    type=click.Choice(SHARD_KEYS),
+    help="Import into a dataset directory, with a shard per crawl (WARC file), month, or hash of the host",
+)
+@click.option(
+    "--shards",
+    type=click.IntRange(min=1),
+    help="Number of shards of --shard-by host (8 by default)",
+)
+@click.option(
+    "--dedup",
+    is_flag=True,
+    help="Store response and resource payloads once per digest (persists for the database)",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(CODECS),
+    help="Compress payloads with this codec (persists for the database). Read them with warc_payload(payload)",
+)
+@click.option(
+    "--no-payload",
+    is_flag=True,
+    help="Don't store payloads, only where each record is in its WARC file; payloads are read back on demand",
+)
+@click.option(
+    "--large-payload-size",
+    type=click.IntRange(min=0),
+    default=LARGE_PAYLOAD_SIZE,
+    help="Size in bytes above which payloads aren't read into memory, but handled according to --large-payloads",
+)
+@click.option(
+    "--large-payloads",
+    type=click.Choice(LARGE_PAYLOAD_MODES),
+    default="stream",
+    help="Write large payloads in chunks (stream), or leave them in the WARC file to be read back on demand (reference)",
+)
+@click.option(
+    "--header-tables",
+    is_flag=True,
+    help="Store HTTP headers in indexed request_http_header / response_http_header tables (persists for the database)",
+)
+@click.option(
+    "--fts",
+    is_flag=True,
+    help="Extract the text of responses into the response_text_fts full-text search index (persists for the database)",
+)
+@click.option(
+    "--force",
+    is_flag=True,
+    help="Import sources from scratch, even if the ingest log says they have been imported",
+)
+@click.option(
+    "--retries",
+    type=click.IntRange(min=0),
+    default=5,
+    help="How many times to retry (and resume) failed downloads",
+)
+@click.option(
+    "--timeout",
+    type=click.FLOAT,
+    default=60,
+    help="Timeout for HTTP connections and reads, in seconds",
+)
+@click.option(
+    "--prefetch",
+    type=click.IntRange(min=0),
+    default=1,
+    help="Number of remote files to download ahead of the one being imported",
+)
+@click.option(
+    "--wacz-member",
+    multiple=True,
+    help="Only import the WARCs of WACZ files matching this glob pattern (can be repeated)",
+)
+@click.option(
+    "--url-prefix",
+    multiple=True,
+    help="Only import captures whose URL starts with this prefix (can be repeated)",
+)
+@click.option(
+    "--mime",
+    multiple=True,
+    help="Only import captures with this MIME type, or type prefix like image/ (can be repeated)",
+)
+@click.option(
+    "--status",
+    type=click.INT,
+    multiple=True,
+    help="Only import captures with this HTTP status (can be repeated)",
+)
+@click.option(
+    "from_",
+    "--from",
+    callback=_date_option,
+    help="Only import captures from this date on, e.g. 2023-10-20 or 20231020122247",
+)
+@click.option(
+    "--to",
+    callback=_date_option,
+    help="Only import captures up to this date (inclusive)",
+)
+@click.option(
+    "--stats",
+    "stats_output",
+    type=click.File("w"),
+    help="Write a JSON report of the import (stage timings, counts, peak RSS) to this file, - for stdout",
+)
+@click.option(
+    "--stats-interval",
+    type=click.FloatRange(min=0, min_open=True),
+    help="Write a snapshot of the --stats report every this many seconds, as newline-delimited JSON",
+)
+@click.option(
+    "--cprofile",
+    type=click.Path(dir_okay=False, allow_dash=False),
+    help="Profile the import with cProfile, and write the stats to this file (read it with python -m pstats)",
+)
+def import_(
+    db_path,
+    warc_path,
+    batch_size,
+    jobs,
+    pipeline,
+    profile,
+    shard_by,
+    shards,
+    dedup,
+    compression,
+    no_payload,
+    large_payload_size,
+    large_payloads,
+    header_tables,
+    fts,
+    force,
+    retries,
+    timeout,
+    prefetch,
+    wacz_member,
+    url_prefix,
+    mime,
+    status,
+    from_,
+    to,
+    stats_output,
+    stats_interval,
+    cprofile,
+):
     """
-    Import a WARC file into the database
+    Import a WARC file into the database, or into the shards of a dataset directory
     """
-    db = WarcDB(db_path, batch_size=batch_size)
+    if pipeline and jobs > 1:
+        raise click.UsageError("--pipeline and --jobs can't be used together")
+    if stats_interval and not stats_output:
+        raise click.UsageError("--stats-interval requires --stats")
+    if shards and shard_by not in (None, "host"):
+        raise click.UsageError("--shards only applies to --shard-by host")
 
-    # ensure the schema is there and up to date
-    migration.apply(db.db)
+    if shard_by or os.path.isdir(db_path):
+        try:
+            db = ShardedWriter(db_path, shard_by, shards, batch_size, profile)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+        # Shards are created with the settings of the catalog (see warcdb.dataset)
+        settings_db = db.catalog
+    else:
+        db = settings_db = WarcDB(db_path, batch_size=batch_size, profile=profile)
+
+        # ensure the schema is there and up to date
+        migration.apply(db.db)
+
+        if profile:
+            record_profile(db.db, profile, db.pragmas)
+
+    if dedup:
+        settings_db.enable_dedup()
+
+    if header_tables:
+        settings_db.enable_header_tables()
+
+    if fts:
+        settings_db.enable_text_search()
+
+    if compression:
+        try:
+            settings_db.set_payload_codec(compression)
+        except ValueError as e:
+            raise click.ClickException(str(e))
+
+    payloads = False
+    if not no_payload:
+        payloads = LargePayloads(large_payload_size, large_payloads)
+
+    to_import = {}
+    record_filter = RecordFilter.create(url_prefix, mime, status, from_, to)
+    http = HTTPClient(retries=retries, timeout=timeout, prefetch=prefetch)
+    for source in expand_sources(warc_path, wacz_member, http):
+        state = resume_state(db, source, force, record_filter)
+        if state is None:
+            click.echo(f"Skipping {source_name(source)}: already imported", err=True)
+            db.stats.sources_skipped += 1
+        else:
+            to_import[source] = state
+    db.stats.sources = len(to_import)
+
+    if profile and PROFILES[profile]["defer_indexes"]:
+        db.defer_indexes()
 
-    # if batch_size:
-    #    warnings.warn("--batch-size has been temporarily disabled")
+    profiler = None
+    if cprofile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+    reporter = None
+    if stats_interval:
+        reporter = StatsReporter(db.stats, stats_output, stats_interval)
+        reporter.start()
 
-    def to_import():
-        for f in always_iterable(warc_path):
-            if f.startswith("http"):
-                yield from tqdm(
-                    ArchiveIterator(req.get(f, stream=True).raw, arc2warc=True), desc=f
+    with db:
+        try:
+            if jobs > 1:
+                parallel_import(
+                    db,
+                    to_import,
+                    jobs,
+                    batch_size,
+                    http,
+                    record_filter,
+                    payloads=payloads,
                 )
-            elif f.endswith(".wacz"):
-                # TODO: can we support loading WACZ files by URL?
-                wacz = zipfile.ZipFile(f)
-                warcs = filter(
-                    lambda f: f.filename.endswith("warc.gz"), wacz.infolist()
+            elif pipeline:
+                http.schedule(remote_sources(to_import))
+                stats = pipelined_import(
+                    db, to_import, http, record_filter, payloads=payloads
                 )
-                for warc in warcs:
-                    yield from tqdm(
-                        ArchiveIterator(wacz.open(warc.filename, "r"), arc2warc=True),
-                        desc=warc.filename,
-                    )
+                click.echo(format_stage_stats(stats), err=True)
             else:
-                yield from tqdm(ArchiveIterator(open(f, "rb"), arc2warc=True), desc=f)
+                http.schedule(remote_sources(to_import))
+                for source, state in to_import.items():
+                    import_source(
+                        db, source, state, http, record_filter, payloads=payloads
+                    )
+        finally:
+            http.close()
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(cprofile)
+            if reporter is not None:
+                reporter.stop()
+
+        # Including the ones deferred by a previous, interrupted import
+        with db.stats.timer("index"):
+            db.rebuild_indexes()
+        record_import(settings_db.db, db.stats)
 
-    for r in to_import():
-        db += r
+    if stats_output:
+        # The last line of --stats-interval snapshots is the final report
+        report = db.stats.as_dict()
+        stats_output.write(dumps(report, indent=None if stats_interval else 2) + "\n")
+
+
+@warcdb_cli.command("index-headers")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+def index_headers(db_path):
+    """
+    Materialize the HTTP headers of all records into indexed tables,
+    and keep doing so for subsequent imports
+    """
+    db = WarcDB(db_path)
+    migration.apply(db.db)
+    db.enable_header_tables()
+    db.close()
+
+
+@warcdb_cli.command("index-text")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+def index_text(db_path):
+    """
+    Extract the text of all responses into a full-text search index,
+    and keep doing so for subsequent imports
+    """
+    db = WarcDB(db_path)
+    migration.apply(db.db)
+    db.enable_text_search()
+    db.close()
+
+
+@warcdb_cli.command("cdx")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.argument("output", type=click.File("w"), default="-")
+def cdx(db_path, output):
+    """
+    Export a CDXJ index of the captures in the database, sorted by SURT and timestamp
+    """
+    db = WarcDB(db_path, profile="readonly")
+    output.writelines(db.cdxj())
+
+
+@warcdb_cli.command("export")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.argument("output", type=click.Path(dir_okay=False, allow_dash=True))
+@click.option(
+    "--where",
+    help="SQL condition the records to export have to match. Record tables without the columns it refers to are skipped",
+)
+@click.option(
+    "-p",
+    "--param",
+    multiple=True,
+    type=(str, str),
+    help="Named :parameters for the --where condition",
+)
+def export(db_path, output, where, param):
+    """
+    Export records into a WARC file, gzipped if its name ends with .gz
+    """
+    db = WarcDB(db_path, profile="readonly")
+    gzip = output.endswith(".gz")
+    with click.open_file(output, "wb") as f:
+        try:
+            count = export_warc(db, f, where, dict(param), gzip=gzip)
+        except sqlite3.OperationalError as e:
+            raise click.ClickException(str(e))
+    click.echo(f"Exported {count} records", err=True)
+
+
+@warcdb_cli.command("export-parquet")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.argument(
+    "directory",
+    type=click.Path(file_okay=False, dir_okay=True, allow_dash=False),
+)
+@click.option(
+    "tables",
+    "--table",
+    type=click.Choice(EXPORT_TABLES),
+    multiple=True,
+    help="Record tables to export (can be repeated; all by default)",
+)
+@click.option(
+    "--no-payload",
+    is_flag=True,
+    help="Leave payloads out, and only export the records' metadata",
+)
+@click.option(
+    "--partition",
+    type=click.Choice(list(PARTITIONS)),
+    default="month",
+    show_default=True,
+    help="Partition the files of every table by the month or day of their records",
+)
+@click.option(
+    "--batch-size",
+    type=click.IntRange(min=1),
+    default=PARQUET_BATCH_SIZE,
+    show_default=True,
+    help="Rows per record batch (and Parquet row group). Memory use grows with it",
+)
+@click.option(
+    "--compression",
+    type=click.Choice(PARQUET_COMPRESSIONS),
+    default="zstd",
+    show_default=True,
+)
+def export_parquet_(
+    db_path, directory, tables, no_payload, partition, batch_size, compression
+):
+    """
+    Export record tables into Parquet files under DIRECTORY,
+    e.g. DIRECTORY/response/date=2022-06/part-0.parquet, for DuckDB, Polars and other analytics engines
+    """
+    if os.path.isdir(directory) and os.listdir(directory):
+        raise click.ClickException(f"{directory} isn't empty")
+    db = WarcDB(db_path, profile="readonly").db
+    try:
+        exported = export_parquet(
+            db,
+            directory,
+            tables=tables,
+            payloads=not no_payload,
+            partition=partition,
+            batch_size=batch_size,
+            compression=compression,
+        )
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    for table, count in exported.items():
+        click.echo(f"{table}: {count} rows", err=True)
+    db.close()
+
+
+@warcdb_cli.command("merge")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+)
+@click.argument(
+    "inputs",
+    nargs=-1,
+    required=True,
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.option(
+    "--profile",
+    type=click.Choice(["bulk", "safe"]),
+    help="SQLite tuning profile of the output (see warcdb import --profile)",
+)
+def merge(db_path, inputs, profile):
+    """
+    Merge WarcDB files into one (created if needed), without re-importing their WARC files.
+    Records are deduplicated on their id, and stored payloads on their digest
+    """
+    if os.path.abspath(db_path) in map(os.path.abspath, inputs):
+        raise click.UsageError("The output can't be one of the inputs")
+    db = WarcDB(db_path, profile=profile)
+    if profile:
+        migration.apply(db.db)
+        record_profile(db.db, profile, db.pragmas)
+    for path, added in merge_databases(db, inputs).items():
+        click.echo(f"{path}: {added} records added", err=True)
+    db.close()
+
+
+@warcdb_cli.command("compact")
+@click.argument(
+    "db_path",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.argument(
+    "output",
+    required=False,
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False),
+)
+@click.option(
+    "--page-size",
+    type=click.Choice(["4096", "8192", "16384", "32768", "65536"]),
+    help="Change the page size (larger pages suit large payloads). This switches the database out of WAL mode",
+)
+def compact_(db_path, output, page_size):
+    """
+    Rewrite a database for read-mostly serving, in place or into OUTPUT:
+    captures ordered by URL and date, full-text indexes optimized, statistics gathered, and VACUUMed
+    """
+    if output and os.path.exists(output):
+        raise click.ClickException(f"{output} already exists")
+    db = sqlite_utils.Database(db_path)
+    compact(db, output, page_size)
+    db.close()
+
+
+@warcdb_cli.command("dataset-query")
+@click.argument(
+    "dataset_path",
+    type=click.Path(file_okay=False, dir_okay=True, allow_dash=False, exists=True),
+)
+@click.argument("sql")
+@click.option(
+    "from_",
+    "--from",
+    callback=_date_option,
+    help="Skip the month shards without records from this date on, e.g. 2023-10 or 20231020",
+)
+@click.option(
+    "--to",
+    callback=_date_option,
+    help="Skip the month shards without records up to this date",
+)
+@click.option("--host", help="Only query the host shard of this host")
+@click.option("--crawl", help="Only query the shard of this crawl")
+@click.option(
+    "-p",
+    "--param",
+    multiple=True,
+    type=(str, str),
+    help="Named :parameters for SQL query",
+)
+@click.option("--nl", is_flag=True, help="Output newline-delimited JSON")
+def dataset_query(dataset_path, sql, from_, to, host, crawl, param, nl):
+    """
+    Run a SQL query over the shards of a dataset,
+    skipping the ones the --from, --to, --host or --crawl predicate rules out.
+    Over more shards than SQLite can attach at once (10), the query runs over batches of shards,
+    whose rows are concatenated
+    """
+    try:
+        dataset = WarcDBDataset(dataset_path)
+        connections = dataset.connections(from_=from_, to=to, host=host, crawl=crawl)
+        cursors = [db.execute(sql, dict(param)) for db in connections]
+    except (ValueError, sqlite3.OperationalError) as e:
+        raise click.ClickException(str(e))
+    if len(cursors) > 1:
+        click.echo(
+            f"The query ran over {len(cursors)} batches of shards: aggregates are per batch",
+            err=True,
+        )
+    headers = [c[0] for c in cursors[0].description or []]
+    rows = chain.from_iterable(cursors)
+    for line in sqlite_utils_cli.output_rows(rows, headers, nl, False, ()):
+        click.echo(line)
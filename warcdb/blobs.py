@@ -0,0 +1,153 @@
+"""
+Large payloads.
+
+Payloads are normally read into memory, and inserted together with their record.
+Payloads larger than a threshold (LargePayloads.max_size) are instead read in chunks into a temporary file,
+and, in stream mode, written with SQLite's incremental BLOB I/O:
+a row is inserted with a zeroblob() of the (compressed) payload's size, which is then filled in chunk by chunk.
+Memory use is bounded by the threshold and the chunk size, rather than by the largest record.
+
+SQLite only leaves a zeroblob() unallocated when no column follows it,
+so large payloads are always stored in the payloads table (digest, payload), like with dedup,
+and their records reference them through payload_digest.
+
+In reference mode large payloads aren't stored at all, like with `warcdb import --no-payload`:
+they're read back from their WARC file when they're accessed.
+Incremental BLOB I/O requires Python 3.11; with older versions, stream mode falls back to reference mode.
+"""
+
+import hashlib
+import os
+import sqlite3
+import tempfile
+from base64 import b32encode
+from itertools import chain
+
+BLOB_CHUNK_SIZE = 1024 * 1024
+LARGE_PAYLOAD_SIZE = 16 * 1024 * 1024
+LARGE_PAYLOAD_MODES = ["stream", "reference"]
+
+BLOB_IO = hasattr(sqlite3.Connection, "blobopen")
+
+
+class LargePayloads:
+    """How payloads larger than max_size bytes are imported: streamed into the database, or left in the WARC"""
+
+    def __init__(self, max_size=LARGE_PAYLOAD_SIZE, mode="stream"):
+        if mode not in LARGE_PAYLOAD_MODES:
+            raise ValueError(f"Unknown mode <{mode}>. Only {LARGE_PAYLOAD_MODES} are.")
+        self.max_size = max_size
+        self.mode = mode if BLOB_IO else "reference"
+
+
+class LargePayload:
+    """
+    A payload spooled to a temporary file, along with its size and digest.
+    It's only a path, so it can be passed between processes; it's deleted once written.
+    """
+
+    def __init__(self, path, size, digest):
+        self.path = path
+        self.size = size
+        self.digest = digest
+
+    @classmethod
+    def from_chunks(cls, chunks):
+        """Write chunks into a temporary file, computing their digest along the way"""
+        sha1, size = hashlib.sha1(), 0
+        with tempfile.NamedTemporaryFile(
+            prefix="warcdb-", suffix=".payload", delete=False
+        ) as f:
+            for chunk in chunks:
+                sha1.update(chunk)
+                size += len(chunk)
+                f.write(chunk)
+        return cls(f.name, size, "sha1:" + b32encode(sha1.digest()).decode())
+
+    @classmethod
+    def spool(cls, stream, head: bytes = b""):
+        """Read the rest of a stream, after its head, in chunks"""
+        return cls.from_chunks(
+            chain([head], iter(lambda: stream.read(BLOB_CHUNK_SIZE), b""))
+        )
+
+    def chunks(self):
+        with open(self.path, "rb") as f:
+            yield from iter(lambda: f.read(BLOB_CHUNK_SIZE), b"")
+
+    def encode(self, codec) -> "LargePayload":
+        """The payload compressed with a codec, spooled to another temporary file"""
+        if codec.name == "none":
+            return self
+        compressor = codec.compressobj(self.size)
+
+        def compressed():
+            for chunk in self.chunks():
+                yield compressor.compress(chunk)
+            yield compressor.flush()
+
+        return LargePayload.from_chunks(compressed())
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def __len__(self):
+        return self.size
+
+
+def payload_policy(payloads) -> LargePayloads:
+    """
+    The LargePayloads policy of the `payloads` argument of the import functions:
+    either a LargePayloads, or True for the default one.
+    """
+    return payloads if isinstance(payloads, LargePayloads) else LargePayloads()
+
+
+def read_payload(r, payloads=True):
+    """
+    Read the payload of a record, memoized like ArcWarcRecord.payload():
+    as bytes, or above the policy's threshold as a LargePayload (or None in reference mode).
+    """
+    try:
+        return r._warcdb_payload
+    except AttributeError:
+        pass
+    large_payloads = payload_policy(payloads)
+    stream = r.content_stream()
+    head = stream.read(large_payloads.max_size + 1)
+    if len(head) <= large_payloads.max_size:
+        payload = head
+    elif large_payloads.mode == "reference":
+        payload = None
+    else:
+        payload = LargePayload.spool(stream, head)
+    r._warcdb_payload = payload
+    return payload
+
+
+def write_large_payload(conn, table, key_column, key, payload: LargePayload, codec):
+    """
+    Fill in the payload of a row inserted without one,
+    by writing it in chunks into a zeroblob() of its size.
+    Rows that already have a payload are left alone.
+    """
+    encoded = payload.encode(codec)
+    try:
+        cursor = conn.execute(
+            f"UPDATE [{table}] SET payload = zeroblob(?) WHERE [{key_column}] = ? AND payload IS NULL",
+            [encoded.size, key],
+        )
+        if not cursor.rowcount:
+            return
+        (rowid,) = conn.execute(
+            f"SELECT rowid FROM [{table}] WHERE [{key_column}] = ?", [key]
+        ).fetchone()
+        with conn.blobopen(table, "payload", rowid) as blob:
+            for chunk in encoded.chunks():
+                blob.write(chunk)
+    finally:
+        if encoded is not payload:
+            encoded.discard()
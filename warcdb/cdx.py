@@ -0,0 +1,126 @@
+"""
+CDX(J) indexes and capture lookups, served from the database.
+
+Captures (response, resource and revisit records) are looked up through the (surt, date_epoch) indexes
+added by the derived columns (see warcdb.derived), so both the sorted CDXJ export
+and closest-capture lookups are index scans rather than table scans.
+"""
+
+import json
+import posixpath
+
+from warcdb.derived import date_epoch, surt
+from warcdb.sources import timestamp14
+
+CAPTURE_TABLES = ["response", "resource", "revisit"]
+
+
+def _capture_select(db, rec_type, table):
+    """SELECT of the CDX fields of the captures of a rec_type, read from its storage table"""
+    columns = db[table].columns_dict
+
+    def column(name):
+        return f"r.[{name}]" if name in columns else "NULL"
+
+    digests = [column(c) for c in ("warc_payload_digest", "payload_digest")]
+    return f"""
+        SELECT
+            '{rec_type}' AS rec_type,
+            r.surt AS surt,
+            r.date_epoch AS date_epoch,
+            r.warc_record_id AS warc_record_id,
+            r.warc_date AS warc_date,
+            r.warc_target_uri AS url,
+            r.content_type AS content_type,
+            {column("http_headers")} AS http_headers,
+            {column("http_status")} AS status,
+            COALESCE({", ".join(digests)}) AS digest,
+            {column("warc_length")} AS length,
+            {column("warc_offset")} AS offset,
+            f.path AS path,
+            f.wacz_member AS wacz_member
+        FROM [{table}] AS r
+        LEFT JOIN warc_file AS f ON f.id = r.warc_file_id
+        WHERE r.surt IS NOT NULL
+    """
+
+
+def _http_mime(http_headers):
+    for h in json.loads(http_headers):
+        if h["header"].lower() == "content-type":
+            return h["value"]
+    return None
+
+
+def cdx_entry(row: dict) -> dict:
+    """The CDXJ fields of a capture row"""
+    mime = row["content_type"]
+    if row["rec_type"] == "revisit":
+        mime = "warc/revisit"
+    elif row["http_headers"]:
+        mime = _http_mime(row["http_headers"])
+    entry = {
+        "url": row["url"],
+        "mime": mime and mime.split(";")[0].strip(),
+        "status": row["status"] and str(row["status"]),
+        "digest": row["digest"] and row["digest"].split(":", 1)[-1],
+        "length": row["length"] and str(row["length"]),
+        "offset": None if row["offset"] is None else str(row["offset"]),
+        "filename": row["path"]
+        and posixpath.basename(row["wacz_member"] or row["path"]),
+    }
+    return {k: v for k, v in entry.items() if v is not None}
+
+
+def cdxj_lines(db, storage_tables):
+    """
+    Stream the CDXJ lines of all captures, sorted by SURT and timestamp.
+    storage_tables maps each rec_type to the table storing it (see warcdb.dedup).
+    Each table is read in (surt, date_epoch) index order and merged, so memory use stays constant.
+    """
+    selects = [
+        _capture_select(db, rec_type, storage_tables[rec_type])
+        for rec_type in CAPTURE_TABLES
+        if db[storage_tables[rec_type]].exists()
+    ]
+    if not selects:
+        return
+    sql = " UNION ALL ".join(selects) + " ORDER BY surt, date_epoch, warc_date"
+    for row in db.query(sql):
+        entry = json.dumps(cdx_entry(row))
+        yield f"{row['surt']} {timestamp14(row['warc_date'])} {entry}\n"
+
+
+def closest_captures(db, storage_tables, url, timestamp=None, limit=1):
+    """
+    The warc_record_ids of the captures of a URL closest to a timestamp
+    (e.g. 20231020122247 or 2023-10-20, the latest ones if it's None), closest first.
+    At most `limit` captures before and after it are read from each table.
+    """
+    key = surt(url)
+    epoch = date_epoch(str(timestamp)) if timestamp else None
+    candidates = []
+    for rec_type in CAPTURE_TABLES:
+        table = storage_tables[rec_type]
+        if not db[table].exists():
+            continue
+        if epoch is None:
+            queries = [("", "DESC", [])]
+        else:
+            queries = [("AND date_epoch <= ?", "DESC", [epoch])]
+            queries.append(("AND date_epoch > ?", "ASC", [epoch]))
+        for condition, order, params in queries:
+            candidates += db.execute(
+                f"""
+                SELECT warc_record_id, date_epoch FROM [{table}]
+                WHERE surt = ? {condition}
+                ORDER BY date_epoch {order} LIMIT ?
+                """,
+                [key, *params, limit],
+            ).fetchall()
+
+    if epoch is None:
+        candidates.sort(key=lambda c: -(c[1] or 0))
+    else:
+        candidates.sort(key=lambda c: abs((c[1] or 0) - epoch))
+    return [record_id for record_id, _ in candidates[:limit]]
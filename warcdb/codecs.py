@@ -0,0 +1,135 @@
+"""
+Payload compression.
+
+The codec of a database is stored in its settings as payload_codec,
+and applies to every payload column in it.
+The warc_payload(payload) SQL function decompresses payloads on read.
+It's registered on the connections of WarcDB and WarcDBDataset.
+This module is also a sqlite-utils plugin (an entry point, see pyproject.toml),
+which registers it on sqlite-utils connections once warcdb is installed, e.g. in `warcdb query`.
+"""
+
+import sqlite3
+import zlib
+
+from sqlite_utils import hookimpl
+
+from warcdb.settings import SETTINGS_TABLE, get_setting, set_setting
+
+CODECS = ["none", "zlib", "zstd"]
+
+
+class Codec:
+    """
+    compress and decompress work on whole payloads.
+    compressobj(size) returns a streaming compressor (with compress(chunk) and flush() methods)
+    for a payload of a known size, whose output decompress() can read.
+    """
+
+    def __init__(self, name, compress, decompress, compressobj):
+        self.name = name
+        self.compress = compress
+        self.decompress = decompress
+        self.compressobj = compressobj
+
+
+def _identity(payload):
+    return payload
+
+
+class _IdentityCompressor:
+    def __init__(self, size=None):
+        pass
+
+    def compress(self, chunk):
+        return chunk
+
+    def flush(self):
+        return b""
+
+
+def get_codec(name) -> Codec:
+    if name in (None, "none"):
+        return Codec("none", _identity, _identity, _IdentityCompressor)
+    if name == "zlib":
+        return Codec(
+            name, zlib.compress, zlib.decompress, lambda size: zlib.compressobj()
+        )
+    if name == "zstd":
+        try:
+            import zstandard
+        except ImportError:
+            raise ValueError(
+                "zstd compression requires the zstandard package: pip install warcdb[zstd]"
+            )
+        # The size is written in the frame header, which decompress() needs
+        return Codec(
+            name,
+            zstandard.ZstdCompressor().compress,
+            zstandard.ZstdDecompressor().decompress,
+            lambda size: zstandard.ZstdCompressor().compressobj(size=size),
+        )
+    raise ValueError(f"Unknown codec <{name}>. Only {CODECS} are supported.")
+
+
+def encode_payload(codec: Codec, payload):
+    if payload is None:
+        return None
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return codec.compress(payload)
+
+
+def connection_codec_name(conn: sqlite3.Connection):
+    try:
+        row = conn.execute(
+            f"SELECT value FROM [{SETTINGS_TABLE}] WHERE key = 'payload_codec'"
+        ).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return row and row[0]
+
+
+def register_payload_function(conn: sqlite3.Connection):
+    name = connection_codec_name(conn)
+    codec = None
+
+    def warc_payload(payload):
+        nonlocal codec
+        if payload is None:
+            return None
+        # Resolved on first use, so a missing zstandard only fails the queries that need it
+        codec = codec or get_codec(name)
+        return codec.decompress(payload)
+
+    conn.create_function("warc_payload", 1, warc_payload, deterministic=True)
+
+
+def set_payload_codec(db, name):
+    """Change the codec of a database, recompressing all existing payloads"""
+    old = get_codec(get_setting(db, "payload_codec"))
+    new = get_codec(name)
+    if old.name == new.name:
+        return
+
+    def recode_payload(payload):
+        if isinstance(payload, str):
+            return encode_payload(new, payload)
+        return encode_payload(new, old.decompress(payload))
+
+    db.conn.create_function("warcdb_recode_payload", 1, recode_payload)
+    with db.conn:
+        db.execute("BEGIN")
+        for table in db.tables:
+            if "payload" in table.columns_dict:
+                db.execute(
+                    f"UPDATE [{table.name}] SET payload = warcdb_recode_payload(payload) WHERE payload IS NOT NULL"
+                )
+        set_setting(db, "payload_codec", new.name)
+
+    register_payload_function(db.conn)
+
+
+@hookimpl
+def prepare_connection(conn):
+    register_payload_function(conn)
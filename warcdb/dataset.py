@@ -0,0 +1,467 @@
+"""
+Sharded datasets.
+
+A dataset is a directory of WarcDB files (shards), along with a catalog.warcdb that keeps track of them.
+`warcdb import --shard-by` routes every record into a shard by a key (SHARD_KEYS):
+
+* crawl: the WARC file (or WACZ member) the record was read from
+* month: the month of its WARC-Date, e.g. 2024-01
+* host: a hash of the host of its URL, into a fixed number of shards
+
+The catalog holds the ingest log of the whole dataset, so imports resume like they do for a single database,
+and the storage settings (dedup, compression, header tables, full-text search) shards are kept in line with.
+
+WarcDBDataset ATTACHes the shards to a single connection, with TEMP views that UNION ALL
+their tables, so that queries like `SELECT * FROM response` span the whole dataset.
+SQLite attaches at most 10 databases to a connection, so queries over more shards
+run over batches of them, one connection each, and their rows are concatenated.
+Shards that can't contain records matching a predicate (a date range with month shards,
+a host with host shards, a crawl with crawl shards) are pruned, so queries only touch the files they need.
+"""
+
+import heapq
+import os
+import re
+import sqlite3
+import zlib
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+import sqlite_utils
+
+from warcdb import RECORDS_TABLE, WarcDB
+from warcdb.codecs import register_payload_function
+from warcdb.dedup import dedup_enabled
+from warcdb.headers import header_tables_enabled
+from warcdb.migrations import migration
+from warcdb.profiles import deferred_indexes, record_profile
+from warcdb.settings import get_setting, set_setting
+from warcdb.sources import source_key, timestamp14
+from warcdb.stats import ImportStats
+from warcdb.text import text_search_enabled
+
+CATALOG = "catalog.warcdb"
+SHARDS_TABLE = "_warcdb_shards"
+SHARD_KEYS = ["crawl", "month", "host"]
+# Few enough for a query over all of them to run over a single connection (see attach_limit())
+HOST_SHARDS = 8
+# The month shard of records without a WARC-Date
+UNDATED = "undated"
+
+
+def attach_limit() -> int:
+    """How many databases SQLite can attach to a connection"""
+    conn = sqlite3.connect(":memory:")
+    try:
+        # Connection.getlimit() requires Python 3.11; 10 is SQLite's default
+        return conn.getlimit(sqlite3.SQLITE_LIMIT_ATTACHED)
+    except AttributeError:
+        return 10
+    finally:
+        conn.close()
+
+
+def crawl_name(source) -> str:
+    """The name of the crawl shard of a source: its file name, and the one of its WACZ member"""
+    path, wacz_member = source
+    name = os.path.basename(path.split("?")[0].rstrip("/"))
+    if wacz_member:
+        name += "-" + os.path.basename(wacz_member)
+    return re.sub(r"[^\w.-]+", "_", name)
+
+
+def host_shard(host, shards=HOST_SHARDS) -> str:
+    """The host shard of a host, by a (stable) hash of it"""
+    width = len(str(shards - 1))
+    return f"host-{zlib.crc32((host or '').encode()) % shards:0{width}d}"
+
+
+def shard_key(shard_by, row: dict, source, shards=HOST_SHARDS) -> str:
+    """The key of the shard a record row goes to"""
+    if shard_by == "crawl":
+        return crawl_name(source)
+    if shard_by == "month":
+        if not row.get("warc_date"):
+            return UNDATED
+        timestamp = timestamp14(row["warc_date"])
+        return f"{timestamp[:4]}-{timestamp[4:6]}"
+    return host_shard(row.get("host"), shards)
+
+
+def open_catalog(path, shard_by=None, shards=None, **kwargs) -> WarcDB:
+    """
+    The catalog of the dataset in a directory, created if it doesn't exist yet.
+    Raises ValueError if the dataset doesn't exist and shard_by isn't given,
+    or if it exists but is sharded differently.
+    """
+    catalog_path = os.path.join(path, CATALOG)
+    if not os.path.exists(catalog_path):
+        if shard_by is None:
+            raise ValueError(f"{path} is not a WarcDB dataset: use --shard-by")
+        os.makedirs(path, exist_ok=True)
+    catalog = WarcDB(catalog_path, **kwargs)
+    migration.apply(catalog.db)
+    catalog.db[SHARDS_TABLE].create(
+        {"key": str, "path": str}, pk="key", if_not_exists=True
+    )
+
+    existing = get_setting(catalog.db, "shard_by")
+    if existing is None:
+        with catalog.db.conn:
+            set_setting(catalog.db, "shard_by", shard_by)
+            set_setting(catalog.db, "shards", shards or HOST_SHARDS)
+    elif shard_by and shard_by != existing:
+        raise ValueError(f"{path} is sharded by {existing}, not {shard_by}")
+    elif existing == "host" and shards and shards != get_setting(catalog.db, "shards"):
+        raise ValueError(
+            f"{path} has {get_setting(catalog.db, 'shards')} host shards, not {shards}"
+        )
+    return catalog
+
+
+class ShardedWriter:
+    """
+    Writes records into the shards of a dataset.
+    It has the add_row(), file_id(), checkpoint(), ingest_state() and stats of a WarcDB,
+    so it can be passed to the import functions in place of one.
+
+    All shards are flushed together, in parallel threads, and the checkpoints are only recorded
+    in the catalog once they all are: an interrupted import resumes from a point every shard has reached
+    (records written again are ignored, like for a single database).
+    """
+
+    def __init__(self, path, shard_by=None, shards=None, batch_size=1000, profile=None):
+        self.path = path
+        self.profile = profile
+        self.catalog = open_catalog(path, shard_by, shards, batch_size=batch_size)
+        self.shard_by = get_setting(self.catalog.db, "shard_by")
+        self.shards = get_setting(self.catalog.db, "shards")
+        self._batch_size = batch_size
+        self._defer_indexes = False
+
+        # Open shards, by key, and the warc_file ids of sources in each
+        self._writers = {}
+        self._file_ids = {}
+        # file_id() hands out source keys, which add_row() resolves to the sources
+        self._sources = {}
+        self._pending_count = 0
+        self._checkpoints = {}
+        self._buffering = False
+        self._executor = None
+        # Shared by all shards
+        self.stats = ImportStats()
+
+    def shard_keys(self) -> list:
+        return [
+            key
+            for (key,) in self.catalog.db.execute(
+                f"SELECT key FROM [{SHARDS_TABLE}] ORDER BY key"
+            )
+        ]
+
+    def shard(self, key) -> WarcDB:
+        """A shard, opened for writing, and created if needed"""
+        if key in self._writers:
+            return self._writers[key]
+
+        # Shards are flushed from worker threads
+        conn = sqlite3.connect(
+            os.path.join(self.path, f"{key}.warcdb"), check_same_thread=False
+        )
+        shard = WarcDB(conn, batch_size=self._batch_size, profile=self.profile)
+        shard.stats = self.stats
+        migration.apply(shard.db)
+        if self.profile:
+            record_profile(shard.db, self.profile, shard.pragmas)
+        self._sync_settings(shard)
+        if self._defer_indexes:
+            shard.defer_indexes()
+        with self.catalog.db.conn:
+            self.catalog.db.execute(
+                f"INSERT OR IGNORE INTO [{SHARDS_TABLE}] (key, path) VALUES (?, ?)",
+                [key, f"{key}.warcdb"],
+            )
+        if self._buffering:
+            shard.__enter__()
+        self._writers[key] = shard
+        return shard
+
+    def _sync_settings(self, shard: WarcDB):
+        """Bring the storage settings of a shard in line with the ones of the catalog"""
+        catalog = self.catalog.db
+        if dedup_enabled(catalog) and not dedup_enabled(shard.db):
+            shard.enable_dedup()
+        if header_tables_enabled(catalog) and not header_tables_enabled(shard.db):
+            shard.enable_header_tables()
+        if text_search_enabled(catalog) and not text_search_enabled(shard.db):
+            shard.enable_text_search()
+        shard.set_payload_codec(get_setting(catalog, "payload_codec"))
+
+    def file_id(self, source) -> str:
+        key = source_key(source)
+        self._sources[key] = source
+        return key
+
+    def add_row(self, rec_type: str, row: dict):
+        """Queue a row (with the file_id() of its source) for insertion into its shard"""
+        source = self._sources[row["warc_file_id"]]
+        key = shard_key(self.shard_by, row, source, self.shards)
+        shard = self.shard(key)
+        if (key, source) not in self._file_ids:
+            self._file_ids[key, source] = shard.file_id(source)
+        row["warc_file_id"] = self._file_ids[key, source]
+        shard.add_row(rec_type, row)
+        self._pending_count += 1
+
+        if not self._buffering or self._pending_count >= self._batch_size:
+            self.flush()
+
+    def checkpoint(self, source: str, **state):
+        self._checkpoints[source] = state
+
+    def ingest_state(self, source: str):
+        return self.catalog.ingest_state(source)
+
+    def flush(self):
+        shards = list(self._writers.values())
+        if len(shards) > 1:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(os.cpu_count())
+            # Raises the first error, once all flushes are done
+            list(self._executor.map(WarcDB.flush, shards))
+        else:
+            for shard in shards:
+                shard.flush()
+        self._pending_count = 0
+
+        checkpoints, self._checkpoints = self._checkpoints, {}
+        for source, state in checkpoints.items():
+            self.catalog.checkpoint(source, **state)
+        self.catalog.flush()
+
+    def defer_indexes(self):
+        """Defer the indexes of the shards written to (see warcdb.profiles)"""
+        self._defer_indexes = True
+        for shard in self._writers.values():
+            shard.defer_indexes()
+
+    def rebuild_indexes(self):
+        """Rebuild the deferred indexes of all shards, including those of earlier, interrupted imports"""
+        self.flush()
+        self._defer_indexes = False
+        for key in self.shard_keys():
+            if key not in self._writers:
+                path = os.path.join(self.path, f"{key}.warcdb")
+                if not deferred_indexes(sqlite_utils.Database(path))["sql"]:
+                    continue
+            self.shard(key).rebuild_indexes()
+
+    def __enter__(self):
+        self._buffering = True
+        for shard in self._writers.values():
+            shard.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def close(self):
+        self.flush()
+        self._buffering = False
+        for shard in self._writers.values():
+            shard.close()
+        self._writers = {}
+        self.catalog.close()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+
+class WarcDBDataset(Mapping):
+    """
+    A read-only view of a sharded dataset.
+
+    Like WarcDB, it's a mapping of record ids to records, looked up shard by shard.
+    query() runs SQL over the union of the shards that a predicate doesn't prune:
+
+        dataset = WarcDBDataset("crawls")
+        dataset.query("SELECT COUNT(*) FROM response", from_="2024-01", to="2024-03")
+
+    Every view has a `shard` column with the key of the shard a row comes from.
+    """
+
+    def __init__(self, path):
+        if not os.path.exists(os.path.join(path, CATALOG)):
+            raise ValueError(f"{path} is not a WarcDB dataset")
+        self.path = path
+        self.catalog = sqlite_utils.Database(os.path.join(path, CATALOG))
+        self.shard_by = get_setting(self.catalog, "shard_by")
+        self.host_shards = get_setting(self.catalog, "shards")
+        # Shards opened read-only, and connections attaching them, by shard keys
+        self._shards = {}
+        self._connections = {}
+
+    def _prunes(self, key, from_=None, to=None, host=None, crawl=None) -> bool:
+        """Whether a shard can't contain records matching a predicate"""
+        if self.shard_by == "month" and (from_ or to):
+            month = key.replace("-", "")
+            return (
+                key == UNDATED
+                or bool(from_ and month < timestamp14(from_)[:6])
+                or bool(to and month > timestamp14(to, "9")[:6])
+            )
+        if self.shard_by == "host" and host is not None:
+            return key != host_shard(host.lower(), self.host_shards)
+        if self.shard_by == "crawl" and crawl is not None:
+            return key != crawl
+        return False
+
+    def shards(self, **predicate) -> dict:
+        """
+        The shards (key: path) that may contain records matching a predicate:
+        from_ and to dates (e.g. 2024-01 or 20240115), a host or a crawl.
+        Parts of the predicate the dataset isn't sharded by don't prune any shard.
+        """
+        return {
+            key: os.path.join(self.path, path)
+            for key, path in self.catalog.execute(
+                f"SELECT key, path FROM [{SHARDS_TABLE}] ORDER BY key"
+            )
+            if not self._prunes(key, **predicate)
+        }
+
+    def shard(self, key) -> WarcDB:
+        """A shard, opened read-only"""
+        if key not in self._shards:
+            path = os.path.join(self.path, f"{key}.warcdb")
+            self._shards[key] = WarcDB(path, profile="readonly")
+        return self._shards[key]
+
+    def connect(self, **predicate) -> sqlite_utils.Database:
+        """
+        An in-memory database with the shards matching a predicate attached,
+        and TEMP views over the union of their tables and views.
+        Raises ValueError if there are more of them than SQLite can attach (see connections()).
+        """
+        connections = self.connections(**predicate)
+        if len(connections) > 1:
+            raise ValueError(
+                f"{len(self.shards(**predicate))} shards match, but SQLite can only attach "
+                f"{attach_limit()} at once: narrow down the query with a predicate"
+            )
+        return connections[0]
+
+    def connections(self, **predicate) -> list:
+        """
+        connect() to the shards matching a predicate,
+        in batches of as many shards as SQLite can attach to a connection.
+        """
+        shards = list(self.shards(**predicate).items())
+        limit = attach_limit()
+        return [
+            self._connect(dict(shards[i : i + limit]))
+            for i in range(0, max(len(shards), 1), limit)
+        ]
+
+    def _connect(self, shards) -> sqlite_utils.Database:
+        keys = tuple(shards)
+        if keys in self._connections:
+            return self._connections[keys]
+
+        db = sqlite_utils.Database(memory=True)
+        # All shards have the codec of the catalog
+        set_setting(db, "payload_codec", get_setting(self.catalog, "payload_codec"))
+        register_payload_function(db.conn)
+
+        # Columns of every table and view, in the order they're first seen in
+        columns, sources = {}, {}
+        for i, (key, path) in enumerate(shards.items()):
+            schema = f"shard{i}"
+            db.attach(schema, path)
+            for name in _shared_names(db, schema):
+                table_columns = columns.setdefault(name, [])
+                for row in db.execute(f"PRAGMA [{schema}].table_info([{name}])"):
+                    if row[1] not in table_columns:
+                        table_columns.append(row[1])
+                sources.setdefault(name, []).append((key, schema))
+
+        for name, table_columns in columns.items():
+            selects = []
+            for key, schema in sources[name]:
+                present = {
+                    row[1]
+                    for row in db.execute(f"PRAGMA [{schema}].table_info([{name}])")
+                }
+                select = ", ".join(
+                    f"[{c}]" if c in present else f"NULL AS [{c}]"
+                    for c in table_columns
+                )
+                selects.append(
+                    f"SELECT '{key}' AS shard, {select} FROM [{schema}].[{name}]"
+                )
+            db.execute(f"CREATE TEMP VIEW [{name}] AS {' UNION ALL '.join(selects)}")
+
+        self._connections[keys] = db
+        return db
+
+    def query(self, sql, params=None, **predicate):
+        """
+        Run a query over the shards matching a predicate, and iterate over its rows as dicts.
+        With more shards than SQLite can attach to a connection, the query runs over every batch of them
+        (see connections()), and their rows are concatenated: aggregates are then per batch.
+        """
+        for db in self.connections(**predicate):
+            yield from db.query(sql, params)
+
+    def cdxj(self, **predicate):
+        """The CDXJ lines of the captures of the shards matching a predicate, merged in sort order"""
+        return heapq.merge(
+            *(self.shard(key).cdxj() for key in self.shards(**predicate))
+        )
+
+    def payload(self, warc_record_id: str, http=None):
+        for key in self.shards():
+            shard = self.shard(key)
+            if warc_record_id in shard:
+                return shard.payload(warc_record_id, http)
+        raise KeyError(warc_record_id)
+
+    def __getitem__(self, warc_record_id):
+        for key in self.shards():
+            shard = self.shard(key)
+            if warc_record_id in shard:
+                return shard[warc_record_id]
+        raise KeyError(warc_record_id)
+
+    def __iter__(self):
+        for key in self.shards():
+            yield from self.shard(key)
+
+    def __len__(self):
+        return sum(len(self.shard(key)) for key in self.shards())
+
+    def close(self):
+        for shard in self._shards.values():
+            shard.close()
+        for db in self._connections.values():
+            db.close()
+        self._shards, self._connections = {}, {}
+
+
+def _shared_names(db, schema) -> list:
+    """
+    The tables and views of an attached shard that the dataset has views over:
+    all but the internal ones (except the record index) and full-text search tables.
+    """
+    objects = db.execute(
+        f"SELECT name, sql FROM [{schema}].sqlite_master WHERE type IN ('table', 'view')"
+    ).fetchall()
+    virtual = [
+        name for name, sql in objects if sql.upper().startswith("CREATE VIRTUAL TABLE")
+    ]
+
+    def shared(name):
+        if any(name == v or name.startswith(v + "_") for v in virtual):
+            return False
+        return name == RECORDS_TABLE or not name.startswith(("_", "sqlite_"))
+
+    return [name for name, _ in objects if shared(name)]
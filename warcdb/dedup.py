@@ -0,0 +1,94 @@
+"""
+Content-addressed payload storage.
+
+When enabled, the payloads of the DEDUP_TABLES are stored once in the payloads table,
+keyed by their digest, and the records only reference them through payload_digest.
+The records themselves live in <rec_type>_record tables,
+and a <rec_type> view joins the payload back,
+so that queries like `SELECT payload FROM response` keep working.
+"""
+
+import hashlib
+from base64 import b32encode
+
+from warcdb.codecs import get_codec
+from warcdb.settings import get_setting, set_setting
+
+DEDUP_TABLES = ["response", "resource"]
+PAYLOADS_TABLE = "payloads"
+
+
+def payload_digest(payload) -> str:
+    """Computes a digest in the same format as the WARC-Payload-Digest header"""
+    if isinstance(payload, str):
+        payload = payload.encode()
+    return "sha1:" + b32encode(hashlib.sha1(payload).digest()).decode()
+
+
+def dedup_enabled(db) -> bool:
+    return bool(get_setting(db, "payload_dedup", False))
+
+
+def create_payloads_table(db):
+    db.execute(
+        f"CREATE TABLE IF NOT EXISTS [{PAYLOADS_TABLE}] (digest TEXT PRIMARY KEY, payload BLOB)"
+    )
+
+
+def storage_table(db, rec_type) -> str:
+    """Name of the table that actually stores the records of a rec_type"""
+    if rec_type in DEDUP_TABLES and dedup_enabled(db):
+        return f"{rec_type}_record"
+    return rec_type
+
+
+def enable_dedup(db):
+    """
+    Convert a database to deduplicated payload storage.
+    Existing payloads are moved into the payloads table.
+    This is a no-op if dedup is already enabled.
+    """
+    if dedup_enabled(db):
+        return
+
+    # Digests are computed over uncompressed payloads
+    codec = get_codec(get_setting(db, "payload_codec"))
+    db.conn.create_function(
+        "payload_digest",
+        1,
+        lambda payload: payload_digest(codec.decompress(payload)),
+        deterministic=True,
+    )
+
+    with db.conn:
+        db.execute("BEGIN")
+        create_payloads_table(db)
+        for rec_type in DEDUP_TABLES:
+            record_table = f"{rec_type}_record"
+            digest = "payload_digest(payload)"
+            if "warc_payload_digest" in db[rec_type].columns_dict:
+                digest = f"COALESCE(warc_payload_digest, {digest})"
+
+            # Large payloads are already stored by digest (see warcdb.blobs)
+            if "payload_digest" not in db[rec_type].columns_dict:
+                db.execute(f"ALTER TABLE [{rec_type}] ADD COLUMN payload_digest TEXT")
+            db.execute(
+                f"UPDATE [{rec_type}] SET payload_digest = {digest} WHERE payload IS NOT NULL"
+            )
+            db.execute(f"""
+                INSERT OR IGNORE INTO [{PAYLOADS_TABLE}] (digest, payload)
+                SELECT payload_digest, payload FROM [{rec_type}]
+                WHERE payload_digest IS NOT NULL
+                """)
+            db.execute(f"ALTER TABLE [{rec_type}] DROP COLUMN payload")
+            db.execute(f"ALTER TABLE [{rec_type}] RENAME TO [{record_table}]")
+            db.execute(
+                f"CREATE INDEX IF NOT EXISTS [idx_{record_table}_payload_digest] ON [{record_table}] (payload_digest)"
+            )
+            db.execute(f"""
+                CREATE VIEW [{rec_type}] AS
+                SELECT record.*, p.payload
+                FROM [{record_table}] AS record
+                LEFT JOIN [{PAYLOADS_TABLE}] AS p ON p.digest = record.payload_digest
+                """)
+        set_setting(db, "payload_dedup", 1)
@@ -0,0 +1,122 @@
+"""
+Columns derived from record headers, so that lookups by URL, host and date can use indexes.
+
+* surt: the target URI, canonicalized into a Sort-friendly URI Reordering Transform
+  (e.g. https://www.Example.com/a?b=1&a=2 -> com,example)/a?a=2&b=1),
+  so that all captures of a URL, or of a host, are next to each other in its index
+* host: the hostname of the target URI
+* registered_domain: the domain the host belongs to, e.g. example.co.uk for www.example.co.uk
+* date_epoch: the WARC-Date as seconds since the epoch
+"""
+
+import calendar
+import re
+import time
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+from warcdb.sources import timestamp14
+
+DERIVED_COLUMNS = {
+    "surt": str,
+    "host": str,
+    "registered_domain": str,
+    "date_epoch": int,
+}
+
+# Tables with a WARC-Target-URI, and the indexes of the capture tables among them
+URI_TABLES = ["request", "response", "metadata", "resource"]
+DERIVED_INDEXES = {
+    "response": [
+        ["surt", "date_epoch"],
+        ["host", "date_epoch"],
+        ["registered_domain", "date_epoch"],
+        ["http_status", "date_epoch"],
+        ["date_epoch"],
+    ],
+    "resource": [
+        ["surt", "date_epoch"],
+        ["host", "date_epoch"],
+        ["registered_domain", "date_epoch"],
+        ["date_epoch"],
+    ],
+    "revisit": [
+        ["surt", "date_epoch"],
+        ["date_epoch"],
+    ],
+}
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+# Second-level labels under which ccTLDs register domains (e.g. co.uk, com.au).
+# There's no public suffix list to check against, so this is a heuristic.
+SECOND_LEVEL_LABELS = {"ac", "co", "com", "edu", "gov", "net", "org", "ne", "or", "go"}
+
+_IPV4 = re.compile(r"^\d+\.\d+\.\d+\.\d+$")
+
+
+def url_host(url: str):
+    """The lowercased hostname of a URL, or None if it has none (e.g. dns: or urn: URIs)"""
+    try:
+        return urlsplit(url).hostname or None
+    except ValueError:
+        return None
+
+
+def registered_domain(host: str):
+    """The registered domain of a host (e.g. www.bbc.co.uk -> bbc.co.uk)"""
+    if not host or _IPV4.match(host) or ":" in host:
+        return host
+    labels = host.rstrip(".").split(".")
+    size = 2
+    if len(labels) > 2 and len(labels[-1]) == 2 and labels[-2] in SECOND_LEVEL_LABELS:
+        size = 3
+    return ".".join(labels[-size:])
+
+
+def surt(url: str):
+    """
+    The SURT form of a URL: lowercased, with the host's labels reversed and www. dropped,
+    without default ports or fragments, and with sorted query parameters.
+    URIs without a host are only lowercased.
+    """
+    try:
+        parts = urlsplit(url.strip())
+        host, port = parts.hostname, parts.port
+    except ValueError:
+        return url.lower()
+    if not host:
+        return url.lower()
+
+    host = re.sub(r"^www\d*\.", "", host.rstrip("."))
+    if not _IPV4.match(host):
+        host = ",".join(reversed(host.split(".")))
+    if port and port != DEFAULT_PORTS.get(parts.scheme.lower()):
+        host += f":{port}"
+
+    path = parts.path or "/"
+    query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+    return f"{host}){path}{'?' + query if query else ''}".lower()
+
+
+def date_epoch(warc_date: str):
+    """Seconds since the epoch of a WARC-Date (e.g. 2023-10-20T12:22:47Z)"""
+    if not warc_date:
+        return None
+    try:
+        return calendar.timegm(time.strptime(timestamp14(warc_date), "%Y%m%d%H%M%S"))
+    except ValueError:
+        return None
+
+
+def derived_columns(row: dict) -> dict:
+    """The derived columns of a record row"""
+    columns = (
+        {"date_epoch": date_epoch(row["warc_date"])} if row.get("warc_date") else {}
+    )
+    uri = row.get("warc_target_uri")
+    if uri:
+        host = url_host(uri)
+        columns.update(
+            surt=surt(uri), host=host, registered_domain=registered_domain(host)
+        )
+    return columns
@@ -0,0 +1,121 @@
+"""
+Export of records back into WARC files.
+
+Records are rebuilt from their row: WARC headers from the columns, HTTP headers from http_headers,
+and the payload from the database (or the source WARC, in reference mode).
+Payloads are stored decoded (de-chunked and decompressed),
+so Transfer-Encoding and Content-Encoding headers are dropped, and lengths and digests recomputed.
+"""
+
+import heapq
+import io
+import sqlite3
+
+from warcio.recordloader import ArcWarcRecord
+from warcio.warcwriter import WARCWriter
+
+from warcdb.records import LazyRecord
+
+EXPORT_TABLES = [
+    "warcinfo",
+    "request",
+    "response",
+    "metadata",
+    "resource",
+    "revisit",
+    "conversion",
+    "continuation",
+]
+
+# HTTP headers describing an encoding of the body that's undone on import
+DECODED_HEADERS = ["Transfer-Encoding", "Content-Encoding"]
+
+
+def _table_rows(db, rec_type, where=None, params=None):
+    """
+    The rows of a table matching a condition, in the order they were read from their WARC files.
+    The query runs right away, so a condition referring to columns the table doesn't have raises.
+    """
+    sql = f"SELECT * FROM [{rec_type}]"
+    if where:
+        sql += f" WHERE {where}"
+    if "warc_offset" in db[rec_type].columns_dict:
+        # Read from the (warc_file_id, warc_offset) index, rather than sorted (see m015)
+        sql += " ORDER BY warc_file_id, warc_offset"
+    cursor = db.execute(sql, params or {})
+    columns = [d[0] for d in cursor.description]
+    return ((rec_type, dict(zip(columns, values))) for values in cursor)
+
+
+def _warc_order(item):
+    _, row = item
+    file_id, offset = row.get("warc_file_id"), row.get("warc_offset")
+    return file_id is not None, file_id or 0, offset or 0
+
+
+def iter_export_rows(db, where=None, params=None):
+    """
+    Stream the (rec_type, row) of all records matching a condition, in WARC order:
+    the tables are read in (warc_file_id, warc_offset) order and merged, one row at a time.
+    Tables that don't have the columns the condition refers to are skipped,
+    but if none has them (e.g. a misspelled column), the error is raised.
+    """
+    tables = [rec_type for rec_type in EXPORT_TABLES if db[rec_type].exists()]
+    rows, error = [], None
+    for rec_type in tables:
+        try:
+            rows.append(_table_rows(db, rec_type, where, params))
+        except sqlite3.OperationalError as e:
+            if "no such column" not in str(e):
+                raise
+            error = e
+    if tables and not rows:
+        raise error
+    yield from heapq.merge(*rows, key=_warc_order)
+
+
+def rebuild_record(warcdb, rec_type, row) -> ArcWarcRecord:
+    """An ArcWarcRecord, ready to be written, rebuilt from its row"""
+    stored = row.pop("payload", None)
+    record = LazyRecord(
+        rec_type, row, lambda: warcdb.payload(row["warc_record_id"]) or b""
+    )
+    if stored is not None:
+        payload = warcdb.decode_payload(stored)
+    elif rec_type == "revisit":
+        # Revisits are written without a body, so there's no need to resolve it
+        payload = b""
+    else:
+        payload = record.payload()
+
+    http_headers = record.http_headers
+    if http_headers and rec_type != "revisit":
+        if any(http_headers.get_header(h) for h in DECODED_HEADERS):
+            for h in DECODED_HEADERS:
+                http_headers.remove_header(h)
+            http_headers.replace_header("Content-Length", str(len(payload)))
+
+    # Without a length, the writer recomputes it along with the digests
+    return ArcWarcRecord(
+        "warc",
+        rec_type,
+        record.rec_headers,
+        io.BytesIO(payload),
+        http_headers,
+        record.content_type,
+        None,
+    )
+
+
+def export_warc(warcdb, output, where=None, params=None, gzip=True):
+    """
+    Write the records matching a condition to a WARC file object.
+    With gzip, every record is a separate gzip member, so the output can be seeked into.
+    Returns the number of records written.
+    """
+    writer = WARCWriter(output, gzip=gzip)
+    count = 0
+    for rec_type, row in iter_export_rows(warcdb.db, where, params):
+        writer.write_record(rebuild_record(warcdb, rec_type, row))
+        count += 1
+    return count
@@ -0,0 +1,63 @@
+"""
+Materialized HTTP header tables.
+
+The v_request_http_header / v_response_http_header views extract headers from the http_headers JSON
+of every record on every query. When header tables are enabled,
+headers are also stored as (warc_record_id, position, name, value) rows in <rec_type>_http_header tables,
+indexed on name and (name, value), and the views read from those instead.
+"""
+
+import json
+
+from warcdb.dedup import storage_table
+from warcdb.settings import get_setting, set_setting
+
+HEADER_TABLES = {
+    "request": "request_http_header",
+    "response": "response_http_header",
+}
+
+
+def header_tables_enabled(db) -> bool:
+    return bool(get_setting(db, "http_header_tables", False))
+
+
+def header_rows(row: dict) -> list:
+    """The header table rows of a record row, as (warc_record_id, position, name, value) tuples"""
+    if not row.get("http_headers"):
+        return []
+    return [
+        (row["warc_record_id"], position, h["header"].lower(), h["value"])
+        for position, h in enumerate(json.loads(row["http_headers"]))
+    ]
+
+
+def backfill_header_tables(db):
+    """
+    Fill the header tables from the http_headers of the records already in the database,
+    and point the header views to them.
+    Records that already have their headers in the tables are skipped, so this can be run repeatedly.
+    """
+    with db.conn:
+        db.execute("BEGIN")
+        for rec_type, header_table in HEADER_TABLES.items():
+            record_table = storage_table(db, rec_type)
+            db.execute(f"""
+                INSERT OR IGNORE INTO [{header_table}] (warc_record_id, position, name, value)
+                SELECT
+                    record.warc_record_id,
+                    header.key,
+                    LOWER(JSON_EXTRACT(header.value, '$.header')),
+                    JSON_EXTRACT(header.value, '$.value')
+                FROM [{record_table}] AS record, JSON_EACH(record.http_headers) AS header
+                WHERE record.http_headers IS NOT NULL
+                """)
+
+            view = f"v_{rec_type}_http_header"
+            db.execute(f"DROP VIEW IF EXISTS [{view}]")
+            db.execute(f"""
+                CREATE VIEW [{view}] AS
+                SELECT warc_record_id, name, value
+                FROM [{header_table}]
+                """)
+        set_setting(db, "http_header_tables", 1)
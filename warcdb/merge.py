@@ -0,0 +1,311 @@
+"""
+Merging databases, and compacting them for serving.
+
+merge_databases() combines WarcDB files (e.g. one per crawler node) without going back to their WARCs:
+each input is ATTACHed in turn, and copied with set-based INSERT OR IGNORE ... SELECT statements,
+in a single transaction. Inputs with an older schema than the output's are merged from a migrated copy,
+which leaves them as they are. Records are deduplicated on their warc_record_id,
+and payloads stored in the payloads table (with --dedup, or large ones) on their digest.
+A new output takes the storage settings of its inputs (see _copy_settings()); the payloads of inputs
+with another codec are recompressed, and moved into the payloads table if the output is deduplicated.
+Secondary indexes and full-text search triggers are dropped during the merge, and built once at the end.
+
+compact() rewrites a database for read-mostly serving: the rows of the capture tables are renumbered
+in (surt, date_epoch) order, so that VACUUM lays out the captures of a URL on neighbouring pages
+(full-text search indexes over them, keyed by rowid, are rebuilt),
+full-text search indexes are merged into a single segment, and the query planner's statistics are gathered.
+"""
+
+import os
+import tempfile
+
+import sqlite_utils
+
+from warcdb import (
+    FILES_TABLE,
+    INGEST_LOG_TABLE,
+    RECORD_TABLES,
+    RECORDS_TABLE,
+    WarcDB,
+)
+from warcdb.cdx import CAPTURE_TABLES
+from warcdb.codecs import encode_payload, get_codec
+from warcdb.dedup import (
+    PAYLOADS_TABLE,
+    create_payloads_table,
+    dedup_enabled,
+    payload_digest,
+    storage_table,
+)
+from warcdb.headers import backfill_header_tables, header_tables_enabled
+from warcdb.migrations import migration
+from warcdb.profiles import defer_indexes, rebuild_indexes
+from warcdb.settings import get_setting
+from warcdb.text import TEXT_TABLE, enable_text_search, text_search_enabled
+
+MERGED = "merged"
+
+
+def _columns(db, schema, table) -> dict:
+    """The columns of a table or view in a schema, mapped to their declared types"""
+    return {
+        row[1]: row[2] for row in db.execute(f"PRAGMA [{schema}].table_info([{table}])")
+    }
+
+
+def _exists(db, schema, name) -> bool:
+    return (
+        db.execute(
+            f"SELECT 1 FROM [{schema}].sqlite_master WHERE name = ? AND type IN ('table', 'view')",
+            [name],
+        ).fetchone()
+        is not None
+    )
+
+
+def _copy_settings(db: WarcDB, paths):
+    """
+    Give a new output the storage settings of its inputs:
+    the codec of the first one, and dedup, header tables and full-text search if any has them.
+    """
+    sources = [sqlite_utils.Database(path) for path in paths]
+    if any(dedup_enabled(source) for source in sources):
+        db.enable_dedup()
+    if any(header_tables_enabled(source) for source in sources):
+        db.enable_header_tables()
+    if any(text_search_enabled(source) for source in sources):
+        db.enable_text_search()
+    db.set_payload_codec(get_setting(sources[0], "payload_codec"))
+    for source in sources:
+        source.close()
+
+
+def _merge_records(db, rec_type, payload, digest):
+    """
+    Copy the records of a rec_type from the attached input.
+    payload and digest are the SQL expressions of their (recompressed) payload and its digest.
+    """
+    target = storage_table(db, rec_type)
+    source_columns = _columns(db, MERGED, rec_type)
+    target_columns = _columns(db, "main", target)
+    deduplicated = target != rec_type
+
+    # The output gains the columns only the input has
+    for column, type_ in source_columns.items():
+        if column not in target_columns and column != "payload":
+            db.execute(f"ALTER TABLE [{target}] ADD COLUMN [{column}] {type_}")
+
+    expressions = {}
+    for column in source_columns:
+        if column == "payload":
+            if not deduplicated:
+                expressions[column] = payload
+        elif column == "warc_file_id":
+            # Ids are the output's ones, of the same source
+            expressions[column] = f"""(
+                SELECT f.id FROM main.[{FILES_TABLE}] AS f
+                JOIN [{MERGED}].[{FILES_TABLE}] AS m ON m.source = f.source
+                WHERE m.id = r.warc_file_id
+            )"""
+        else:
+            expressions[column] = f"r.[{column}]"
+
+    if deduplicated:
+        digests = [
+            f"r.[{c}]"
+            for c in ("payload_digest", "warc_payload_digest")
+            if c in source_columns
+        ]
+        digest = f"COALESCE({', '.join([*digests, digest])})"
+        expressions["payload_digest"] = digest
+        db.execute(f"""
+            INSERT OR IGNORE INTO main.[{PAYLOADS_TABLE}] (digest, payload)
+            SELECT {digest}, {payload} FROM [{MERGED}].[{rec_type}] AS r
+            WHERE r.payload IS NOT NULL
+            AND r.warc_record_id NOT IN (SELECT warc_record_id FROM main.[{target}])
+            """)
+
+    db.execute(f"""
+        INSERT OR IGNORE INTO main.[{target}] ({', '.join(f'[{c}]' for c in expressions)})
+        SELECT {', '.join(expressions.values())} FROM [{MERGED}].[{rec_type}] AS r
+        """)
+
+
+def _copy_rows(db, table, key_columns=None):
+    """Copy the rows of a table the input and the output have, on the columns they share"""
+    if not _exists(db, MERGED, table) or not _exists(db, "main", table):
+        return
+    shared = [
+        c
+        for c in _columns(db, MERGED, table)
+        if c in _columns(db, "main", table) and c not in (key_columns or [])
+    ]
+    columns = ", ".join(f"[{c}]" for c in shared)
+    db.execute(
+        f"INSERT OR IGNORE INTO main.[{table}] ({columns}) SELECT {columns} FROM [{MERGED}].[{table}]"
+    )
+
+
+def _outdated(db, source) -> bool:
+    """Whether an input lacks migrations the output has"""
+    applied = set()
+    if source[migration.migrations_table].exists():
+        applied = {
+            row["name"]
+            for row in source[migration.migrations_table].rows_where(
+                "migration_set = ?", [migration.name]
+            )
+        }
+    return any(m.name not in applied for m in migration.applied(db))
+
+
+def _count_records(db) -> int:
+    return sum(
+        db[storage_table(db, rec_type)].count
+        for rec_type in RECORD_TABLES
+        if db[storage_table(db, rec_type)].exists()
+    )
+
+
+def merge_database(db: WarcDB, path) -> int:
+    """Merge a single database into another, and return the number of records it added"""
+    db.flush()
+    source = sqlite_utils.Database(path)
+    if _outdated(db.db, source):
+        # Its records need the derived columns, ids... the migrations add
+        with tempfile.TemporaryDirectory() as directory:
+            copy_path = os.path.join(directory, os.path.basename(path))
+            source.execute("VACUUM INTO ?", [copy_path])
+            source.close()
+            copy = sqlite_utils.Database(copy_path)
+            migration.apply(copy)
+            copy.close()
+            return merge_database(db, copy_path)
+    source_codec = get_codec(get_setting(source, "payload_codec"))
+    source_deduplicated = dedup_enabled(source)
+    source.close()
+    codec = get_codec(get_setting(db.db, "payload_codec"))
+    output_deduplicated = dedup_enabled(db.db)
+
+    payload = "r.payload"
+    if codec.name != source_codec.name:
+
+        def recode(value):
+            if isinstance(value, str):
+                return encode_payload(codec, value)
+            return encode_payload(codec, source_codec.decompress(value))
+
+        db.db.conn.create_function("warcdb_merge_payload", 1, recode)
+        payload = "warcdb_merge_payload(r.payload)"
+
+    # Digests are computed over uncompressed payloads, like with enable_dedup()
+    db.db.conn.create_function(
+        "warcdb_merge_digest",
+        1,
+        lambda value: value and payload_digest(source_codec.decompress(value)),
+        deterministic=True,
+    )
+
+    db.db.attach(MERGED, path)
+    try:
+        with db.db.conn:
+            db.db.execute("BEGIN")
+            before = _count_records(db.db)
+            _copy_rows(db.db, FILES_TABLE, key_columns=["id"])
+            # The payloads of deduplicated inputs come with their records when the output isn't
+            if _exists(db.db, MERGED, PAYLOADS_TABLE) and (
+                output_deduplicated or not source_deduplicated
+            ):
+                create_payloads_table(db.db)
+                db.db.execute(f"""
+                    INSERT OR IGNORE INTO main.[{PAYLOADS_TABLE}] (digest, payload)
+                    SELECT digest, {payload} FROM [{MERGED}].[{PAYLOADS_TABLE}] AS r
+                    """)
+            for rec_type in RECORD_TABLES:
+                if _exists(db.db, MERGED, rec_type):
+                    _merge_records(
+                        db.db, rec_type, payload, "warcdb_merge_digest(r.payload)"
+                    )
+            _copy_rows(db.db, RECORDS_TABLE)
+            _copy_rows(db.db, INGEST_LOG_TABLE)
+            # Extracted text, rather than extracting it again
+            _copy_rows(db.db, TEXT_TABLE, key_columns=["id"])
+            after = _count_records(db.db)
+    finally:
+        db.db.execute(f"DETACH DATABASE [{MERGED}]")
+    return after - before
+
+
+def merge_databases(db: WarcDB, paths) -> dict:
+    """
+    Merge databases into another one, and return the number of records each added.
+    Header tables and full-text search are filled in for the records of inputs that didn't have them.
+    """
+    migration.apply(db.db)
+    if not len(db):
+        _copy_settings(db, paths)
+
+    defer_indexes(db.db)
+    added = {path: merge_database(db, path) for path in paths}
+    if header_tables_enabled(db.db):
+        backfill_header_tables(db.db)
+    if text_search_enabled(db.db):
+        enable_text_search(db.db)
+    rebuild_indexes(db.db)
+    return added
+
+
+def cluster(db, table, order=("surt", "date_epoch")):
+    """
+    Renumber the rows of a table in the order of some columns, so that VACUUM writes them in that order.
+    Records are referred to by warc_record_id, but full-text search indexes over the table
+    (e.g. of `warcdb enable-fts`) are keyed by rowid, so they are rebuilt.
+    """
+    order_by = ", ".join(f"[{c}]" for c in order)
+    with db.conn:
+        db.execute("BEGIN")
+        db.execute(
+            "CREATE TEMP TABLE _warcdb_cluster (old INTEGER PRIMARY KEY, new INTEGER)"
+        )
+        db.execute(f"""
+            INSERT INTO temp._warcdb_cluster (old, new)
+            SELECT rowid, ROW_NUMBER() OVER (ORDER BY {order_by}, rowid) FROM [{table}]
+            """)
+        # In two steps, so that new rowids never collide with old ones
+        db.execute(f"""
+            UPDATE [{table}] SET rowid = -(
+                SELECT new FROM temp._warcdb_cluster WHERE old = [{table}].rowid
+            )
+            """)
+        db.execute(f"UPDATE [{table}] SET rowid = -rowid")
+        db.execute("DROP TABLE temp._warcdb_cluster")
+        if db[table].detect_fts():
+            db[table].rebuild_fts()
+
+
+def compact(db: sqlite_utils.Database, output=None, page_size=None):
+    """
+    Rewrite a database for read-mostly serving, in place, or into an output file (leaving it as it is).
+    page_size changes the page size, which requires leaving WAL mode.
+    """
+    if output:
+        db.execute("VACUUM INTO ?", [output])
+        copy = sqlite_utils.Database(output)
+        compact(copy, page_size=page_size)
+        copy.close()
+        return
+
+    rebuild_indexes(db)
+    for rec_type in CAPTURE_TABLES:
+        table = storage_table(db, rec_type)
+        if db[table].exists():
+            cluster(db, table)
+    with db.conn:
+        for table in db.tables:
+            if table.detect_fts():
+                table.optimize()
+        db.analyze()
+    if page_size:
+        db.execute("PRAGMA journal_mode = delete")
+        db.execute(f"PRAGMA page_size = {int(page_size)}")
+    db.vacuum()
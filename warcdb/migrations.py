@@ -1,5 +1,16 @@
 from sqlite_migrate import Migrations
 
+from warcdb.dedup import DEDUP_TABLES, storage_table
+from warcdb.derived import (
+    DERIVED_COLUMNS,
+    DERIVED_INDEXES,
+    URI_TABLES,
+    date_epoch,
+    registered_domain,
+    surt,
+    url_host,
+)
+
 migration = Migrations("warcdb")
 
 
@@ -124,3 +135,256 @@ def m002_headers(db):
 @migration()
 def m003_status(db):
     db["response"].add_column("http_status", int)
+
+
+@migration()
+def m004_payload_blob(db):
+    """Payloads are raw bytes, so declare them as BLOBs"""
+    # transform() rebuilds the tables, which fails while views reference them
+    views = {view.name: view.schema for view in db.views}
+    for name in views:
+        db[name].drop()
+
+    for table in db.tables:
+        if table.columns_dict.get("payload") is str:
+            table.transform(types={"payload": bytes})
+
+    for schema in views.values():
+        db.execute(schema)
+
+
+@migration()
+def m005_ingest_log(db):
+    db["_warcdb_ingest_log"].create(
+        {
+            "source": str,
+            "size": int,
+            "digest": str,
+            "offset": int,
+            "records": int,
+            "completed": int,
+            "updated_at": str,
+        },
+        pk="source",
+    )
+
+
+@migration()
+def m006_ingest_log_filter(db):
+    db["_warcdb_ingest_log"].add_column("record_filter", str)
+
+
+@migration()
+def m007_record_location(db):
+    """Where each record was read from, to load its payload back lazily"""
+    db["warc_file"].create(
+        {"id": int, "source": str, "path": str, "wacz_member": str},
+        pk="id",
+    )
+    db["warc_file"].create_index(["source"], unique=True)
+    for rec_type in ["warcinfo", "request", "response", "metadata", "resource"]:
+        table = db[storage_table(db, rec_type)]
+        table.add_column("warc_file_id", int)
+        table.add_column("warc_offset", int)
+        table.add_column("warc_length", int)
+
+
+@migration()
+def m008_records(db):
+    """Index of every record id and its rec_type, to look records up by id alone"""
+    db["_warcdb_records"].create(
+        {"warc_record_id": str, "rec_type": str},
+        pk="warc_record_id",
+        if_not_exists=True,
+    )
+    for rec_type in ["warcinfo", "request", "response", "metadata", "resource"]:
+        if db[rec_type].exists():
+            db.execute(
+                f"INSERT OR IGNORE INTO _warcdb_records SELECT warc_record_id, ? FROM [{rec_type}]",
+                [rec_type],
+            )
+
+
+@migration()
+def m009_http_header_tables(db):
+    """Tables the HTTP headers are materialized into, once enabled (see warcdb.headers)"""
+    for header_table in ["request_http_header", "response_http_header"]:
+        db[header_table].create(
+            {"warc_record_id": str, "position": int, "name": str, "value": str},
+            pk=("warc_record_id", "position"),
+        )
+        db[header_table].create_index(["name"])
+        db[header_table].create_index(["name", "value"])
+
+
+@migration()
+def m010_derived_columns(db):
+    """SURT, host, registered domain and epoch columns, and indexes for lookups by them"""
+    db.conn.create_function("surt", 1, surt, deterministic=True)
+    db.conn.create_function("url_host", 1, url_host, deterministic=True)
+    db.conn.create_function(
+        "registered_domain", 1, registered_domain, deterministic=True
+    )
+    db.conn.create_function("date_epoch", 1, date_epoch, deterministic=True)
+
+    for rec_type in ["warcinfo", "request", "response", "metadata", "resource"]:
+        table = db[storage_table(db, rec_type)]
+        columns = ["date_epoch"]
+        if rec_type in URI_TABLES:
+            columns += ["surt", "host", "registered_domain"]
+        for column in columns:
+            table.add_column(column, DERIVED_COLUMNS[column])
+
+        with db.conn:
+            db.execute(f"UPDATE [{table.name}] SET date_epoch = date_epoch(warc_date)")
+            if rec_type in URI_TABLES:
+                db.execute(f"""
+                    UPDATE [{table.name}] SET
+                        surt = surt(warc_target_uri),
+                        host = url_host(warc_target_uri),
+                        registered_domain = registered_domain(url_host(warc_target_uri))
+                    WHERE warc_target_uri IS NOT NULL
+                    """)
+        for columns in DERIVED_INDEXES.get(rec_type, []):
+            table.create_index(columns, if_not_exists=True)
+
+
+@migration()
+def m011_http_status_line(db):
+    for rec_type in ["request", "response"]:
+        db[storage_table(db, rec_type)].add_column("http_status_line", str)
+
+
+@migration()
+def m012_revisit_conversion_continuation(db):
+    """Tables for the remaining WARC 1.1 record types"""
+    common = {
+        "warc_type": str,
+        "warc_record_id": str,
+        "warc_warcinfo_id": str,
+        "warc_target_uri": str,
+        "warc_date": str,
+        "warc_block_digest": str,
+        "content_type": str,
+        "content_length": int,
+        "payload": bytes,
+        **DERIVED_COLUMNS,
+        "warc_file_id": int,
+        "warc_offset": int,
+        "warc_length": int,
+    }
+    db["revisit"].create(
+        {
+            **common,
+            "warc_concurrent_to": str,
+            "warc_ip_address": str,
+            "warc_payload_digest": str,
+            "warc_profile": str,
+            "warc_refers_to": str,
+            "warc_refers_to_target_uri": str,
+            "warc_refers_to_date": str,
+            "http_headers": str,
+            "http_status": int,
+            "http_status_line": str,
+        },
+        pk="warc_record_id",
+        foreign_keys=[("warc_warcinfo_id", "warcinfo", "warc_record_id")],
+    )
+    db["conversion"].create(
+        {**common, "warc_payload_digest": str, "warc_refers_to": str},
+        pk="warc_record_id",
+        foreign_keys=[("warc_warcinfo_id", "warcinfo", "warc_record_id")],
+    )
+    db["continuation"].create(
+        {
+            **common,
+            "warc_segment_origin_id": str,
+            "warc_segment_number": int,
+            "warc_segment_total_length": int,
+        },
+        pk="warc_record_id",
+        foreign_keys=[("warc_warcinfo_id", "warcinfo", "warc_record_id")],
+    )
+    for columns in DERIVED_INDEXES["revisit"]:
+        db["revisit"].create_index(columns)
+
+    # Revisits are resolved to the original payload by its digest
+    for rec_type in ["response", "resource"]:
+        table = db[storage_table(db, rec_type)]
+        if "warc_payload_digest" not in table.columns_dict:
+            table.add_column("warc_payload_digest", str)
+        table.create_index(["warc_payload_digest"], if_not_exists=True)
+
+
+@migration()
+def m013_response_text(db):
+    """Text extracted from responses for full-text search, once enabled (see warcdb.text)"""
+    db["response_text"].create(
+        {"id": int, "warc_record_id": str, "title": str, "text": str}, pk="id"
+    )
+    db["response_text"].create_index(["warc_record_id"], unique=True)
+
+
+@migration()
+def m014_imports(db):
+    """A summary of every import, with its full stats report (see warcdb.stats)"""
+    db["_warcdb_imports"].create(
+        {
+            "id": int,
+            "started_at": str,
+            "finished_at": str,
+            "seconds": float,
+            "sources": int,
+            "records": int,
+            "payload_bytes": int,
+            "duplicates_ignored": int,
+            "peak_rss_mb": float,
+            "stats": str,
+        },
+        pk="id",
+    )
+
+
+@migration()
+def m015_record_location_index(db):
+    """Indexes to read records in the order of their WARC files (see warcdb.export)"""
+    for rec_type in [
+        "warcinfo",
+        "request",
+        "response",
+        "metadata",
+        "resource",
+        "revisit",
+        "conversion",
+        "continuation",
+    ]:
+        table = db[storage_table(db, rec_type)]
+        if table.exists() and "warc_file_id" in table.columns_dict:
+            table.create_index(["warc_file_id", "warc_offset"], if_not_exists=True)
+
+
+@migration()
+def m016_date_epoch_index(db):
+    """Indexes to read every record table in date order (see warcdb.parquet)"""
+    for rec_type in [
+        "warcinfo",
+        "request",
+        "response",
+        "metadata",
+        "resource",
+        "revisit",
+        "conversion",
+        "continuation",
+    ]:
+        table = db[storage_table(db, rec_type)]
+        if table.exists() and "date_epoch" in table.columns_dict:
+            table.create_index(["date_epoch"], if_not_exists=True)
+
+
+@migration()
+def m017_payload_digest_index(db):
+    """Indexes to tell whether a payload is still referenced, when deleting records (see WarcDB.__delitem__)"""
+    for rec_type in DEDUP_TABLES:
+        table = db[storage_table(db, rec_type)]
+        if table.exists() and "payload_digest" in table.columns_dict:
+            table.create_index(["payload_digest"], if_not_exists=True)
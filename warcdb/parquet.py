@@ -0,0 +1,248 @@
+"""
+Columnar export of the record tables into Parquet files, for analytics engines (DuckDB, Polars, Spark...).
+
+Every table is read with a plain cursor, in record batches of a fixed number of rows,
+which are converted column by column into Arrow arrays and written as Parquet row groups:
+memory use is bounded by the batch size, whatever the size of the database.
+Columns are typed from their declared SQLite types, except for:
+
+* warc_date (and warc_refers_to_date): UTC timestamps, rather than strings
+* http_status: 32-bit integers
+* payload: the decompressed payload, as binary (large payloads are read from the payloads table)
+
+Files are partitioned by table and by the month (or day) of their records, in Hive style,
+so that engines can skip partitions a date predicate rules out:
+
+    DIR/response/date=2022-06/part-0.parquet
+
+Rows are read in the order of the date_epoch index, so only one partition is being written at a time.
+pyarrow is an optional dependency: pip install warcdb[parquet]
+"""
+
+import os
+
+from warcdb.codecs import get_codec
+from warcdb.dedup import PAYLOADS_TABLE
+from warcdb.derived import date_epoch
+from warcdb.export import EXPORT_TABLES
+from warcdb.settings import get_setting
+
+PARQUET_BATCH_SIZE = 10_000
+PARQUET_COMPRESSIONS = ["zstd", "snappy", "gzip", "none"]
+# Partition: strftime() format of its date
+PARTITIONS = {"month": "%Y-%m", "day": "%Y-%m-%d", "none": None}
+UNDATED = "undated"
+
+TIMESTAMP_COLUMNS = ["warc_date", "warc_refers_to_date"]
+
+
+def _pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ValueError(
+            "Parquet export requires the pyarrow package: pip install warcdb[parquet]"
+        )
+    return pyarrow
+
+
+def arrow_type(pa, column, declared_type):
+    """The Arrow type of a column, from its name and declared SQLite type"""
+    if column in TIMESTAMP_COLUMNS:
+        return pa.timestamp("us", tz="UTC")
+    if column == "http_status":
+        return pa.int32()
+    if column == "payload":
+        return pa.large_binary()
+    declared_type = (declared_type or "").upper()
+    if "INT" in declared_type:
+        return pa.int64()
+    if any(t in declared_type for t in ("REAL", "FLOA", "DOUB")):
+        return pa.float64()
+    if "BLOB" in declared_type:
+        return pa.binary()
+    return pa.string()
+
+
+def timestamp_array(pa, values):
+    """
+    WARC dates as UTC timestamps.
+    Dates Arrow can't parse (e.g. without a time) are parsed like date_epoch, to the second.
+    """
+    strings = pa.array(values, pa.string())
+    type_ = pa.timestamp("us", tz="UTC")
+    try:
+        return strings.cast(type_)
+    except pa.ArrowInvalid:
+        seconds = [date_epoch(v) for v in values]
+        return pa.array(
+            [s * 1_000_000 if s is not None else None for s in seconds], pa.int64()
+        ).cast(type_)
+
+
+def _table_query(db, table, payloads, partition_format):
+    """The SELECT statement of a table's rows, in partition order, and the columns it returns"""
+    columns = {row[1]: row[2] for row in db.execute(f"PRAGMA table_info([{table}])")}
+    expressions = {}
+    for column in columns:
+        if column == "payload":
+            if not payloads:
+                continue
+            expression = "r.payload"
+            # Large payloads are stored by digest (see warcdb.blobs)
+            if "payload_digest" in columns and db[PAYLOADS_TABLE].exists():
+                expression = f"""COALESCE(r.payload, (
+                    SELECT p.payload FROM [{PAYLOADS_TABLE}] AS p WHERE p.digest = r.payload_digest
+                ))"""
+            expressions[column] = expression
+        else:
+            expressions[column] = f"r.[{column}]"
+
+    sql = f"SELECT {', '.join(expressions.values())}"
+    if partition_format and "date_epoch" in columns:
+        sql += f", strftime('{partition_format}', r.date_epoch, 'unixepoch')"
+        sql += f" FROM [{table}] AS r"
+        # Only in date order if it can be read from the date_epoch index (see m016),
+        # as sorting would hold the whole table. Partitions are otherwise written in several parts.
+        ordered = sql + " ORDER BY r.date_epoch"
+        plan = db.execute(f"EXPLAIN QUERY PLAN {ordered}").fetchall()
+        if not any("TEMP B-TREE" in row[-1] for row in plan):
+            sql = ordered
+    else:
+        sql += f", NULL FROM [{table}] AS r"
+    return sql, {column: columns[column] for column in expressions}
+
+
+class _PartitionWriter:
+    """Writes the batches of a table into the file of their partition, one partition at a time"""
+
+    def __init__(self, pa, directory, schema, partitioned, compression):
+        self.pa = pa
+        self.directory = directory
+        self.schema = schema
+        self.partitioned = partitioned
+        self.compression = compression
+        self.partition = None
+        self.writer = None
+        self.parts = {}
+
+    def _open(self, partition):
+        directory = self.directory
+        if self.partitioned:
+            directory = os.path.join(directory, f"date={partition or UNDATED}")
+        os.makedirs(directory, exist_ok=True)
+        # Partitions are written once, unless their rows aren't in date order
+        part = self.parts.get(partition, 0)
+        self.parts[partition] = part + 1
+        self.writer = self.pa.parquet.ParquetWriter(
+            os.path.join(directory, f"part-{part}.parquet"),
+            self.schema,
+            compression=self.compression,
+        )
+        self.partition = partition
+
+    def write(self, partition, arrays):
+        if self.writer is None or partition != self.partition:
+            self.close()
+            self._open(partition)
+        self.writer.write_batch(
+            self.pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+        )
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+def export_table(
+    db,
+    table,
+    directory,
+    payloads=True,
+    partition="month",
+    batch_size=PARQUET_BATCH_SIZE,
+    compression="zstd",
+) -> int:
+    """Export the rows of a table into Parquet files under a directory, and return their number"""
+    pa = _pyarrow()
+    partition_format = PARTITIONS[partition]
+    sql, columns = _table_query(db, table, payloads, partition_format)
+    schema = pa.schema(
+        [(column, arrow_type(pa, column, type_)) for column, type_ in columns.items()]
+    )
+    codec = get_codec(get_setting(db, "payload_codec"))
+    writer = _PartitionWriter(
+        pa,
+        os.path.join(directory, table),
+        schema,
+        partitioned=partition_format is not None,
+        compression=None if compression == "none" else compression,
+    )
+
+    def write(partition, rows):
+        arrays = []
+        for i, field in enumerate(schema):
+            values = [row[i] for row in rows]
+            if field.name in TIMESTAMP_COLUMNS:
+                arrays.append(timestamp_array(pa, values))
+                continue
+            if field.name == "payload":
+                values = [
+                    codec.decompress(v) if isinstance(v, bytes) else v and v.encode()
+                    for v in values
+                ]
+            arrays.append(pa.array(values, field.type))
+        writer.write(partition, arrays)
+
+    count = 0
+    cursor = db.execute(sql)
+    try:
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            count += len(rows)
+            # Batches are split on partition boundaries
+            start = 0
+            for i in range(1, len(rows) + 1):
+                if i == len(rows) or rows[i][-1] != rows[start][-1]:
+                    write(rows[start][-1], rows[start:i])
+                    start = i
+    finally:
+        cursor.close()
+        writer.close()
+    return count
+
+
+def export_parquet(
+    db,
+    directory,
+    tables=None,
+    payloads=True,
+    partition="month",
+    batch_size=PARQUET_BATCH_SIZE,
+    compression="zstd",
+) -> dict:
+    """
+    Export record tables (all by default) into Parquet files under a directory,
+    and return the number of rows of each.
+    """
+    _pyarrow()
+    if partition not in PARTITIONS:
+        raise ValueError(
+            f"Unknown partition <{partition}>. Only {list(PARTITIONS)} are supported."
+        )
+    if compression not in PARQUET_COMPRESSIONS:
+        raise ValueError(
+            f"Unknown compression <{compression}>. Only {PARQUET_COMPRESSIONS} are supported."
+        )
+    exported = {}
+    for table in tables or EXPORT_TABLES:
+        if not db[table].exists():
+            continue
+        exported[table] = export_table(
+            db, table, directory, payloads, partition, batch_size, compression
+        )
+    return exported
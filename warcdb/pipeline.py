@@ -0,0 +1,206 @@
+"""
+Pipelined imports.
+
+Reading sources, parsing records (gzip inflation included), normalizing them into rows
+and writing them to the database run concurrently, in stages connected by bounded queues:
+a stage that's ahead blocks once its output queue is full (backpressure),
+instead of buffering without bounds.
+
+zlib, file and network I/O and SQLite all release the GIL,
+so the stages overlap even though they're threads.
+Each stage keeps StageStats, to tell which one is the bottleneck.
+"""
+
+import queue
+import threading
+import time
+
+# Records buffered between two stages
+QUEUE_SIZE = 1000
+# Bytes read ahead of the parser, per source
+READ_AHEAD = 16 * 1024 * 1024
+
+_DONE = object()
+
+
+class StageStats:
+    """
+    Throughput and timings of a stage:
+    busy is the time spent working, starved the time spent waiting for input
+    and blocked the time spent waiting for room in its (full) output queue,
+    whose depth is sampled every time an item is put in it.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.bytes = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self._depth_total = 0
+        self._depth_samples = 0
+        self.max_depth = 0
+
+    def sample_depth(self, depth):
+        self._depth_total += depth
+        self._depth_samples += 1
+        self.max_depth = max(self.max_depth, depth)
+
+    @property
+    def avg_depth(self):
+        return self._depth_total / self._depth_samples if self._depth_samples else 0
+
+    def as_dict(self, elapsed) -> dict:
+        elapsed = elapsed or float("inf")
+        return {
+            "stage": self.name,
+            "items": self.items,
+            "items_per_sec": round(self.items / elapsed, 1),
+            "mb_per_sec": round(self.bytes / elapsed / 1024 / 1024, 2),
+            "busy_pct": round(100 * self.busy / elapsed, 1),
+            "starved_pct": round(100 * self.starved / elapsed, 1),
+            "blocked_pct": round(100 * self.blocked / elapsed, 1),
+            "avg_queue_depth": round(self.avg_depth, 1),
+            "max_queue_depth": self.max_depth,
+        }
+
+
+class Pipeline:
+    """
+    Iterates over items, passing each one through functions running in their own thread.
+
+    The producer stage iterates over `items` (so the work of producing them is its own),
+    each of `stages` is a (name, function) applied to the output of the previous one,
+    and the final results are yielded by iterating over the Pipeline itself,
+    from the consumer stage: the caller's thread.
+    Errors in any stage are raised from the iteration.
+    """
+
+    def __init__(
+        self, items, stages, producer="parse", consumer="write", queue_size=QUEUE_SIZE
+    ):
+        self._items = items
+        self._stages = stages
+        self._queue_size = queue_size
+        self._stopped = threading.Event()
+        self.stats = [StageStats(producer)]
+        self.stats += [StageStats(name) for name, _ in stages]
+        self.stats.append(StageStats(consumer))
+        self._started = self._finished = None
+
+    def _put(self, q, item, stats):
+        start = time.perf_counter()
+        while not self._stopped.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        stats.blocked += time.perf_counter() - start
+        stats.sample_depth(q.qsize())
+
+    def _get(self, q, stats):
+        start = time.perf_counter()
+        while not self._stopped.is_set():
+            try:
+                item = q.get(timeout=0.1)
+                break
+            except queue.Empty:
+                continue
+        else:
+            item = _DONE
+        stats.starved += time.perf_counter() - start
+        return item
+
+    def _produce(self, output, stats):
+        items = iter(self._items)
+        try:
+            while not self._stopped.is_set():
+                start = time.perf_counter()
+                item = next(items, _DONE)
+                stats.busy += time.perf_counter() - start
+                if item is _DONE:
+                    break
+                stats.items += 1
+                self._put(output, item, stats)
+        except BaseException as e:
+            self._put(output, _Error(e), stats)
+        finally:
+            # Closes the sources being read, if we're stopping early
+            if hasattr(items, "close"):
+                items.close()
+            self._put(output, _DONE, stats)
+
+    def _transform(self, function, input, output, stats):
+        while True:
+            item = self._get(input, stats)
+            if item is _DONE or isinstance(item, _Error):
+                self._put(output, item, stats)
+                if item is _DONE:
+                    return
+                continue
+            try:
+                start = time.perf_counter()
+                result = function(item)
+                stats.busy += time.perf_counter() - start
+                stats.items += 1
+            except BaseException as e:
+                result = _Error(e)
+            self._put(output, result, stats)
+
+    def __iter__(self):
+        queues = [
+            queue.Queue(maxsize=self._queue_size) for _ in range(len(self._stages) + 1)
+        ]
+        threads = [
+            threading.Thread(
+                target=self._produce, args=(queues[0], self.stats[0]), daemon=True
+            )
+        ]
+        for i, (_, function) in enumerate(self._stages):
+            threads.append(
+                threading.Thread(
+                    target=self._transform,
+                    args=(function, queues[i], queues[i + 1], self.stats[i + 1]),
+                    daemon=True,
+                )
+            )
+        self._started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+
+        output, stats = queues[-1], self.stats[-1]
+        try:
+            while True:
+                item = self._get(output, stats)
+                if item is _DONE:
+                    return
+                if isinstance(item, _Error):
+                    raise item.error
+                start = time.perf_counter()
+                yield item
+                stats.busy += time.perf_counter() - start
+                stats.items += 1
+        finally:
+            # Unblock stages still running, e.g. when the consumer failed
+            self._stopped.set()
+            for thread in threads:
+                thread.join()
+            self._finished = time.perf_counter()
+
+    @property
+    def elapsed(self):
+        if self._started is None:
+            return 0
+        return (self._finished or time.perf_counter()) - self._started
+
+    def report(self, extra_stats=()) -> list:
+        """The stats of every stage, as dicts"""
+        elapsed = self.elapsed
+        return [s.as_dict(elapsed) for s in [*extra_stats, *self.stats]]
+
+
+class _Error:
+    def __init__(self, error):
+        self.error = error
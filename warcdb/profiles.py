@@ -0,0 +1,113 @@
+"""
+SQLite tuning profiles.
+
+* safe: WAL journal, fully synchronous commits. Durable, with readers not blocking the writer.
+* bulk: for building a database from WARC files that are kept around.
+  WAL journal, no fsync on commit, a large page cache, memory mapped I/O and larger pages (new databases only).
+  A power loss may corrupt the database, so it may have to be rebuilt from its sources.
+  Secondary indexes and full-text search triggers are dropped for the duration of the import,
+  and rebuilt once at the end (see defer_indexes()).
+* readonly: for serving queries. Writes are refused, with a large page cache and memory mapped I/O.
+  Temporary tables and sorts stay on disk, as exports stream whole tables.
+
+Pragmas other than journal_mode and page_size only last for the connection,
+so the profile an import used is recorded in the settings (import_profile, import_pragmas).
+"""
+
+import json
+
+from warcdb.settings import get_setting, set_setting
+
+PROFILES = {
+    "safe": {
+        "pragmas": {"journal_mode": "wal", "synchronous": "full"},
+        "defer_indexes": False,
+    },
+    "bulk": {
+        "pragmas": {
+            # page_size only applies to databases without any tables yet
+            "page_size": 16384,
+            "journal_mode": "wal",
+            "synchronous": "off",
+            # In KiB when negative
+            "cache_size": -256 * 1024,
+            "mmap_size": 1024 * 1024 * 1024,
+            "temp_store": "memory",
+        },
+        "defer_indexes": True,
+    },
+    "readonly": {
+        "pragmas": {
+            "query_only": 1,
+            "cache_size": -256 * 1024,
+            "mmap_size": 1024 * 1024 * 1024,
+            # temp_store is left as it is: the sorts of unindexed ORDER BYs (e.g. of exports)
+            # spill to temporary files, rather than holding whole tables in memory
+        },
+        "defer_indexes": False,
+    },
+}
+
+
+def apply_profile(db, name) -> dict:
+    """Set the pragmas of a profile on a connection, and return their resulting values"""
+    pragmas = PROFILES[name]["pragmas"]
+    for pragma, value in pragmas.items():
+        db.execute(f"PRAGMA {pragma} = {value}")
+    return {pragma: db.execute(f"PRAGMA {pragma}").fetchone()[0] for pragma in pragmas}
+
+
+def record_profile(db, name, pragmas: dict):
+    """Record the profile, and the pragmas it resulted in, a database was built with"""
+    with db.conn:
+        set_setting(db, "import_profile", name)
+        set_setting(db, "import_pragmas", json.dumps(pragmas))
+
+
+def deferred_indexes(db) -> dict:
+    """The indexes and triggers dropped by defer_indexes(), that haven't been rebuilt yet"""
+    return json.loads(
+        get_setting(db, "deferred_indexes", None) or '{"sql": [], "fts": []}'
+    )
+
+
+def defer_indexes(db):
+    """
+    Drop secondary indexes and full-text search triggers, so that inserts don't maintain them.
+    Their definitions are kept in the settings until rebuild_indexes(),
+    so the ones dropped by an interrupted import are still rebuilt by the next one.
+    Unique indexes are kept, as inserts rely on them.
+    """
+    deferred = deferred_indexes(db)
+    fts_tables = [table.name for table in db.tables if table.detect_fts()]
+    objects = db.execute("""
+        SELECT type, name, tbl_name, sql FROM sqlite_master
+        WHERE (type = 'index' AND sql IS NOT NULL AND sql NOT LIKE 'CREATE UNIQUE%')
+           OR type = 'trigger'
+        """).fetchall()
+    with db.conn:
+        db.execute("BEGIN")
+        for type_, name, table, sql in objects:
+            if type_ == "trigger" and table not in fts_tables:
+                continue
+            db.execute(f"DROP {type_.upper()} [{name}]")
+            deferred["sql"].append(sql)
+            if type_ == "trigger" and table not in deferred["fts"]:
+                deferred["fts"].append(table)
+        set_setting(db, "deferred_indexes", json.dumps(deferred))
+
+
+def rebuild_indexes(db):
+    """Recreate the indexes and triggers dropped by defer_indexes(), and rebuild full-text search indexes"""
+    deferred = deferred_indexes(db)
+    if not deferred["sql"]:
+        return
+    with db.conn:
+        db.execute("BEGIN")
+        for sql in deferred["sql"]:
+            db.execute(sql)
+        set_setting(db, "deferred_indexes", None)
+    # rebuild_fts() doesn't commit
+    with db.conn:
+        for table in deferred["fts"]:
+            db[table].rebuild_fts()
@@ -0,0 +1,108 @@
+"""
+Records read back from a WarcDB.
+
+A LazyRecord is built from its table row alone;
+its payload is only read (from the database, or from its WARC file) when it's accessed.
+"""
+
+import io
+import json
+from http import HTTPStatus
+from urllib.parse import urlsplit
+
+from warcio import StatusAndHeaders
+from warcio.recordloader import ArcWarcRecord
+
+from warcdb.derived import DERIVED_COLUMNS
+
+# Columns that aren't WARC headers of the record
+NON_HEADER_COLUMNS = {
+    "payload",
+    "payload_digest",
+    "http_headers",
+    "http_status",
+    "http_status_line",
+    "warc_file_id",
+    "warc_offset",
+    "warc_length",
+    *DERIVED_COLUMNS,
+}
+
+# Header name parts that aren't simply capitalized
+_HEADER_ACRONYMS = {"warc": "WARC", "id": "ID", "uri": "URI", "ip": "IP"}
+
+
+def http_status_line(rec_type, row: dict) -> str:
+    """
+    The HTTP status (or request) line of a row.
+    Rows imported before it was stored get one rebuilt from the status code (or target URI).
+    """
+    if row.get("http_status_line"):
+        return row["http_status_line"]
+    if rec_type == "request":
+        parts = urlsplit(row.get("warc_target_uri") or "")
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        return f"GET {path} HTTP/1.1"
+    status = row.get("http_status")
+    try:
+        return f"HTTP/1.1 {status} {HTTPStatus(int(status)).phrase}"
+    except (TypeError, ValueError):
+        return f"HTTP/1.1 {status}"
+
+
+def header_name(column: str) -> str:
+    """The header name a column was derived from, e.g. warc_target_uri -> WARC-Target-URI"""
+    return "-".join(
+        _HEADER_ACRONYMS.get(part, part.capitalize()) for part in column.split("_")
+    )
+
+
+class LazyRecord(ArcWarcRecord):
+    """
+    An ArcWarcRecord rebuilt from its row.
+
+    Header names are restored from the column names, so their case may differ from the original.
+    """
+
+    def __init__(self, rec_type, row: dict, load_payload):
+        rec_headers = StatusAndHeaders(
+            "WARC/1.0",
+            [
+                (header_name(column), str(value))
+                for column, value in row.items()
+                if column not in NON_HEADER_COLUMNS and value is not None
+            ],
+        )
+        http_headers = None
+        if row.get("http_headers"):
+            # Like warcio, which parses "GET / HTTP/1.1" into protocol GET and statusline "/ HTTP/1.1"
+            protocol, statusline = http_status_line(rec_type, row).split(" ", 1)
+            http_headers = StatusAndHeaders(
+                statusline,
+                [(h["header"], h["value"]) for h in json.loads(row["http_headers"])],
+                protocol,
+            )
+        super().__init__(
+            "warc",
+            rec_type,
+            rec_headers,
+            None,
+            http_headers,
+            row.get("content_type"),
+            row.get("content_length"),
+        )
+        self.row = row
+        self._load_payload = load_payload
+
+    def payload(self) -> bytes:
+        try:
+            return self._warcdb_payload
+        except AttributeError:
+            self._warcdb_payload = self._load_payload()
+            return self._warcdb_payload
+
+    def content_stream(self):
+        return io.BytesIO(self.payload() or b"")
+
+    def as_dict(self) -> dict:
+        return {k: v for k, v in self.row.items() if k not in NON_HEADER_COLUMNS}
@@ -0,0 +1,400 @@
+"""
+Streaming of remote (HTTP) sources.
+
+Remote WARCs are often several GB, so a dropped connection shouldn't kill the import:
+streams reconnect with an HTTP Range request from the byte already consumed.
+Downloads of the next sources can be prefetched in background threads,
+into bounded in-memory buffers, while the current one is being parsed.
+Remote WACZ files are read with Range requests too,
+fetching only their central directory and the members being imported.
+"""
+
+import io
+import queue
+import struct
+import threading
+import time
+import zipfile
+from collections import OrderedDict, deque
+
+import requests as req
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import IncompleteRead, ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+
+# Errors after which a stream reconnects and resumes
+RESUMABLE_ERRORS = (
+    req.ConnectionError,
+    req.Timeout,
+    ProtocolError,
+    IncompleteRead,
+    ReadTimeoutError,
+    ConnectionError,
+    TimeoutError,
+)
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class SourceChanged(IOError):
+    """The remote file changed while it was being read"""
+
+
+class ResumableHTTPStream:
+    """
+    A read-only file object over a URL,
+    which reconnects from its current position when the connection fails.
+
+    It can be limited to the [start, end) byte range of the URL,
+    in which case positions are relative to start.
+    """
+
+    def __init__(self, client, url, offset=0, start=0, end=None):
+        self._client = client
+        self.url = url
+        self.position = offset
+        self._start = start
+        self._end = end
+        self._validator = None
+        self._resp = None
+        self._connect()
+
+    def _connect(self):
+        headers = {}
+        first = self._start + self.position
+        if first or self._end is not None:
+            last = "" if self._end is None else self._end - 1
+            headers["Range"] = f"bytes={first}-{last}"
+            if self._validator:
+                # The server sends the whole (new) file instead, if it has changed
+                headers["If-Range"] = self._validator
+        resp = self._client.session.get(
+            self.url, stream=True, timeout=self._client.timeout, headers=headers
+        )
+        resp.raise_for_status()
+
+        validator = resp.headers.get("ETag") or resp.headers.get("Last-Modified")
+        if validator and validator.startswith("W/"):
+            validator = None
+        if self._validator and validator != self._validator:
+            resp.close()
+            raise SourceChanged(f"{self.url} changed while it was being read")
+        self._validator = self._validator or validator
+
+        self._resp = resp
+        if first and resp.status_code != 206:
+            # Range isn't supported: skip what we already have
+            skip = first
+            while skip:
+                skipped = len(resp.raw.read(min(skip, CHUNK_SIZE)))
+                if not skipped:
+                    break
+                skip -= skipped
+
+    def read(self, size=-1):
+        if self._end is not None:
+            # Servers ignoring Range would keep on sending past the end
+            remaining = self._end - self._start - self.position
+            size = remaining if size < 0 else min(size, remaining)
+        for attempt in range(self._client.retries + 1):
+            try:
+                data = self._resp.raw.read(None if size < 0 else size)
+                self.position += len(data)
+                return data
+            except RESUMABLE_ERRORS:
+                if attempt == self._client.retries:
+                    raise
+                self._resp.close()
+                time.sleep(self._client.backoff * 2**attempt)
+                self._connect()
+
+    def tell(self):
+        return self.position
+
+    def readable(self):
+        return True
+
+    def close(self):
+        if self._resp is not None:
+            self._resp.close()
+
+
+class HTTPRangeFile(io.RawIOBase):
+    """
+    A seekable, read-only file object over a URL,
+    reading it with Range requests through a small LRU cache of blocks.
+
+    It's meant for random access, e.g. letting zipfile read a remote archive's central directory.
+    """
+
+    def __init__(self, client, url, block_size=256 * 1024, cache_blocks=16):
+        super().__init__()
+        self._client = client
+        self.url = url
+        self._block_size = block_size
+        self._cache_blocks = cache_blocks
+        self._blocks = OrderedDict()
+        self._position = 0
+
+        resp = client.session.get(
+            url, headers={"Range": "bytes=0-0"}, stream=True, timeout=client.timeout
+        )
+        resp.raise_for_status()
+        resp.close()
+        if resp.status_code == 206:
+            self.size = int(resp.headers["Content-Range"].rsplit("/", 1)[1])
+        else:
+            self.size = int(resp.headers["Content-Length"])
+
+    def _block(self, index):
+        if index in self._blocks:
+            self._blocks.move_to_end(index)
+            return self._blocks[index]
+
+        start = index * self._block_size
+        end = min(start + self._block_size, self.size)
+        stream = ResumableHTTPStream(self._client, self.url, start=start, end=end)
+        try:
+            block = b"".join(iter(lambda: stream.read(CHUNK_SIZE), b""))
+        finally:
+            stream.close()
+
+        self._blocks[index] = block
+        if len(self._blocks) > self._cache_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def read(self, size=-1):
+        end = (
+            self.size
+            if size is None or size < 0
+            else min(self.size, self._position + size)
+        )
+        data = []
+        while self._position < end:
+            index, start = divmod(self._position, self._block_size)
+            part = self._block(index)[start : start + end - self._position]
+            if not part:
+                break
+            data.append(part)
+            self._position += len(part)
+        return b"".join(data)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            offset += self._position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        self._position = max(0, offset)
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def seekable(self):
+        return True
+
+    def readable(self):
+        return True
+
+
+def stored_member_offset(f, info: zipfile.ZipInfo) -> int:
+    """Offset of the data of a member stored (uncompressed) in the zip file f"""
+    f.seek(info.header_offset)
+    name_length, extra_length = struct.unpack("<HH", f.read(30)[26:30])
+    return info.header_offset + 30 + name_length + extra_length
+
+
+def open_wacz_member(client, url, member, offset=0):
+    """
+    Open a member of a remote WACZ file positioned at an offset,
+    without downloading the rest of the archive.
+    """
+    f = HTTPRangeFile(client, url)
+    wacz = zipfile.ZipFile(f)
+    info = wacz.getinfo(member)
+    if info.compress_type != zipfile.ZIP_STORED:
+        stream = wacz.open(info)
+        stream.seek(offset)
+        return stream
+
+    # WARCs are already compressed, so they're usually stored as-is:
+    # stream the member's bytes straight from the server
+    start = stored_member_offset(f, info)
+    return ResumableHTTPStream(
+        client, url, offset, start=start, end=start + info.compress_size
+    )
+
+
+class PrefetchingStream:
+    """
+    Opens a stream and reads it ahead in a background thread,
+    into a buffer of at most buffer_size bytes.
+
+    stats is an optional warcdb.pipeline.StageStats, to account the reads to.
+    """
+
+    def __init__(self, open_stream, position, buffer_size, stats=None):
+        self._open_stream = open_stream
+        self._stream = None
+        self.position = position
+        self._stats = stats
+        self._chunks = queue.Queue(maxsize=max(1, buffer_size // CHUNK_SIZE))
+        self._current = b""
+        self._closed = threading.Event()
+        self._thread = threading.Thread(target=self._prefetch, daemon=True)
+        self._thread.start()
+
+    def _prefetch(self):
+        try:
+            self._stream = self._open_stream()
+            while not self._closed.is_set():
+                start = time.perf_counter()
+                chunk = self._stream.read(CHUNK_SIZE)
+                if self._stats is not None:
+                    self._stats.busy += time.perf_counter() - start
+                    self._stats.items += 1
+                    self._stats.bytes += len(chunk)
+                self._put(chunk)
+                if not chunk:
+                    return
+        except Exception as e:
+            self._put(e)
+        finally:
+            # Whether it's been read through or closed, nothing reads from it anymore
+            if self._stream is not None:
+                self._stream.close()
+
+    def _put(self, item):
+        start = time.perf_counter()
+        while not self._closed.is_set():
+            try:
+                self._chunks.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        if self._stats is not None:
+            self._stats.blocked += time.perf_counter() - start
+            self._stats.sample_depth(self._chunks.qsize())
+
+    def read(self, size=-1):
+        data = []
+        wanted = float("inf") if size is None or size < 0 else size
+        while wanted:
+            if not self._current:
+                chunk = self._chunks.get()
+                if isinstance(chunk, Exception):
+                    raise chunk
+                if not chunk:
+                    # Keep returning EOF to subsequent reads
+                    self._put(chunk)
+                    break
+                self._current = chunk
+            part = self._current[: int(min(wanted, len(self._current)))]
+            self._current = self._current[len(part) :]
+            data.append(part)
+            wanted -= len(part)
+        data = b"".join(data)
+        self.position += len(data)
+        return data
+
+    def tell(self):
+        return self.position
+
+    def readable(self):
+        return True
+
+    def close(self):
+        # The thread closes the stream itself, once its current read returns
+        self._closed.set()
+
+
+class HTTPClient:
+    """
+    Pooled HTTP session used to stream remote sources,
+    retrying failed requests with exponential backoff.
+
+    prefetch is the number of sources downloaded ahead of the one being parsed,
+    each buffering at most prefetch_buffer bytes.
+    """
+
+    def __init__(
+        self,
+        retries=5,
+        timeout=60,
+        backoff=1.0,
+        prefetch=0,
+        prefetch_buffer=64 * CHUNK_SIZE,
+    ):
+        self.retries = retries
+        self.timeout = timeout
+        self.backoff = backoff
+        self.prefetch = prefetch
+        self.prefetch_buffer = prefetch_buffer
+        self.session = self._create_session()
+        self._scheduled = deque()
+        self._prefetched = {}
+
+    @property
+    def options(self):
+        """Options to recreate this client with, e.g. in another process"""
+        return {
+            "retries": self.retries,
+            "timeout": self.timeout,
+            "backoff": self.backoff,
+            "prefetch": self.prefetch,
+            "prefetch_buffer": self.prefetch_buffer,
+        }
+
+    def _create_session(self) -> req.Session:
+        retry = Retry(
+            total=self.retries,
+            backoff_factor=self.backoff,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["HEAD", "GET"],
+        )
+        adapter = HTTPAdapter(
+            max_retries=retry,
+            pool_connections=self.prefetch + 1,
+            pool_maxsize=self.prefetch + 1,
+        )
+        session = req.Session()
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
+
+    def schedule(self, requests):
+        """Schedule (url, offset) requests, in the order they're going to be opened"""
+        self._scheduled.extend(requests)
+        self._fill()
+
+    def _fill(self):
+        while self._scheduled and len(self._prefetched) < self.prefetch:
+            url, offset = self._scheduled.popleft()
+            self._prefetched[url, offset] = PrefetchingStream(
+                lambda url=url, offset=offset: ResumableHTTPStream(self, url, offset),
+                offset,
+                self.prefetch_buffer,
+            )
+
+    def open(self, url, offset=0):
+        """Open a URL at a byte offset, using its prefetched stream if there's one"""
+        if (url, offset) in self._scheduled:
+            self._scheduled.remove((url, offset))
+        stream = self._prefetched.pop((url, offset), None)
+        if stream is None:
+            stream = ResumableHTTPStream(self, url, offset)
+        self._fill()
+        return stream
+
+    def close(self):
+        self._scheduled.clear()
+        for stream in self._prefetched.values():
+            stream.close()
+        self._prefetched.clear()
+        self.session.close()
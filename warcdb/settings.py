@@ -0,0 +1,28 @@
+"""
+Per-database settings (e.g. storage modes), kept in a key-value table.
+
+The table is only created the first time a setting is stored,
+so databases using the defaults don't get it at all.
+"""
+
+SETTINGS_TABLE = "_warcdb_settings"
+
+
+def get_setting(db, key, default=None):
+    if not db[SETTINGS_TABLE].exists():
+        return default
+    row = db.execute(
+        f"SELECT value FROM [{SETTINGS_TABLE}] WHERE key = ?", [key]
+    ).fetchone()
+    return default if row is None else row[0]
+
+
+def set_setting(db, key, value):
+    """Store a setting. This doesn't commit, so it can be part of a larger transaction."""
+    db.execute(
+        f"CREATE TABLE IF NOT EXISTS [{SETTINGS_TABLE}] (key TEXT PRIMARY KEY, value)"
+    )
+    db.execute(
+        f"INSERT OR REPLACE INTO [{SETTINGS_TABLE}] (key, value) VALUES (?, ?)",
+        [key, value],
+    )
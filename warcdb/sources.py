@@ -0,0 +1,419 @@
+"""
+Sources of records for `warcdb import`.
+
+A source is a (path, wacz_member) tuple: a local file or URL,
+or a single WARC member of a (local or remote) WACZ file.
+Each source can be parsed, and resumed, independently.
+"""
+
+import datetime
+import gzip
+import hashlib
+import io
+import json
+import os
+import posixpath
+import re
+import zipfile
+from fnmatch import fnmatch
+from typing import NamedTuple, Optional
+
+from more_itertools import always_iterable
+from warcio import ArchiveIterator
+from warcio.exceptions import ArchiveLoadFailed
+from warcio.limitreader import LimitReader
+
+from warcdb.blobs import payload_policy, read_payload
+from warcdb.remote import (
+    HTTPClient,
+    HTTPRangeFile,
+    ResumableHTTPStream,
+    open_wacz_member,
+    stored_member_offset,
+)
+
+# How much of a local file is hashed to fingerprint it
+FINGERPRINT_BYTES = 1024 * 1024
+
+# CDX(J) indexes WACZ files may ship with, in order of preference
+WACZ_INDEXES = [
+    "indexes/index.cdxj",
+    "indexes/index.cdx",
+    "indexes/index.cdxj.gz",
+    "indexes/index.cdx.gz",
+]
+
+
+# Record types RecordFilter applies to
+CAPTURE_TYPES = ("response", "resource", "revisit")
+
+# Dates filters can be given as, down to the year
+DATE_PATTERN = re.compile(
+    r"\d{4}(-?\d{2}(-?\d{2}([T ]?\d{2}(:?\d{2}(:?\d{2}(\.\d+)?)?)?)?)?)?Z?"
+)
+
+
+def timestamp14(value: str, pad="0") -> str:
+    """Normalize a date (e.g. 2023-10-20T12:22:47Z, 20231020 or 2023) into a 14-digit timestamp"""
+    return re.sub(r"\D", "", value)[:14].ljust(14, pad)
+
+
+def check_date(value: str) -> str:
+    """Check that a date given as a filter (e.g. --from) is one, or raise ValueError"""
+    digits = re.sub(r"\D", "", value)[:14]
+    try:
+        if not DATE_PATTERN.fullmatch(value):
+            raise ValueError
+        # Months and days pad to their first
+        datetime.datetime.strptime(
+            digits + "0101000000"[len(digits) - 4 :], "%Y%m%d%H%M%S"
+        )
+    except ValueError:
+        raise ValueError(
+            f"Invalid date <{value}>. Dates are like 2023, 2023-10-20, 2023-10-20T12:22:47Z or 20231020122247."
+        )
+    return value
+
+
+class RecordFilter(NamedTuple):
+    """
+    Selects the captures (response, resource and revisit records) to import.
+    All given criteria have to match; a repeated one matches any of its values.
+    """
+
+    url_prefixes: tuple = ()
+    mimes: tuple = ()
+    statuses: tuple = ()
+    from_timestamp: Optional[str] = None
+    to_timestamp: Optional[str] = None
+
+    @classmethod
+    def create(cls, url_prefixes=(), mimes=(), statuses=(), from_=None, to=None):
+        """Raises ValueError for invalid from_ and to dates"""
+        for date in (from_, to):
+            if date:
+                check_date(date)
+        return cls(
+            tuple(url_prefixes),
+            tuple(m.lower() for m in mimes),
+            tuple(int(s) for s in statuses),
+            from_ and timestamp14(from_, "0"),
+            to and timestamp14(to, "9"),
+        )
+
+    @property
+    def active(self) -> bool:
+        return any(self)
+
+    def describe(self) -> Optional[str]:
+        """How the filter is recorded in the ingest log"""
+        return json.dumps(self._asdict()) if self.active else None
+
+    def matches(self, url, mime, status, timestamp) -> bool:
+        if self.url_prefixes and not (url or "").startswith(self.url_prefixes):
+            return False
+        if self.mimes:
+            mime = (mime or "").split(";")[0].strip().lower()
+            if not mime.startswith(self.mimes):
+                return False
+        if self.statuses:
+            try:
+                if int(status) not in self.statuses:
+                    return False
+            except (TypeError, ValueError):
+                return False
+        if self.from_timestamp and not timestamp >= self.from_timestamp:
+            return False
+        if self.to_timestamp and not timestamp <= self.to_timestamp:
+            return False
+        return True
+
+    def matches_record(self, r) -> bool:
+        if r.rec_type not in CAPTURE_TYPES:
+            return False
+        status, mime = None, r.rec_headers.get_header("Content-Type")
+        if r.rec_type in ("response", "revisit") and r.http_headers:
+            status = r.http_headers.get_statuscode()
+            mime = r.http_headers.get_header("Content-Type")
+        return self.matches(
+            r.rec_headers.get_header("WARC-Target-URI"),
+            mime,
+            status,
+            timestamp14(r.rec_headers.get_header("WARC-Date") or ""),
+        )
+
+
+def expand_sources(warc_path, wacz_members=None, http: HTTPClient = None):
+    """
+    Expand the paths / URLs given to `warcdb import` into sources,
+    each of which can be parsed independently: (path, wacz_member) tuples.
+
+    wacz_members are glob patterns selecting which WARCs to import from WACZ files.
+    """
+    for f in always_iterable(warc_path):
+        if not f.endswith(".wacz"):
+            yield f, None
+            continue
+
+        wacz_file, wacz = _open_wacz(f, http)
+        with wacz_file, wacz:
+            members = [info.filename for info in wacz.infolist()]
+        for member in members:
+            if not member.endswith("warc.gz"):
+                continue
+            if wacz_members and not any(
+                fnmatch(member, pattern) for pattern in wacz_members
+            ):
+                continue
+            yield f, member
+
+
+def source_name(source):
+    path, wacz_member = source
+    return wacz_member or path
+
+
+def source_key(source):
+    """Unique key of a source, e.g. in the ingest log"""
+    path, wacz_member = source
+    return path if wacz_member is None else f"{path}#{wacz_member}"
+
+
+def source_fingerprint(source):
+    """
+    A cheap (size, digest) fingerprint, used to tell whether a source has changed since it was imported.
+    Remote sources are assumed to be immutable, so they have none.
+    """
+    path, wacz_member = source
+    if path.startswith("http"):
+        return None, None
+    if wacz_member is not None:
+        with zipfile.ZipFile(path) as wacz:
+            info = wacz.getinfo(wacz_member)
+        return info.file_size, f"crc32:{info.CRC:08x}"
+    with open(path, "rb") as f:
+        head = f.read(FINGERPRINT_BYTES)
+    return os.path.getsize(path), "sha1:" + hashlib.sha1(head).hexdigest()
+
+
+_default_http = None
+
+
+def default_http() -> HTTPClient:
+    global _default_http
+    if _default_http is None:
+        _default_http = HTTPClient()
+    return _default_http
+
+
+def _open_wacz(path, http=None):
+    if path.startswith("http"):
+        f = HTTPRangeFile(http or default_http(), path)
+    else:
+        f = open(path, "rb")
+    return f, zipfile.ZipFile(f)
+
+
+def wacz_index_entries(path, wacz_member, record_filter: RecordFilter, http=None):
+    """
+    The (offset, length) of the records of a WACZ member matching a filter, according to the WACZ's index.
+    Returns None if there is no index, or if the member can't be seeked into.
+    """
+    f, wacz = _open_wacz(path, http)
+    with f, wacz:
+        names = set(wacz.namelist())
+        index = next((name for name in WACZ_INDEXES if name in names), None)
+        if (
+            index is None
+            or wacz.getinfo(wacz_member).compress_type != zipfile.ZIP_STORED
+        ):
+            return None
+
+        filename = posixpath.basename(wacz_member)
+        entries = []
+        with wacz.open(index) as stream:
+            if index.endswith(".gz"):
+                stream = gzip.open(stream)
+            for line in io.TextIOWrapper(stream, encoding="utf-8"):
+                # <surt> <timestamp> <json>
+                parts = line.rstrip("\n").split(" ", 2)
+                if len(parts) != 3 or not parts[2].startswith("{"):
+                    continue
+                entry = json.loads(parts[2])
+                if posixpath.basename(entry.get("filename", "")) != filename:
+                    continue
+                if record_filter.matches(
+                    entry.get("url"), entry.get("mime"), entry.get("status"), parts[1]
+                ):
+                    entries.append((int(entry["offset"]), int(entry["length"])))
+    return sorted(entries)
+
+
+def _read_warcinfo(f, start, payloads=True):
+    """The (offset, length, record) of the warcinfo record a WARC starts with, if it does"""
+    f.seek(start)
+    records = ArchiveIterator(f, arc2warc=True)
+    r = next(records, None)
+    if r is None or r.rec_type != "warcinfo":
+        return None
+    if payloads:
+        read_payload(r, payloads)
+    return records.get_record_offset(), records.get_record_length(), r
+
+
+def _iter_indexed(source, entries, offset, http=None, payloads=True):
+    """
+    Iterate over the (offset, length, record) of the index entries of a WACZ member, seeking to each one.
+    Its warcinfo record, which indexes leave out, comes first.
+    """
+    path, wacz_member = source
+    f, wacz = _open_wacz(path, http)
+    with f, wacz:
+        start = stored_member_offset(f, wacz.getinfo(wacz_member))
+        warcinfo = _read_warcinfo(f, start, payloads)
+        if warcinfo is not None and warcinfo[0] >= offset:
+            yield warcinfo
+        for record_offset, length in entries:
+            if record_offset < offset:
+                continue
+            if warcinfo is not None and record_offset == warcinfo[0]:
+                continue
+            f.seek(start + record_offset)
+            # Large records are streamed rather than read at once
+            if length > payload_policy(payloads).max_size:
+                record = LimitReader(f, length)
+            else:
+                record = io.BytesIO(f.read(length))
+            for r in ArchiveIterator(record, arc2warc=True):
+                if r.rec_type in CAPTURE_TYPES:
+                    if payloads:
+                        read_payload(r, payloads)
+                    yield record_offset, length, r
+                break
+
+
+def _open_source(source, offset, http=None):
+    """
+    Open a source positioned at a byte offset.
+    All streams report their absolute position through tell().
+    """
+    path, wacz_member = source
+    if path.startswith("http") and wacz_member is not None:
+        return open_wacz_member(http or default_http(), path, wacz_member, offset)
+    if path.startswith("http"):
+        return (http or default_http()).open(path, offset)
+    if wacz_member is not None:
+        # The member keeps the file open until it is closed
+        with zipfile.ZipFile(path) as wacz:
+            stream = wacz.open(wacz_member, "r")
+    else:
+        stream = open(path, "rb")
+    stream.seek(offset)
+    return stream
+
+
+def iter_source(
+    source,
+    offset=0,
+    http: HTTPClient = None,
+    record_filter: RecordFilter = None,
+    payloads=True,
+    wrap_stream=None,
+):
+    """
+    Iterate over the (offset, length, record) of each record of a single source,
+    starting from a record's byte offset.
+    Remote sources are streamed through the given HTTPClient,
+    and wrap_stream can wrap the opened stream, e.g. to read it ahead.
+
+    With a record_filter, only matching records are returned,
+    and warcinfo records, which the records of a WARC refer to.
+    For WACZ members the WACZ's index is used to seek straight to them, if there is one.
+
+    Without payloads, record payloads are skipped over instead of being read (see load_record()).
+    payloads can also be a LargePayloads policy, for payloads too large to be read into memory (see warcdb.blobs).
+    """
+    record_filter = record_filter or RecordFilter()
+    if record_filter.active and source[1] is not None:
+        entries = wacz_index_entries(*source, record_filter, http)
+        if entries is not None:
+            yield from _iter_indexed(source, entries, offset, http, payloads)
+            return
+
+    started = False
+    stream = _open_source(source, offset, http)
+    if wrap_stream is not None:
+        stream = wrap_stream(stream)
+    try:
+        records = ArchiveIterator(stream, arc2warc=True)
+        for r in records:
+            started = True
+            if (
+                record_filter.active
+                and r.rec_type != "warcinfo"
+                and not record_filter.matches_record(r)
+            ):
+                continue
+            # The offset is only known once the record has been read through;
+            # the payload is memoized, so it's not read twice
+            if payloads:
+                read_payload(r, payloads)
+            yield records.get_record_offset(), records.get_record_length(), r
+    except ArchiveLoadFailed:
+        if started or not offset:
+            raise
+        # The offset isn't a record boundary we can restart from (e.g. a single gzip member).
+        # Start over instead; records already imported are ignored on insert.
+        stream.close()
+        yield from iter_source(source, 0, http, record_filter, payloads, wrap_stream)
+    finally:
+        stream.close()
+
+
+def read_record_bytes(path, wacz_member, offset, length, http: HTTPClient = None):
+    """Read the raw (possibly gzipped) bytes of a single record of a source"""
+    if path.startswith("http"):
+        client = http or default_http()
+        if wacz_member is not None:
+            stream = open_wacz_member(client, path, wacz_member, offset)
+        else:
+            stream = ResumableHTTPStream(
+                client, path, start=offset, end=offset + length
+            )
+        try:
+            return stream.read(length)
+        finally:
+            stream.close()
+
+    with open(path, "rb") as f:
+        if wacz_member is None:
+            f.seek(offset)
+            return f.read(length)
+        wacz = zipfile.ZipFile(f)
+        info = wacz.getinfo(wacz_member)
+        if info.compress_type == zipfile.ZIP_STORED:
+            f.seek(stored_member_offset(f, info) + offset)
+            return f.read(length)
+        with wacz.open(info) as member:
+            member.seek(offset)
+            return member.read(length)
+
+
+def load_record(path, wacz_member, offset, length, http: HTTPClient = None):
+    """
+    Load a single record, with its payload, from the (offset, length) it was found at by iter_source().
+    That's a seek plus the decompression of a single gzip member.
+    """
+    data = read_record_bytes(path, wacz_member, offset, length, http)
+    r = next(iter(ArchiveIterator(io.BytesIO(data), arc2warc=True)))
+    r.payload()
+    return r
+
+
+def remote_sources(sources):
+    """The (url, offset) requests needed to import {source: resume_state} sources"""
+    return [
+        (path, state["offset"])
+        for (path, wacz_member), state in sources.items()
+        if path.startswith("http") and wacz_member is None
+    ]
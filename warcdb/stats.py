@@ -0,0 +1,224 @@
+"""
+Import instrumentation.
+
+Every WarcDB (and ShardedWriter) has an ImportStats, which the import functions and flush() report to:
+
+* the time spent in each stage of an import, exclusive of the stages nested in it:
+  read (file and network I/O, including waiting for downloads), parse (warcio, gzip inflation included),
+  normalize (record_to_row()), text (text extraction for full-text search), compress (payload compression),
+  schema (creating tables and adding columns), insert (the SQLite transaction)
+  and index (building the indexes deferred by --profile bulk).
+  Stages running in several threads (e.g. the flushes of the shards of a dataset) add up.
+* records and payload bytes per rec_type, input bytes read, sources skipped as already imported,
+  and records ignored as duplicates (already in the database)
+* the peak RSS of the process (and of its worker processes, with --jobs)
+
+`warcdb import --stats FILE` writes the report as JSON once the import is done,
+or with --stats-interval as newline-delimited JSON snapshots, the last one being the final report.
+A summary of every import is also kept in the _warcdb_imports table.
+"""
+
+import datetime
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+IMPORTS_TABLE = "_warcdb_imports"
+
+STAGES = ["read", "parse", "normalize", "text", "compress", "schema", "insert", "index"]
+
+
+def peak_rss_mb():
+    """The peak RSS of this process and of its (largest) child process, in MB, or None if unknown"""
+    if resource is None:
+        return None
+    # KiB on Linux, bytes on macOS
+    scale = 1024 * 1024 if sys.platform == "darwin" else 1024
+    rss = {
+        who: resource.getrusage(who).ru_maxrss / scale
+        for who in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)
+    }
+    return round(max(rss.values()), 1)
+
+
+class _TimedStream:
+    """A stream whose reads are accounted to the read stage"""
+
+    def __init__(self, stream, stats):
+        self._stream = stream
+        self._stats = stats
+
+    def read(self, *args):
+        with self._stats.timer("read"):
+            data = self._stream.read(*args)
+        self._stats.add_input(len(data))
+        return data
+
+    def __getattr__(self, name):
+        return getattr(self._stream, name)
+
+
+class ImportStats:
+    """What an import spent its time on, and what it imported"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.started_at = datetime.datetime.now(datetime.timezone.utc).isoformat()
+        self.seconds = defaultdict(float)
+        self.records = defaultdict(int)
+        self.bytes = defaultdict(int)
+        self.input_bytes = 0
+        self.sources = 0
+        self.sources_skipped = 0
+        self.duplicates = 0
+        # The stage stats of a pipelined import (see warcdb.pipeline)
+        self.pipeline = None
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @contextmanager
+    def timer(self, stage):
+        """Account the time spent in a block to a stage, less the time of the stages nested in it"""
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += elapsed
+            with self._lock:
+                self.seconds[stage] += elapsed - nested
+
+    def timed(self, items, stage):
+        """Iterate over items, accounting the time spent producing each one to a stage"""
+        items = iter(items)
+        while True:
+            with self.timer(stage):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    return
+            yield item
+
+    def timed_stream(self, stream):
+        """Wrap a source's stream (see iter_source()), to account its reads to the read stage"""
+        return _TimedStream(stream, self)
+
+    def add_input(self, size):
+        with self._lock:
+            self.input_bytes += size
+
+    def count(self, rec_type, row):
+        """Count a record queued for insertion, and the bytes of its payload"""
+        payload = row.get("payload")
+        with self._lock:
+            self.records[rec_type] += 1
+            if payload is not None:
+                self.bytes[rec_type] += len(payload)
+
+    def add_duplicates(self, count):
+        with self._lock:
+            self.duplicates += count
+
+    @property
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            elapsed = self.elapsed
+            records = sum(self.records.values())
+            payload_bytes = sum(self.bytes.values())
+            report = {
+                "started_at": self.started_at,
+                "seconds": round(elapsed, 3),
+                "sources": self.sources,
+                "sources_skipped": self.sources_skipped,
+                "records": records,
+                "records_per_sec": round(records / elapsed, 1) if elapsed else 0,
+                "payload_bytes": payload_bytes,
+                "input_bytes": self.input_bytes,
+                "input_mb_per_sec": (
+                    round(self.input_bytes / elapsed / 1024 / 1024, 2) if elapsed else 0
+                ),
+                "duplicates_ignored": self.duplicates,
+                "peak_rss_mb": peak_rss_mb(),
+                "rec_types": {
+                    rec_type: {"records": count, "payload_bytes": self.bytes[rec_type]}
+                    for rec_type, count in sorted(self.records.items())
+                },
+                "stages": {
+                    stage: {
+                        "seconds": round(self.seconds[stage], 3),
+                        "pct": round(100 * self.seconds[stage] / elapsed, 1),
+                    }
+                    for stage in sorted(self.seconds, key=_stage_order)
+                },
+            }
+        if self.pipeline is not None:
+            report["pipeline"] = self.pipeline
+        return report
+
+
+def _stage_order(stage):
+    return STAGES.index(stage) if stage in STAGES else len(STAGES)
+
+
+class StatsReporter:
+    """
+    Writes newline-delimited JSON snapshots of an ImportStats to a file every `interval` seconds,
+    from a background thread, from start() until stop().
+    """
+
+    def __init__(self, stats: ImportStats, output, interval):
+        self.stats = stats
+        self.output = output
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._report, daemon=True)
+
+    def write(self):
+        self.output.write(json.dumps(self.stats.as_dict()) + "\n")
+        self.output.flush()
+
+    def _report(self):
+        while not self._stopped.wait(self.interval):
+            self.write()
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._thread.join()
+
+
+def record_import(db, stats: ImportStats):
+    """Keep a summary of an import, and its full report, in the _warcdb_imports table"""
+    report = stats.as_dict()
+    with db.conn:
+        db[IMPORTS_TABLE].insert(
+            {
+                "started_at": report["started_at"],
+                "finished_at": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+                "seconds": report["seconds"],
+                "sources": report["sources"],
+                "records": report["records"],
+                "payload_bytes": report["payload_bytes"],
+                "duplicates_ignored": report["duplicates_ignored"],
+                "peak_rss_mb": report["peak_rss_mb"],
+                "stats": json.dumps(report),
+            },
+            pk="id",
+        )
@@ -0,0 +1,214 @@
+"""
+Deterministic synthetic WARC and WACZ files, for benchmarks and tests.
+
+The same parameters (and seed) always produce the same records: record IDs, dates and payloads
+are derived from a seeded random generator, rather than from uuid4() and the current time.
+Each capture is a response (an HTML page of about payload_size bytes, with a Set-Cookie header),
+or, for a revisit_ratio of them, a revisit of an earlier capture of the same URL,
+optionally preceded by its request.
+"""
+
+import datetime
+import io
+import json
+import random
+import uuid
+import zipfile
+
+from warcio import ArchiveIterator, StatusAndHeaders
+from warcio.warcwriter import WARCWriter
+
+from warcdb.dedup import payload_digest
+from warcdb.derived import surt
+from warcdb.sources import timestamp14
+
+START_DATE = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+
+WORDS = (
+    "archive web crawl capture record payload index search query table column page "
+    "link header status cookie session browser server network request response stocks "
+    "market news world science health sports travel weather music video image text"
+).split()
+
+
+def _record_id(rng) -> str:
+    return f"<urn:uuid:{uuid.UUID(int=rng.getrandbits(128), version=4)}>"
+
+
+def _html(rng, url, size) -> bytes:
+    title = " ".join(rng.choices(WORDS, k=5)).capitalize()
+    parts = [f"<html><head><title>{title}</title></head><body><h1>{title}</h1>"]
+    length = len(parts[0])
+    while length < size:
+        paragraph = f"<p>{' '.join(rng.choices(WORDS, k=40))}</p>\n"
+        parts.append(paragraph)
+        length += len(paragraph)
+    parts.append(f'<a href="{url}">{url}</a></body></html>')
+    return "".join(parts).encode()
+
+
+def write_synthetic_warc(
+    output,
+    records=1000,
+    payload_size=16 * 1024,
+    revisit_ratio=0.1,
+    requests=True,
+    hosts=10,
+    gzip=True,
+    seed=0,
+) -> int:
+    """
+    Write a synthetic WARC to a file object: a warcinfo record, followed by `records` captures.
+    Payload sizes vary uniformly between half and one and a half payload_size.
+    Returns the number of records written.
+    """
+    rng = random.Random(seed)
+    writer = WARCWriter(output, gzip=gzip)
+
+    def write(uri, rec_type, date, **kwargs):
+        headers = {"WARC-Record-ID": _record_id(rng), "WARC-Date": date}
+        headers.update(kwargs.pop("warc_headers_dict", {}))
+        record = writer.create_warc_record(
+            uri, rec_type, warc_headers_dict=headers, **kwargs
+        )
+        writer.write_record(record)
+        return record
+
+    info = b"software: warcdb synthetic\r\nformat: WARC File Format 1.0\r\n"
+    write(
+        "",
+        "warcinfo",
+        START_DATE.strftime("%Y-%m-%dT%H:%M:%SZ"),
+        payload=io.BytesIO(info),
+        length=len(info),
+        warc_content_type="application/warc-fields",
+    )
+    count = 1
+
+    captured = []
+    for i in range(records):
+        date = (START_DATE + datetime.timedelta(seconds=i + 1)).strftime(
+            "%Y-%m-%dT%H:%M:%SZ"
+        )
+        revisit = captured and rng.random() < revisit_ratio
+        if revisit:
+            url, digest, original_date = rng.choice(captured)
+        else:
+            url = f"https://www.host{rng.randrange(hosts)}.example.com/page/{i}?q={rng.choice(WORDS)}"
+
+        status = "404 Not Found" if i % 25 == 24 else "200 OK"
+        http_headers = StatusAndHeaders(
+            status,
+            [
+                ("Content-Type", "text/html; charset=utf-8"),
+                ("Set-Cookie", f"session={rng.getrandbits(64):016x}; Path=/"),
+            ],
+            protocol="HTTP/1.1",
+        )
+        if revisit:
+            response = writer.create_revisit_record(
+                url,
+                digest,
+                url,
+                original_date,
+                http_headers=http_headers,
+                warc_headers_dict={
+                    "WARC-Record-ID": _record_id(rng),
+                    "WARC-Date": date,
+                },
+            )
+            writer.write_record(response)
+        else:
+            size = rng.randint(payload_size // 2, payload_size * 3 // 2)
+            payload = _html(rng, url, size)
+            http_headers.add_header("Content-Length", str(len(payload)))
+            response = write(
+                url,
+                "response",
+                date,
+                payload=io.BytesIO(payload),
+                length=len(payload),
+                http_headers=http_headers,
+            )
+            captured.append((url, payload_digest(payload), date))
+        count += 1
+
+        if requests:
+            path = url.split(".example.com", 1)[1]
+            host = url.split("/")[2]
+            write(
+                url,
+                "request",
+                date,
+                http_headers=StatusAndHeaders(
+                    f"GET {path} HTTP/1.1",
+                    [("Host", host), ("Cookie", f"visit={i}")],
+                    is_http_request=True,
+                ),
+                warc_headers_dict={
+                    "WARC-Concurrent-To": response.rec_headers.get_header(
+                        "WARC-Record-ID"
+                    )
+                },
+            )
+            count += 1
+    return count
+
+
+def cdxj_index(warc: bytes, filename) -> list:
+    """The sorted CDXJ lines of the captures of a (gzipped) WARC"""
+    lines = []
+    records = ArchiveIterator(io.BytesIO(warc))
+    for r in records:
+        if r.rec_type not in ("response", "revisit"):
+            continue
+        url = r.rec_headers.get_header("WARC-Target-URI")
+        date = r.rec_headers.get_header("WARC-Date")
+        mime = "warc/revisit"
+        if r.rec_type == "response":
+            mime = r.http_headers.get_header("Content-Type").split(";")[0]
+        entry = {
+            "url": url,
+            "mime": mime,
+            "status": r.http_headers.get_statuscode(),
+            "digest": r.rec_headers.get_header("WARC-Payload-Digest").split(":")[-1],
+            "filename": filename,
+        }
+        r.content_stream().read()
+        entry["offset"] = str(records.get_record_offset())
+        entry["length"] = str(records.get_record_length())
+        lines.append(f"{surt(url)} {timestamp14(date)} {json.dumps(entry)}\n")
+    return sorted(lines)
+
+
+def write_synthetic_wacz(path, **params) -> int:
+    """
+    Write a synthetic WACZ file: a single (stored, so seekable) archive/data.warc.gz,
+    with its CDXJ index. Takes the parameters of write_synthetic_warc().
+    Returns the number of records written.
+    """
+    params["gzip"] = True
+    warc = io.BytesIO()
+    count = write_synthetic_warc(warc, **params)
+    with zipfile.ZipFile(path, "w", compression=zipfile.ZIP_STORED) as wacz:
+
+        def add(name, data):
+            # With a fixed timestamp, so the WACZ is the same byte for byte
+            wacz.writestr(zipfile.ZipInfo(name, date_time=(1980, 1, 1, 0, 0, 0)), data)
+
+        add("archive/data.warc.gz", warc.getvalue())
+        add("indexes/index.cdxj", "".join(cdxj_index(warc.getvalue(), "data.warc.gz")))
+        add(
+            "datapackage.json",
+            json.dumps(
+                {
+                    "profile": "data-package",
+                    "resources": [
+                        {"name": "data.warc.gz", "path": "archive/data.warc.gz"},
+                        {"name": "index.cdxj", "path": "indexes/index.cdxj"},
+                    ],
+                    "wacz_version": "1.1.1",
+                }
+            ),
+        )
+    return count
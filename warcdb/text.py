@@ -0,0 +1,184 @@
+"""
+Full-text search over the text of responses.
+
+When enabled, the text of HTML and plain text responses is extracted on import
+(decoded from its charset, with markup, scripts and styles stripped from HTML)
+and stored in the response_text table, with the same batched transaction as the records.
+response_text_fts is an external-content FTS5 index over it, kept up to date by triggers,
+so search works as soon as the import is done:
+
+    SELECT * FROM response_text WHERE rowid IN
+        (SELECT rowid FROM response_text_fts WHERE response_text_fts MATCH 'stocks')
+"""
+
+import json
+import re
+import zlib
+from html.parser import HTMLParser
+
+from warcdb.codecs import get_codec
+from warcdb.settings import get_setting, set_setting
+
+TEXT_TABLE = "response_text"
+
+HTML_TYPES = {"text/html", "application/xhtml+xml"}
+PLAIN_TYPES = {"text/plain", "text/markdown"}
+# Elements whose content isn't text.
+# Not head, whose end tag can be left out: what it holds is either skipped or has no content (meta, link)
+SKIPPED_ELEMENTS = {"script", "style", "noscript", "template", "svg"}
+
+_META_CHARSET = re.compile(rb"""<meta[^>]+charset\s*=\s*["']?([\w.:-]+)""", re.I)
+
+
+def text_search_enabled(db) -> bool:
+    return bool(get_setting(db, "full_text_search", False))
+
+
+class _TextExtractor(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.title = []
+        self.text = []
+        self._skipping = []
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == "title":
+            self._in_title = True
+        elif tag in SKIPPED_ELEMENTS:
+            self._skipping.append(tag)
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+        elif self._skipping and self._skipping[-1] == tag:
+            self._skipping.pop()
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title.append(data)
+        elif not self._skipping:
+            self.text.append(data)
+
+
+def _normalize_space(text: str) -> str:
+    return " ".join(text.split())
+
+
+def html_text(html: str):
+    """The (title, text) of an HTML document"""
+    parser = _TextExtractor()
+    parser.feed(html)
+    parser.close()
+    return _normalize_space(" ".join(parser.title)), _normalize_space(
+        " ".join(parser.text)
+    )
+
+
+def _http_header(http_headers, name):
+    for h in json.loads(http_headers or "[]"):
+        if h["header"].lower() == name:
+            return h["value"]
+    return None
+
+
+def decode_content(payload: bytes, content_encoding):
+    """
+    Undo a Content-Encoding the payload still has.
+    warcio usually decodes payloads on import, but keeps the header;
+    returns None for encodings that can't be decoded (e.g. br without the brotli package).
+    """
+    encoding = (content_encoding or "").strip().lower()
+    try:
+        if encoding in ("gzip", "x-gzip") and payload[:2] == b"\x1f\x8b":
+            return zlib.decompress(payload, 16 + zlib.MAX_WBITS)
+        if encoding == "br":
+            try:
+                import brotli
+            except ImportError:
+                return None
+            return brotli.decompress(payload)
+    except Exception:
+        # Most likely already decoded by warcio
+        return payload
+    return payload
+
+
+def decode_text(payload: bytes, charset=None) -> str:
+    """
+    Decode a payload with its declared charset, or the one of its <meta> tag.
+    Without either, it's decoded as UTF-8 if it is valid UTF-8, and as Windows-1252 otherwise.
+    """
+    if not charset:
+        match = _META_CHARSET.search(payload[:2048])
+        charset = match and match.group(1).decode("ascii")
+    if charset:
+        try:
+            return payload.decode(charset, errors="replace")
+        except LookupError:
+            pass
+    try:
+        return payload.decode("utf-8")
+    except UnicodeDecodeError:
+        return payload.decode("cp1252", errors="replace")
+
+
+def response_text(row: dict):
+    """
+    The (title, text) of a response row, or None if it has no textual payload.
+    """
+    payload = row.get("payload")
+    # Large payloads aren't read into memory (see warcdb.blobs)
+    if not payload or not isinstance(payload, (bytes, str)):
+        return None
+    if isinstance(payload, str):
+        payload = payload.encode()
+    content_type = _http_header(row.get("http_headers"), "content-type") or ""
+    mime, _, params = content_type.partition(";")
+    mime = mime.strip().lower()
+    if mime not in HTML_TYPES and mime not in PLAIN_TYPES:
+        return None
+
+    payload = decode_content(
+        payload, _http_header(row.get("http_headers"), "content-encoding")
+    )
+    if payload is None:
+        return None
+    charset = re.search(r"charset\s*=\s*[\"']?([\w.:-]+)", params, re.I)
+    text = decode_text(payload, charset and charset.group(1))
+    if mime in HTML_TYPES:
+        return html_text(text)
+    return None, _normalize_space(text)
+
+
+def text_rows(rows):
+    """Iterate over the response_text rows of response rows, as (warc_record_id, title, text) tuples"""
+    for row in rows:
+        extracted = response_text(row)
+        if extracted:
+            yield row["warc_record_id"], *extracted
+
+
+def enable_text_search(db):
+    """
+    Create the full-text search index, and fill it with the text of the responses already in the database.
+    Responses that already have their text extracted are skipped, so this can be run repeatedly.
+    """
+    if not db[f"{TEXT_TABLE}_fts"].exists():
+        db[TEXT_TABLE].enable_fts(["title", "text"], create_triggers=True)
+
+    codec = get_codec(get_setting(db, "payload_codec"))
+    sql = f"""
+        SELECT warc_record_id, http_headers, payload FROM response
+        WHERE payload IS NOT NULL
+        AND warc_record_id NOT IN (SELECT warc_record_id FROM [{TEXT_TABLE}])
+    """
+    rows = (
+        {**row, "payload": codec.decompress(row["payload"])} for row in db.query(sql)
+    )
+    with db.conn:
+        db.conn.executemany(
+            f"INSERT OR IGNORE INTO [{TEXT_TABLE}] (warc_record_id, title, text) VALUES (?, ?, ?)",
+            text_rows(rows),
+        )
+        set_setting(db, "full_text_search", 1)